@@ -2,23 +2,69 @@
 # -*- coding:utf-8 -*-
 from collections import Counter
 import os
+import sys
 import json
 from typing import Dict, List
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
-from universal_ie.generation_format.generation_format import GenerationFormat
+from universal_ie.generation_format.generation_format import GenerationFormat, SchemaAccumulator
 from universal_ie.generation_format import generation_format_dict
 from universal_ie.generation_format.structure_marker import BaseStructureMarker
 from universal_ie.dataset import Dataset
 from universal_ie.ie_format import Sentence
 
 
+def columnar_schema():
+    """ Arrow schema of `DatasetFeature` in `uie/seq2seq/features.py`, without `task` as the JSON lines """
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    from uie.seq2seq.features import DatasetFeature
+
+    return pa.schema([field for field in pa.schema(DatasetFeature.type) if field.name != "task"])
+
+
+class ColumnarWriter:
+    """ Write instances into a Parquet file or an Arrow IPC stream file (memory-mapped by `Dataset.from_file`) by batches """
+
+    def __init__(self, filename: str, output_format: str, schema: pa.Schema, batch_size: int = 1000):
+        self.schema = schema
+        self.batch_size = batch_size
+        self.batch = list()
+        if output_format == "parquet":
+            self.writer = pq.ParquetWriter(filename, schema)
+        elif output_format == "arrow":
+            self.writer = pa.ipc.new_stream(filename, schema)
+        else:
+            raise NotImplementedError(f"Output format {output_format} is not implemented.")
+
+    def write(self, instance: Dict):
+        self.batch += [instance]
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        columns = {name: [instance[name] for instance in self.batch] for name in self.schema.names}
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+        self.batch = list()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
 def convert_graph(
     generation_class: GenerationFormat,
     output_folder: str,
     datasets: Dict[str, List[Sentence]],
     language: str = "en",
     label_mapper: Dict = None,
+    output_format: str = "json",
 ):
+    """ Write `{split}.json` JSON lines and schema files into `output_folder`,
+    and `{split}.parquet` or `{split}.arrow` with the same columns if `output_format` is `parquet` or `arrow`
+    """
     convertor = generation_class(
         structure_maker=BaseStructureMarker(),
         language=language,
@@ -29,13 +75,19 @@ def convert_graph(
 
     os.makedirs(output_folder, exist_ok=True)
 
-    schema_counter = {
-        "entity": list(),
-        "relation": list(),
-        "event": list(),
-    }
+    schema_accumulator = SchemaAccumulator(convertor)
+
+    schema = columnar_schema() if output_format != "json" else None
 
     for data_type, instance_list in datasets.items():
+        # JSON lines are always written, the evaluation scripts read the gold `val.json` and `test.json`
+        columnar_writer = None
+        if schema is not None:
+            columnar_writer = ColumnarWriter(
+                os.path.join(output_folder, f"{data_type}.{output_format}"),
+                output_format=output_format,
+                schema=schema,
+            )
         with open(os.path.join(output_folder, f"{data_type}.json"), "w") as output:
             for instance in tqdm(instance_list):
                 counter.update([f"{data_type} sent"])
@@ -48,47 +100,48 @@ def convert_graph(
                 src, tgt, spot_labels, asoc_labels = converted_graph[:4]
                 spot_asoc = converted_graph[4]
 
-                schema_counter["entity"] += instance.entities
-                schema_counter["relation"] += instance.relations
-                schema_counter["event"] += instance.events
-
-                output.write(
-                    "%s\n"
-                    % json.dumps(
-                        {
-                            "text": src,
-                            "tokens": instance.tokens,
-                            "record": tgt,
-                            "entity": [
-                                entity.to_offset(label_mapper)
-                                for entity in instance.entities
-                            ],
-                            "relation": [
-                                relation.to_offset(
-                                    ent_label_mapper=label_mapper,
-                                    rel_label_mapper=label_mapper,
-                                )
-                                for relation in instance.relations
-                            ],
-                            "event": [
-                                event.to_offset(evt_label_mapper=label_mapper)
-                                for event in instance.events
-                            ],
-                            "spot": list(spot_labels),
-                            "asoc": list(asoc_labels),
-                            "spot_asoc": spot_asoc,
-                        },
-                        ensure_ascii=False,
-                    )
+                schema_accumulator.update(
+                    entities=instance.entities,
+                    relations=instance.relations,
+                    events=instance.events,
                 )
+
+                instance_dict = {
+                    "text": src,
+                    "tokens": instance.tokens,
+                    "record": tgt,
+                    "entity": [
+                        entity.to_offset(label_mapper)
+                        for entity in instance.entities
+                    ],
+                    "relation": [
+                        relation.to_offset(
+                            ent_label_mapper=label_mapper,
+                            rel_label_mapper=label_mapper,
+                        )
+                        for relation in instance.relations
+                    ],
+                    "event": [
+                        event.to_offset(evt_label_mapper=label_mapper)
+                        for event in instance.events
+                    ],
+                    "spot": list(spot_labels),
+                    "asoc": list(asoc_labels),
+                    "spot_asoc": spot_asoc,
+                }
+                output.write("%s\n" % json.dumps(instance_dict, ensure_ascii=False))
+                if columnar_writer is not None:
+                    columnar_writer.write(instance_dict)
+        if columnar_writer is not None:
+            columnar_writer.close()
     convertor.output_schema(os.path.join(output_folder, "record.schema"))
-    convertor.get_entity_schema(schema_counter["entity"]).write_to_file(
+    schema_accumulator.get_entity_schema().write_to_file(
         os.path.join(output_folder, f"entity.schema")
     )
-    convertor.get_relation_schema(schema_counter["relation"]).write_to_file(
+    schema_accumulator.get_relation_schema().write_to_file(
         os.path.join(output_folder, f"relation.schema")
     )
-    convertor.get_event_schema(schema_counter["event"]).write_to_file(
+    schema_accumulator.get_event_schema().write_to_file(
         os.path.join(output_folder, f"event.schema")
     )
     print(counter)
@@ -178,6 +231,13 @@ def main():
     parser.add_argument("-format", dest="generation_format", default="spotasoc")
     parser.add_argument("-config", dest="config", default="data_config/relation")
     parser.add_argument("-output", dest="output", default="relation")
+    parser.add_argument(
+        "-output_format",
+        dest="output_format",
+        default="json",
+        choices=["json", "parquet", "arrow"],
+        help="Also write columnar Parquet or Arrow IPC files besides JSON lines",
+    )
     options = parser.parse_args()
 
     generation_class = generation_format_dict.get(options.generation_format)
@@ -213,6 +273,7 @@ def main():
                 datasets=datasets,
                 language=dataset.language,
                 label_mapper=label_mapper,
+                output_format=options.output_format,
             )
         elif options.generation_format == "oneie":
             convert_to_oneie(output_name, datasets=datasets)
@@ -65,47 +65,72 @@ class GenerationFormat:
         record_schema.write_to_file(filename)
 
     def get_entity_schema(self, entities: List[Entity]):
-        schema_role_map = set()
-        for entity in entities:
-            schema_role_map.add(self.get_label_str(entity.label))
-        return RecordSchema(
-            type_list=list(schema_role_map),
-            role_list=list(),
-            type_role_dict=dict()
-        )
+        accumulator = SchemaAccumulator(self)
+        accumulator.update(entities=entities)
+        return accumulator.get_entity_schema()
 
     def get_relation_schema(self, relations: List[Relation]):
-        record_role_map = defaultdict(set)
-        role_set = set()
+        accumulator = SchemaAccumulator(self)
+        accumulator.update(relations=relations)
+        return accumulator.get_relation_schema()
 
+    def get_event_schema(self, events: List[Event]):
+        accumulator = SchemaAccumulator(self)
+        accumulator.update(events=events)
+        return accumulator.get_event_schema()
+
+
+class SchemaAccumulator:
+    """
+    Streaming entity, relation and event schemas of converted instances.
+    Types and roles are added instance by instance in the same order as `get_*_schema` over all records,
+    so the records are not kept until the end and the schema files stay the same.
+    """
+
+    def __init__(self, generation_format: GenerationFormat) -> None:
+        self.generation_format = generation_format
+        self.entity_type_set = set()
+        self.relation_role_map = defaultdict(set)
+        self.event_role_map = defaultdict(set)
+
+    def update(self,
+               entities: List[Entity] = (),
+               relations: List[Relation] = (),
+               events: List[Event] = ()):
+        get_label_str = self.generation_format.get_label_str
+        for entity in entities:
+            self.entity_type_set.add(get_label_str(entity.label))
         for relation in relations:
-            record_role_map[self.get_label_str(relation.label)].add(self.get_label_str(relation.arg1.label))
-            record_role_map[self.get_label_str(relation.label)].add(self.get_label_str(relation.arg2.label))
-
-        for record in record_role_map:
-            role_set.update(record_role_map[record])
-            record_role_map[record] = list(self.record_role_map[record])
+            self.relation_role_map[get_label_str(relation.label)].add(get_label_str(relation.arg1.label))
+            self.relation_role_map[get_label_str(relation.label)].add(get_label_str(relation.arg2.label))
+        for event in events:
+            for role, _ in event.args:
+                self.event_role_map[get_label_str(event.label)].add(get_label_str(role))
 
+    def get_entity_schema(self):
         return RecordSchema(
-            type_list=list(record_role_map.keys()),
-            role_list=list(role_set),
-            type_role_dict=record_role_map
+            type_list=list(self.entity_type_set),
+            role_list=list(),
+            type_role_dict=dict()
         )
 
-    def get_event_schema(self, events: List[Event]):
-        record_role_map = defaultdict(set)
+    def get_record_schema(self, role_map):
         role_set = set()
+        record_role_map = defaultdict(set)
 
-        for event in events:
-            for role, _ in event.args:
-                record_role_map[self.get_label_str(event.label)].add(self.get_label_str(role))
-
-        for record in record_role_map:
-            role_set.update(record_role_map[record])
-            record_role_map[record] = list(self.record_role_map[record])
+        for record in role_map:
+            role_set.update(role_map[record])
+            # Roles of the type-role dict come from the annotated records, the same as `output_schema`
+            record_role_map[record] = list(self.generation_format.record_role_map[record])
 
         return RecordSchema(
             type_list=list(record_role_map.keys()),
             role_list=list(role_set),
             type_role_dict=record_role_map
         )
+
+    def get_relation_schema(self):
+        return self.get_record_schema(self.relation_role_map)
+
+    def get_event_schema(self):
+        return self.get_record_schema(self.event_role_map)
@@ -6,6 +6,80 @@ task=$1
 source function_code_e2h.bash
 
 export verbose=True
+# data_file_format=parquet/arrow trains on the columnar files of `uie_convert.py -output_format`
+
+# one_process=True runs the easy, hard and main stages of all seeds in one process by e2h.py,
+# the tokenizer, the datasets and the trained model are kept in memory between stages
+if [[ ${one_process} == True ]]
+then
+  echo "Easy, Hard and Main Stages in one process ..."
+  if [[ ${verbose} == True ]]
+  then
+    e2h_stdout_file=/dev/stdout
+    e2h_stderr_file=/dev/stderr
+    disable_tqdm=False
+  else
+    e2h_stdout_file=${model_folder}_e2h.log
+    e2h_stderr_file=${model_folder}_e2h.err
+    disable_tqdm=True
+  fi
+  CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} e2h.py \
+    --skill_task=${task} \
+    --easy_output_dir=${easy_model_folder} \
+    --hard_output_dir=${hard_model_folder} \
+    --run_time=${run_time} \
+    --easy_num_train_epochs=${easy_epoch} \
+    --easy_max_source_length=${easy_max_source_length:-"256"} \
+    --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} ${preprocessed_folder} \
+    --report_to wandb \
+    --use_fast_tokenizer=True \
+    --ddp_find_unused_parameters=False \
+    --predict_with_generate \
+    --evaluation_strategy=${evaluation_strategy} \
+    --save_strategy=${evaluation_strategy} \
+    --metric_for_best_model eval_overall-F1 \
+    --save_total_limit 1 \
+    --load_best_model_at_end \
+    --max_source_length=${max_source_length:-"256"} \
+    --max_prefix_length=${max_prefix_length:-"-1"} \
+    --max_target_length=${max_target_length:-"256"} \
+    --num_train_epochs=${epoch} \
+    --cache_dir=${cache_dir} \
+    --task=${task_name} \
+    --skills=${skills} \
+    --empty_ratio=${empty_ratio} \
+    --sent_num=${sent_num} \
+    --M=${M} \
+    --train_file=${data_folder}/train.${data_file_format:-"json"} \
+    --validation_file=${data_folder}/val.${data_file_format:-"json"} \
+    --test_file=${data_folder}/test.${data_file_format:-"json"} \
+    --record_schema=${data_folder}/record.schema \
+    --per_device_train_batch_size=${batch_size} \
+    --gradient_accumulation_steps=${gradient_accumulation_steps} \
+    --per_device_eval_batch_size=$((batch_size * 4)) \
+    --output_dir=${model_folder} \
+    --overwrite_output_dir \
+    --model_name_or_path=${model_name} \
+    --learning_rate=${lr} \
+    --source_prefix="${task_name}: " \
+    --lr_scheduler_type=${lr_scheduler} \
+    --label_smoothing_factor=${label_smoothing} \
+    --eval_steps ${eval_steps} \
+    --decoding_format ${decoding_format} \
+    --warmup_ratio ${warmup_ratio} \
+    --preprocessing_num_workers=4 \
+    --dataloader_num_workers=0 \
+    --meta_negative=${negative} \
+    --meta_positive_rate=${positive} \
+    --skip_memory_metrics \
+    --no_remove_unused_columns \
+    --ordered_prompt=${ordered_prompt} \
+    --save_better_checkpoint=False \
+    --start_eval_step=${start_eval_step:-"0"} \
+    --spot_noise=${spot_noise} \
+    --asoc_noise=${asoc_noise} \
+    --seed=${seed} --disable_tqdm=${disable_tqdm} >${e2h_stdout_file} 2>${e2h_stderr_file}
+fi
 
 for index in $(seq 1 ${run_time}); do
   main_output_dir=${model_folder}_run${index}
@@ -43,19 +117,22 @@ for index in $(seq 1 ${run_time}); do
   echo "hard_stdout_file: " ${hard_stdout_file}
   echo "hard_stderr_file: " ${hard_stderr_file}
 
-  if [[ ! -d ${main_output_dir} ]]
+  if [[ ${one_process} == True ]]
+  then
+    echo "Trained by e2h.py"
+  elif [[ ! -d ${main_output_dir} ]]
   then
     mkdir ${main_output_dir}
   else
     continue
   fi
 
-  if [[ ! -d ${easy_output_dir} ]]
+  if [[ ${one_process} != True && ! -d ${easy_output_dir} ]]
   then
     echo "Easy Stage ..."
     mkdir ${easy_output_dir}
     CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} skill_${task}.py \
-      --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} \
+      --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} ${preprocessed_folder} \
       --stage easy \
       --report_to wandb \
       --use_fast_tokenizer=True \
@@ -74,9 +151,9 @@ for index in $(seq 1 ${run_time}); do
       --task=${task_name} \
       --skills=${skills} \
       --empty_ratio=${empty_ratio} \
-      --train_file=${data_folder}/train.json \
-      --validation_file=${data_folder}/val.json \
-      --test_file=${data_folder}/test.json \
+      --train_file=${data_folder}/train.${data_file_format:-"json"} \
+      --validation_file=${data_folder}/val.${data_file_format:-"json"} \
+      --test_file=${data_folder}/test.${data_file_format:-"json"} \
       --record_schema=${data_folder}/record.schema \
       --per_device_train_batch_size=${batch_size} \
       --gradient_accumulation_steps=${gradient_accumulation_steps} \
@@ -103,12 +180,12 @@ for index in $(seq 1 ${run_time}); do
       --seed=${seed}${index} --disable_tqdm=${disable_tqdm} >${easy_stdout_file} 2>${easy_stderr_file}
   fi
 
-  if [[ ! -d ${hard_output_dir} ]]
+  if [[ ${one_process} != True && ! -d ${hard_output_dir} ]]
   then
     echo "Hard Stage ..."
     mkdir ${hard_output_dir}
     CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} skill_${task}.py \
-      --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} \
+      --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} ${preprocessed_folder} \
       --stage hard \
       --report_to wandb \
       --use_fast_tokenizer=True \
@@ -127,9 +204,9 @@ for index in $(seq 1 ${run_time}); do
       --task=${task_name} \
       --sent_num=${sent_num} \
       --M=${M} \
-      --train_file=${data_folder}/train.json \
-      --validation_file=${data_folder}/val.json \
-      --test_file=${data_folder}/test.json \
+      --train_file=${data_folder}/train.${data_file_format:-"json"} \
+      --validation_file=${data_folder}/val.${data_file_format:-"json"} \
+      --test_file=${data_folder}/test.${data_file_format:-"json"} \
       --record_schema=${data_folder}/record.schema \
       --per_device_train_batch_size=${batch_size} \
       --gradient_accumulation_steps=${gradient_accumulation_steps} \
@@ -158,56 +235,59 @@ for index in $(seq 1 ${run_time}); do
       --seed=${seed}${index} --disable_tqdm=${disable_tqdm} >${hard_stdout_file} 2>${hard_stderr_file}
   fi
 
-  echo "Main Stage ..."
-  CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} skill_${task}.py \
-      --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} \
-      --stage main \
-      --report_to wandb \
-      --use_fast_tokenizer=True \
-      --ddp_find_unused_parameters=False \
-      --predict_with_generate \
-      --evaluation_strategy=${evaluation_strategy} \
-      --save_strategy=${evaluation_strategy} \
-      --metric_for_best_model eval_overall-F1 \
-      --save_total_limit 1 \
-      --load_best_model_at_end \
-      --max_source_length=${max_source_length:-"256"} \
-      --max_prefix_length=${max_prefix_length:-"-1"} \
-      --max_target_length=${max_target_length:-"256"} \
-      --num_train_epochs=${epoch} \
-      --cache_dir=${cache_dir} \
-      --task=${task_name} \
-      --train_file=${data_folder}/train.json \
-      --validation_file=${data_folder}/val.json \
-      --test_file=${data_folder}/test.json \
-      --record_schema=${data_folder}/record.schema \
-      --per_device_train_batch_size=${batch_size} \
-      --gradient_accumulation_steps=${gradient_accumulation_steps} \
-      --per_device_eval_batch_size=$((batch_size * 4)) \
-      --output_dir=${main_output_dir} \
-      --overwrite_output_dir \
-      --model_name_or_path=${hard_output_dir} \
-      --learning_rate=${lr} \
-      --source_prefix="${task_name}: " \
-      --lr_scheduler_type=${lr_scheduler} \
-      --label_smoothing_factor=${label_smoothing} \
-      --eval_steps ${eval_steps} \
-      --decoding_format ${decoding_format} \
-      --warmup_ratio ${warmup_ratio} \
-      --preprocessing_num_workers=4 \
-      --dataloader_num_workers=0 \
-      --meta_negative=${negative} \
-      --meta_positive_rate=${positive} \
-      --skip_memory_metrics \
-      --no_remove_unused_columns \
-      --ordered_prompt=${ordered_prompt} \
-      --save_better_checkpoint=False \
-      --start_eval_step=${start_eval_step:-"0"} \
-      --spot_noise=${spot_noise} \
-      --asoc_noise=${asoc_noise} \
-      --seed=${seed}${index} --disable_tqdm=${disable_tqdm} >${main_stdout_file} 2>${main_stderr_file}
+  if [[ ${one_process} != True ]]
+  then
+    echo "Main Stage ..."
+    CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} skill_${task}.py \
+        --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} ${preprocessed_folder} \
+        --stage main \
+        --report_to wandb \
+        --use_fast_tokenizer=True \
+        --ddp_find_unused_parameters=False \
+        --predict_with_generate \
+        --evaluation_strategy=${evaluation_strategy} \
+        --save_strategy=${evaluation_strategy} \
+        --metric_for_best_model eval_overall-F1 \
+        --save_total_limit 1 \
+        --load_best_model_at_end \
+        --max_source_length=${max_source_length:-"256"} \
+        --max_prefix_length=${max_prefix_length:-"-1"} \
+        --max_target_length=${max_target_length:-"256"} \
+        --num_train_epochs=${epoch} \
+        --cache_dir=${cache_dir} \
+        --task=${task_name} \
+        --train_file=${data_folder}/train.${data_file_format:-"json"} \
+        --validation_file=${data_folder}/val.${data_file_format:-"json"} \
+        --test_file=${data_folder}/test.${data_file_format:-"json"} \
+        --record_schema=${data_folder}/record.schema \
+        --per_device_train_batch_size=${batch_size} \
+        --gradient_accumulation_steps=${gradient_accumulation_steps} \
+        --per_device_eval_batch_size=$((batch_size * 4)) \
+        --output_dir=${main_output_dir} \
+        --overwrite_output_dir \
+        --model_name_or_path=${hard_output_dir} \
+        --learning_rate=${lr} \
+        --source_prefix="${task_name}: " \
+        --lr_scheduler_type=${lr_scheduler} \
+        --label_smoothing_factor=${label_smoothing} \
+        --eval_steps ${eval_steps} \
+        --decoding_format ${decoding_format} \
+        --warmup_ratio ${warmup_ratio} \
+        --preprocessing_num_workers=4 \
+        --dataloader_num_workers=0 \
+        --meta_negative=${negative} \
+        --meta_positive_rate=${positive} \
+        --skip_memory_metrics \
+        --no_remove_unused_columns \
+        --ordered_prompt=${ordered_prompt} \
+        --save_better_checkpoint=False \
+        --start_eval_step=${start_eval_step:-"0"} \
+        --spot_noise=${spot_noise} \
+        --asoc_noise=${asoc_noise} \
+        --seed=${seed}${index} --disable_tqdm=${disable_tqdm} >${main_stdout_file} 2>${main_stderr_file}
+  fi
 
-  if [[ ${verbose} != True ]]
+  if [[ ${verbose} != True && ${one_process} != True ]]
   then
     tail -n 200 ${main_output_dir}/main.log
   fi
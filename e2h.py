@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Run the easy, hard and main stages of `skill_{task}.py` in one process.
+
+The tokenizer, the loaded and tokenized datasets and the trained model are kept in memory between stages
+instead of being reloaded by a new process for every stage.
+Every stage writes the same output folder as `e2h.bash`, and the main stage of every run writes `{output_dir}_run{index}`:
+
+    python e2h.py --skill_task relation --easy_output_dir output-e2h/easy --hard_output_dir output-e2h/hard \
+        --output_dir output-e2h/main --run_time 3 --seed 42 ... (the same options as the main stage of `e2h.bash`)
+
+As `e2h.bash`, the easy stage and the hard stage are skipped if their output folders exist,
+and a run is skipped if its main output folder exists.
+"""
+import copy
+import importlib
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import Optional
+
+from transformers import HfArgumentParser
+
+from uie.seq2seq.constrained_seq2seq import ConstraintSeq2SeqTrainingArguments
+from uie.seq2seq.trainer_arguments import ModelArguments, DataTrainingArguments
+from utils import StageCache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class E2HArguments:
+    """
+    Arguments of the easy and hard stages, the others are shared with the main stage.
+    """
+
+    skill_task: str = field(
+        metadata={"help": "Task of `skill_{task}.py`: entity, relation, event, or aste."}
+    )
+    easy_output_dir: str = field(
+        metadata={"help": "Output folder of the easy stage, shared by all runs."}
+    )
+    hard_output_dir: str = field(
+        metadata={"help": "Output folder of the hard stage, `{hard_output_dir}_run{index}` for every run."}
+    )
+    easy_num_train_epochs: Optional[float] = field(
+        default=None, metadata={"help": "Training epochs of the easy stage, `num_train_epochs` if not set."}
+    )
+    easy_max_source_length: Optional[int] = field(
+        default=None, metadata={"help": "Max source length of the easy stage, `max_source_length` if not set."}
+    )
+    run_time: int = field(
+        default=1, metadata={"help": "Number of runs, the seed of the i-th run is `{seed}{i}`."}
+    )
+
+
+def stage_arguments(arguments, **changes):
+    """ Shallow copy of `arguments` with `changes`,
+    `TrainingArguments` is not re-created since it sets up devices and the distributed process group once
+    """
+    arguments = copy.copy(arguments)
+    for name, value in changes.items():
+        setattr(arguments, name, value)
+    return arguments
+
+
+def main():
+    parser = HfArgumentParser((E2HArguments, ModelArguments, DataTrainingArguments, ConstraintSeq2SeqTrainingArguments))
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        e2h_args, model_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        e2h_args, model_args, data_args, training_args = parser.parse_args_into_dataclasses()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    logger.setLevel(logging.INFO)
+
+    skill_module = importlib.import_module(f"skill_{e2h_args.skill_task}")
+    cache = StageCache()
+
+    for index in range(1, e2h_args.run_time + 1):
+        main_output_dir = f"{training_args.output_dir}_run{index}"
+        hard_output_dir = f"{e2h_args.hard_output_dir}_run{index}"
+        if os.path.isdir(main_output_dir):
+            continue
+
+        stages = [
+            # stage, output folder, initial model, data arguments, training arguments
+            ("easy", e2h_args.easy_output_dir, model_args.model_name_or_path,
+             dict(max_source_length=e2h_args.easy_max_source_length or data_args.max_source_length,
+                  spot_noise=0., asoc_noise=0.),
+             dict(num_train_epochs=e2h_args.easy_num_train_epochs or training_args.num_train_epochs)),
+            ("hard", hard_output_dir, e2h_args.easy_output_dir, dict(), dict()),
+            ("main", main_output_dir, hard_output_dir, dict(), dict()),
+        ]
+        for stage, output_dir, model_name_or_path, data_changes, training_changes in stages:
+            if stage != "main" and os.path.isdir(output_dir):
+                logger.info(f"Skip the {stage} stage, {output_dir} exists")
+                # The next stage loads the saved model
+                cache.model = None
+                continue
+
+            logger.info(f"{stage.capitalize()} Stage ...")
+            run_name = training_args.run_name
+            if run_name == training_args.output_dir:  # default run name
+                run_name = output_dir
+            skill_module.main(
+                args=(
+                    stage_arguments(model_args, model_name_or_path=model_name_or_path),
+                    stage_arguments(data_args, stage=stage, **data_changes),
+                    stage_arguments(training_args, output_dir=output_dir, run_name=run_name,
+                                    seed=int(f"{training_args.seed}{index}"), **training_changes),
+                ),
+                cache=cache,
+            )
+
+            if "wandb" in training_args.report_to:
+                import wandb
+
+                # One wandb run for every stage
+                wandb.finish()
+
+        # The easy stage of the next run starts from the saved model, or is skipped
+        cache.model = None
+
+
+if __name__ == "__main__":
+    main()
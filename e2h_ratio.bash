@@ -87,7 +87,7 @@ for index in $(seq 1 ${run_time}); do
       eval_steps=$(python scripts/get_eval_batch_num.py ${run_data_folder}/train.json ${batch_size} 10)
       echo Eval each ${eval_steps} batch
       CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} skill_${task}.py \
-        --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} \
+        --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} ${preprocessed_folder} \
         --stage easy \
         --report_to wandb \
         --use_fast_tokenizer=True \
@@ -140,7 +140,7 @@ for index in $(seq 1 ${run_time}); do
       echo "Hard Stage ..."
       mkdir ${hard_run_output_folder}
       CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} skill_${task}.py \
-        --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} \
+        --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} ${preprocessed_folder} \
         --stage hard \
         --report_to wandb \
         --use_fast_tokenizer=True \
@@ -192,7 +192,7 @@ for index in $(seq 1 ${run_time}); do
 
     echo "Main Stage ..."
     CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES} ${run_command} skill_${task}.py \
-        --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} \
+        --do_train --do_eval --do_predict ${constraint_decoding} ${fp16} ${preprocessed_folder} \
         --stage main \
         --report_to wandb \
         --use_fast_tokenizer=True \
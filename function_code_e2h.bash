@@ -313,6 +313,12 @@ then
   model_folder=${model_folder}_CD
 fi
 
+if [[ ${preprocess} == True ]]
+then
+  # Cache the stage datasets, shared by runs with the same data, stage arguments and seed
+  preprocessed_folder="--preprocessed_folder=${cache_dir}/preprocessed"
+fi
+
 if [[ ${ordered_prompt} == False ]]
 then
   model_folder=${model_folder}_RP
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Batched extraction inference without Trainer.
+
+Load a checkpoint and the schema folder (record/entity/relation/event.schema) once, stream JSONL instances
+(`text`, optional `tokens`) in, and stream offset-level records out, one JSON line per instance in input order:
+
+    python inference.py --model output-e2h/xxx_run1 --data data/relation/conll04 --task relation \
+        --input data/relation/conll04/test.json --output test_preds_record.txt
+"""
+import argparse
+import json
+import logging
+import math
+import sys
+import time
+from itertools import islice
+
+import torch
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+from uie.extraction.constants import text_start
+from uie.extraction.record_schema import RecordSchema
+from uie.sel2record.record import MapConfig
+from uie.sel2record.sel2record import SEL2Record
+from uie.seq2seq.constraint_decoder import (
+    get_constraint_decoder,
+    ConstraintLogitsProcessor,
+    append_logits_processor
+)
+from uie.seq2seq.data_collator import (
+    meta_data_collator_skill_entity,
+    meta_data_collator_skill_event,
+    meta_data_collator_skill_relation,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Prompt of the main skill and whether the asoc SSI follows the spot SSI, as in `DataCollatorForMetaSeq2Seq`
+main_skill_prompt = {
+    'entity': (meta_data_collator_skill_entity,
+               f"{meta_data_collator_skill_entity.HEC} {meta_data_collator_skill_entity.HES}", False),
+    'relation': (meta_data_collator_skill_relation,
+                 f"{meta_data_collator_skill_relation.HE} {meta_data_collator_skill_relation.HR}", True),
+    'aste': (meta_data_collator_skill_relation,
+             f"{meta_data_collator_skill_relation.HE} {meta_data_collator_skill_relation.HR}", True),
+    'event': (meta_data_collator_skill_event,
+              f"{meta_data_collator_skill_event.HT} {meta_data_collator_skill_event.HA}", True),
+}
+
+
+class ExtractionPredictor:
+    def __init__(self, model_path, schema_folder, task, map_config: MapConfig, ssi_model_name=None,
+                 max_source_length=256, max_prefix_length=-1, max_target_length=256, num_beams=1,
+                 constraint_decoding=False, fp16=False, device=None) -> None:
+        self._device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self._tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+        self._model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+        self._model.to(self._device)
+        self._model.half() if fp16 else None
+        self._model.eval()
+
+        self._max_source_length = max_source_length
+        self._max_target_length = max_target_length
+        self._num_beams = num_beams
+
+        self._schema = RecordSchema.read_from_file(f"{schema_folder}/record.schema")
+        self._sel2record = SEL2Record(
+            schema_dict=SEL2Record.load_schema_dict(schema_folder),
+            decoding_schema='spotasoc',
+            map_config=map_config,
+        )
+
+        # Ordered full SSI, the same as evaluation in `DataCollatorForMetaSeq2Seq`
+        collator_module, prompt, with_asoc = main_skill_prompt[task]
+        ssi_generator = collator_module.DynamicSSIGenerator(
+            tokenizer=self._tokenizer,
+            schema=self._schema,
+            model_name=ssi_model_name or model_path,
+            ordered_prompt=True,
+        )
+        prefix = self._tokenizer.encode(prompt, add_special_tokens=False) + ssi_generator.full_spot()
+        if with_asoc:
+            prefix += ssi_generator.full_asoc()
+        if max_prefix_length is not None and max_prefix_length >= 0:
+            prefix = prefix[:max_prefix_length]
+        self._prefix = prefix + [ssi_generator.text_start]
+
+        if constraint_decoding:
+            self._constraint_decoder = get_constraint_decoder(
+                tokenizer=self._tokenizer,
+                type_schema=self._schema,
+                decoding_schema='spotasoc',
+                task_name='record',
+            )
+        else:
+            self._constraint_decoder = None
+        self._constraint_mask_cache = dict()
+
+        self._to_remove_token_list = [token for token in [self._tokenizer.bos_token,
+                                                          self._tokenizer.eos_token,
+                                                          self._tokenizer.pad_token] if token]
+
+    def postprocess_text(self, x_str):
+        # Clean `bos` `eos` `pad` for cleaned text
+        for to_remove_token in self._to_remove_token_list:
+            x_str = x_str.replace(to_remove_token, '')
+        return x_str.strip()
+
+    def encode(self, text_list):
+        """ SSI prefix + `text_start` + text ids, truncated to `max_source_length` """
+        text_ids = self._tokenizer(text_list, max_length=self._max_source_length, truncation=True)['input_ids']
+        return [(self._prefix + ids)[:self._max_source_length] for ids in text_ids]
+
+    @torch.no_grad()
+    def generate(self, input_ids_list):
+        max_length = max(len(input_ids) for input_ids in input_ids_list)
+        pad_token_id = self._tokenizer.pad_token_id
+        input_ids = torch.tensor(
+            [input_ids + [pad_token_id] * (max_length - len(input_ids)) for input_ids in input_ids_list],
+            dtype=torch.long,
+            device=self._device,
+        )
+        attention_mask = (torch.arange(max_length, device=self._device)[None, :]
+                          < torch.tensor([len(x) for x in input_ids_list], device=self._device)[:, None]).long()
+
+        gen_kwargs = {
+            "max_length": self._max_target_length,
+            "num_beams": self._num_beams,
+        }
+        if self._constraint_decoder is not None:
+            logits_processor = ConstraintLogitsProcessor(
+                constraint_decoder=self._constraint_decoder,
+                src_sentences=input_ids,
+                num_beams=self._num_beams,
+                mask_cache=self._constraint_mask_cache,
+            )
+            with append_logits_processor(self._model, logits_processor):
+                generated_tokens = self._model.generate(input_ids, attention_mask=attention_mask, **gen_kwargs)
+        else:
+            generated_tokens = self._model.generate(input_ids, attention_mask=attention_mask, **gen_kwargs)
+
+        decoded_preds = self._tokenizer.batch_decode(
+            generated_tokens, skip_special_tokens=False, clean_up_tokenization_spaces=False
+        )
+        return [self.postprocess_text(pred) for pred in decoded_preds]
+
+    def predict(self, instances, batch_size=32, bucket_batches=16):
+        """ Predict records of streaming instances
+
+        Instances are read `batch_size * bucket_batches` at a time, sorted by encoded length inside the window
+        and batched, then yielded in input order.
+
+        Args:
+            instances (Iterable[Dict]): with `text` and optional `tokens` (default split by space)
+            batch_size (int):
+            bucket_batches (int): number of batches in one length bucketing window
+
+        Yields:
+            (Dict, str, Dict, float): instance, generated SEL, offset-level record, latency of its batch
+        """
+        instances = iter(instances)
+        while True:
+            window = list(islice(instances, batch_size * bucket_batches))
+            if len(window) == 0:
+                break
+
+            input_ids_list = self.encode([instance['text'] for instance in window])
+            order = sorted(range(len(window)), key=lambda index: len(input_ids_list[index]))
+
+            preds, latency = [None] * len(window), [0.] * len(window)
+            for start in range(0, len(order), batch_size):
+                batch_index = order[start:start + batch_size]
+                start_time = time.perf_counter()
+                batch_preds = self.generate([input_ids_list[index] for index in batch_index])
+                batch_latency = time.perf_counter() - start_time
+                for index, pred in zip(batch_index, batch_preds):
+                    preds[index], latency[index] = pred, batch_latency
+
+            for instance, pred, instance_latency in zip(window, preds, latency):
+                tokens = instance.get('tokens') or instance['text'].split(' ')
+                record = self._sel2record.sel2record(pred, instance['text'], tokens)
+                yield instance, pred, record, instance_latency
+
+
+def read_jsonl(filename):
+    input_file = sys.stdin if filename == '-' else open(filename)
+    for line in input_file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, help='Fine-tuned checkpoint folder')
+    parser.add_argument('--data', required=True, help='Folder of record.schema/entity.schema/relation.schema/event.schema')
+    parser.add_argument('--task', required=True, choices=list(main_skill_prompt.keys()))
+    parser.add_argument('--input', default='-', help='JSONL with `text` (and `tokens`), `-` for stdin')
+    parser.add_argument('--output', default='-', help='JSONL of records, `-` for stdout')
+    parser.add_argument('--seq2seq_output', default=None, help='Write generated SEL, one per line')
+    parser.add_argument('--map_config', default='config/offset_map/closest_offset_en.yaml')
+    parser.add_argument('--ssi_model_name', default=None,
+                        help='Backbone name deciding the SSI prompt tokens, `uie` models use <spot>/<asoc>')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--bucket_batches', type=int, default=16)
+    parser.add_argument('--max_source_length', type=int, default=256)
+    parser.add_argument('--max_prefix_length', type=int, default=-1)
+    parser.add_argument('--max_target_length', type=int, default=256)
+    parser.add_argument('--num_beams', type=int, default=1)
+    parser.add_argument('--constraint_decoding', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    options = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+        handlers=[logging.StreamHandler(sys.stderr)],
+    )
+
+    predictor = ExtractionPredictor(
+        model_path=options.model,
+        schema_folder=options.data,
+        task=options.task,
+        map_config=MapConfig.load_from_yaml(options.map_config),
+        ssi_model_name=options.ssi_model_name,
+        max_source_length=options.max_source_length,
+        max_prefix_length=options.max_prefix_length,
+        max_target_length=options.max_target_length,
+        num_beams=options.num_beams,
+        constraint_decoding=options.constraint_decoding,
+        fp16=options.fp16,
+    )
+
+    output = sys.stdout if options.output == '-' else open(options.output, 'w')
+    seq2seq_output = open(options.seq2seq_output, 'w') if options.seq2seq_output else None
+
+    instance_num, latency_list = 0, list()
+    start_time = time.perf_counter()
+    for _, pred, record, latency in predictor.predict(read_jsonl(options.input),
+                                                      batch_size=options.batch_size,
+                                                      bucket_batches=options.bucket_batches):
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+        seq2seq_output.write(pred + '\n') if seq2seq_output else None
+        instance_num += 1
+        latency_list += [latency]
+    total_time = time.perf_counter() - start_time
+
+    output.close() if output is not sys.stdout else output.flush()
+    seq2seq_output.close() if seq2seq_output else None
+
+    if instance_num > 0:
+        latency_list.sort()
+        logger.info(f"Instances: {instance_num}, Time: {total_time:.2f}s, "
+                    f"Throughput: {instance_num / total_time:.2f} instances/s")
+        logger.info(f"Batch latency: mean {sum(latency_list) / instance_num * 1000:.1f}ms, "
+                    f"p50 {latency_list[instance_num // 2] * 1000:.1f}ms, "
+                    f"p95 {latency_list[min(instance_num - 1, math.ceil(instance_num * 0.95) - 1)] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 import copy
+import functools
 import logging
 import os
 import sys
@@ -26,7 +27,8 @@ from collections import defaultdict
 from datasets import load_dataset, concatenate_datasets
 from datasets import Dataset, load_from_disk
 
-from utils import count_datasets, build_hard, convert_spot_asoc, convert_spot, convert_asoc, balance_data
+from utils import count_datasets, build_hard, convert_spot_asoc, convert_spot, convert_asoc, skill_instance, decompose_dataset, \
+    HardInstanceIterableDataset, load_raw_datasets, map_dataset, process_stage_datasets
 
 import transformers
 from transformers import (
@@ -42,11 +44,11 @@ from transformers.trainer_utils import get_last_checkpoint, is_main_process
 
 from uie.extraction import constants
 from uie.extraction.record_schema import RecordSchema
-from uie.extraction.extraction_metrics import get_extract_metrics
+from uie.extraction.extraction_metrics import get_extract_metrics, get_extraction_metric
 from uie.extraction.noiser.spot_asoc_noiser import SpotAsocNoiser
 from uie.extraction.dataset_processer import PrefixGenerator
 from uie.extraction.constants import BaseStructureMarker
-from uie.extraction.utils import convert_to_record_function
+from uie.extraction.utils import convert_to_record_function, tokenize_spot_asoc
 from uie.seq2seq.constrained_seq2seq import ConstraintSeq2SeqTrainingArguments, ConstraintSeq2SeqTrainer
 from uie.seq2seq.data_collator.meta_data_collator_skill_event import (
     DataCollatorForMetaSeq2Seq,
@@ -59,61 +61,44 @@ logger = logging.getLogger(__name__)
 
 
 def process_first(instance, structure_marker):  # Skill 1
-    first_instance = copy.deepcopy(instance)
-    spot_asoc = copy.deepcopy(instance["spot_asoc"])
-    for sa in spot_asoc:
-        sa["asoc"] = []
-    first_instance["record"] = convert_spot_asoc(spot_asoc, structure_marker)
-    first_instance["skill"] = "first"
-    first_instance["skill_input"] = ["empty", "empty"]
-    if len(first_instance["record"].split()) == 2 and first_instance["record"].split()[1] == structure_marker.sent_end:
-        first_instance["empty"] = True
-    else:
-        first_instance["empty"] = False
-    return first_instance
+    spot_asoc = [dict(sa, asoc=[]) for sa in instance["spot_asoc"]]
+    return skill_instance("first", ["empty", "empty"], convert_spot_asoc(spot_asoc, structure_marker), structure_marker)
 
 
 def process_second(instance, structure_marker):  # Skill 2
     second_instances = []
     for sa in instance["spot_asoc"]:
-        second_instance = copy.deepcopy(instance)
-        second_instance["skill"] = "second"
-        second_instance["skill_input"] = [sa["label"], sa["span"]]
         if len(sa["asoc"]) == 0:
-            second_instance["record"] = convert_spot_asoc([], structure_marker)
-        else:
-            second_instance["record"] = convert_spot_asoc([sa], structure_marker)
-        if len(second_instance["record"].split()) == 2 and second_instance["record"].split()[1] == structure_marker.sent_end:
-            second_instance["empty"] = True
+            record = convert_spot_asoc([], structure_marker)
         else:
-            second_instance["empty"] = False
-        second_instances.append(second_instance)
+            record = convert_spot_asoc([sa], structure_marker)
+        second_instances.append(skill_instance("second", [sa["label"], sa["span"]], record, structure_marker))
     return second_instances
 
 
-def decomposition(dataset, data_args):
+def decompose_function(spot_asoc_column, indices):
+    """ Batched map of `decompose_dataset`, emit the changed columns of skill instances and their source rows """
     structure_marker = BaseStructureMarker()
-    first_all = []
-    second_all = []
-    for instance in dataset:
-        # print("instance:\n", instance)
-        first_instance = process_first(instance, structure_marker)
-        second_instances = process_second(instance, structure_marker)
-        # print("first_instance:\n", first_instance)
-        # print("second_instances:\n", second_instances)
-        first_all.append(first_instance)
-        second_all.extend(second_instances)
-    first_all = balance_data(first_all, data_args)
-    second_all = balance_data(second_all, data_args)
+    skill_examples = {"source_index": [], "record": [], "skill": [], "skill_input": [], "empty": []}
+    for spot_asoc, index in zip(spot_asoc_column, indices):
+        instance = {"spot_asoc": spot_asoc}
+        skill_instances = [process_first(instance, structure_marker)]
+        skill_instances += process_second(instance, structure_marker)
+        for one_instance in skill_instances:
+            skill_examples["source_index"].append(index)
+            for key, value in one_instance.items():
+                skill_examples[key].append(value)
+    return skill_examples
 
-    all_data = []
-    all_data.extend(first_all) if "first" in data_args.skills else all_data
-    all_data.extend(second_all) if "second" in data_args.skills else all_data
-    all_data = {k: [r.get(k) for r in all_data] for k in all_data[0]}
 
-    dataset = Dataset.from_dict(all_data)  # convert dict to dataset
-
-    return dataset
+def decomposition(dataset, data_args):
+    return decompose_dataset(
+        dataset,
+        decompose_function,
+        input_columns=["spot_asoc"],
+        skill_order=["first", "second"],
+        data_args=data_args,
+    )
 
 
 def build_easy(datasets, data_args):
@@ -127,12 +112,16 @@ def process_datasets(datasets, data_args):
     if data_args.stage == "easy":
         build_easy(datasets, data_args)
     else:
-        train_dataset = copy.deepcopy(datasets["train"])
+        train_dataset = datasets["train"]
         temp_datasets = []
-        for n in range(2, data_args.sent_num + 1):  # build the hard stage
+        # Hard instances are merged on the fly by `HardInstanceIterableDataset` with `stream_hard`
+        sent_num = 1 if data_args.stream_hard else data_args.sent_num
+        if data_args.stage != "hard":  # the main stage trains on single sentences
+            sent_num = 1
+        for n in range(2, sent_num + 1):  # build the hard stage
             hard_train_dataset = build_hard(train_dataset, n, data_args.M)
             temp_datasets.append(hard_train_dataset)
-        if len(temp_datasets) > 0 and data_args.stage == "hard":  # the hard stage
+        if len(temp_datasets) > 0:  # the hard stage
             datasets["train"] = concatenate_datasets(temp_datasets)
 
         for key in datasets:
@@ -142,7 +131,13 @@ def process_datasets(datasets, data_args):
             datasets[key] = datasets[key].add_column("skill_input", skill_input_column)
 
 
-def main():
+def main(args=None, cache=None):
+    """ Train and evaluate one stage
+
+    Args:
+        args: (ModelArguments, DataTrainingArguments, ConstraintSeq2SeqTrainingArguments), parsed from the command line if not set
+        cache (StageCache, optional): datasets, tokenizer and model kept between stages run in one process by `e2h.py`
+    """
     os.environ[
         'CUBLAS_WORKSPACE_CONFIG'] = ':4096:8'  # Deterministic behavior of torch.addmm. Please refer to https://docs.nvidia.com/cuda/cublas/index.html#cublasApi_reproducibility
     torch.use_deterministic_algorithms(True)
@@ -150,7 +145,9 @@ def main():
     # os.environ['WANDB_MODE'] = 'offline'
 
     parser = HfArgumentParser((ModelArguments, DataTrainingArguments, ConstraintSeq2SeqTrainingArguments))
-    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+    if args is not None:
+        model_args, data_args, training_args = args
+    elif len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
         # If we pass only one argument to the script and it's the path to a json file,
         # let's parse it to get our arguments.
         model_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
@@ -236,12 +233,18 @@ def main():
         if data_args.test_file is not None:
             data_files["test"] = data_args.test_file
         logger.info(data_files)
-        datasets = load_dataset("uie_json.py", data_files=data_files, cache_dir=model_args.cache_dir)
+        # Only the columns for training, nested `entity`, `relation` and `event` are not materialized
+        datasets = load_raw_datasets(
+            data_files,
+            columns=["text", "record", "spot", "asoc", "spot_asoc"],
+            cache_dir=model_args.cache_dir,
+            cache=cache,
+        )
 
     # logger.info(datasets)
 
     # Obtain the datasets for training and evaluation
-    process_datasets(datasets, data_args)
+    process_stage_datasets(process_datasets, datasets, data_files, data_args, training_args.seed)
 
     logger.info(datasets)
 
@@ -262,13 +265,17 @@ def main():
     config.max_length = data_args.max_target_length
 
     tokenizer_name = model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path
-    tokenizer = AutoTokenizer.from_pretrained(
-        tokenizer_name,
-        cache_dir=model_args.cache_dir,
-        use_fast=model_args.use_fast_tokenizer,
-        revision=model_args.model_revision,
-        use_auth_token=True if model_args.use_auth_token else None,
-    )
+    if cache is not None and cache.tokenizer is not None:
+        # Saved with the model of the previous stage
+        tokenizer = cache.tokenizer
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(
+            tokenizer_name,
+            cache_dir=model_args.cache_dir,
+            use_fast=model_args.use_fast_tokenizer,
+            revision=model_args.model_revision,
+            use_auth_token=True if model_args.use_auth_token else None,
+        )
 
     # count_datasets(datasets, tokenizer)
 
@@ -280,15 +287,20 @@ def main():
     if tokenizer.pad_token:
         to_remove_token_list += [tokenizer.pad_token]
 
-    model = AutoModelForSeq2SeqLM.from_pretrained(
-        model_args.model_name_or_path,
-        from_tf=bool(".ckpt" in model_args.model_name_or_path),
-        config=config,
-        cache_dir=model_args.cache_dir,
-        revision=model_args.model_revision,
-        use_auth_token=True if model_args.use_auth_token else None,
-        # mirror='tuna',
-    )
+    if cache is not None and cache.model is not None:
+        # Weights of the previous stage in memory, the same as saved in `model_name_or_path`
+        model = cache.model
+        model.config.max_length = config.max_length
+    else:
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            model_args.model_name_or_path,
+            from_tf=bool(".ckpt" in model_args.model_name_or_path),
+            config=config,
+            cache_dir=model_args.cache_dir,
+            revision=model_args.model_revision,
+            use_auth_token=True if model_args.use_auth_token else None,
+            # mirror='tuna',
+        )
 
     if training_args.do_train and "uie" in model_args.model_name_or_path:
         to_add_special_token = list()
@@ -355,7 +367,7 @@ def main():
             f"`{model.__class__.__name__}`. This will lead to loss being calculated twice and will take up more memory"
         )
 
-    def preprocess_function(examples):
+    def preprocess_function(examples, target_length=None):
         inputs = examples[text_column]
         targets = examples[record_column]
 
@@ -364,7 +376,7 @@ def main():
 
         # Setup the tokenizer for targets
         with tokenizer.as_target_tokenizer():
-            labels = tokenizer(targets, max_length=max_target_length, padding=padding, truncation=True)
+            labels = tokenizer(targets, max_length=target_length or max_target_length, padding=padding, truncation=True)
 
         # If we are padding here, replace all tokenizer.pad_token_id in the labels by -100 when we want to ignore
         # padding in the loss.
@@ -381,6 +393,8 @@ def main():
             model_inputs['spots'] = examples['spot']
             model_inputs['asocs'] = examples['asoc']
             model_inputs['spot_asoc'] = examples['spot_asoc']
+            # Pre-tokenized spans for regenerating labels in the collator
+            model_inputs['spot_asoc_ids'] = [tokenize_spot_asoc(spot_asoc, tokenizer) for spot_asoc in examples['spot_asoc']]
             model_inputs['skill'] = examples['skill']
             model_inputs['skill_input'] = examples['skill_input']
 
@@ -394,6 +408,10 @@ def main():
         model_inputs['sample_prompt'] = [False] * len(model_inputs['input_ids'])
         return model_inputs
 
+    def preprocess_key():
+        # Arguments of `preprocess_function` for reusing tokenized datasets between stages
+        return prefix, data_args.source_prefix, data_args.max_source_length, max_target_length, padding
+
     def postprocess_text(x_str):
         # Clean `bos` `eos` `pad` for cleaned text
         for to_remove_token in to_remove_token_list:
@@ -409,22 +427,39 @@ def main():
         train_dataset = datasets["train"]
         if data_args.max_train_samples is not None:
             train_dataset = train_dataset.select(range(data_args.max_train_samples))
-        train_dataset = train_dataset.map(
-            preprocess_function,
-            batched=True,
-            num_proc=data_args.preprocessing_num_workers,
-            remove_columns=column_names,
-            load_from_cache_file=not data_args.overwrite_cache,
-            # features=Feature,
-        )
+        if data_args.stage == "hard" and data_args.stream_hard and data_args.sent_num >= 2:
+            train_dataset = HardInstanceIterableDataset(
+                train_dataset,
+                sent_num_list=list(range(2, data_args.sent_num + 1)),
+                M=data_args.M,
+                # Bind the training target length, `max_target_length` is changed for evaluation before iterating
+                function=functools.partial(preprocess_function, target_length=max_target_length),
+                seed=training_args.seed,
+                batch_size=training_args.train_batch_size * training_args.world_size,
+            )
+        else:
+            train_dataset = map_dataset(
+                train_dataset,
+                preprocess_function,
+                cache=cache,
+                cache_key=preprocess_key(),
+                batched=True,
+                num_proc=data_args.preprocessing_num_workers,
+                remove_columns=column_names,
+                load_from_cache_file=not data_args.overwrite_cache,
+                # features=Feature,
+            )
 
     if training_args.do_eval:
         max_target_length = data_args.val_max_target_length
         eval_dataset = datasets["validation"]
         if data_args.max_val_samples is not None:
             eval_dataset = eval_dataset.select(range(data_args.max_val_samples))
-        eval_dataset = eval_dataset.map(
+        eval_dataset = map_dataset(
+            eval_dataset,
             preprocess_function_eval,
+            cache=cache,
+            cache_key=preprocess_key(),
             batched=True,
             num_proc=data_args.preprocessing_num_workers,
             remove_columns=column_names,
@@ -437,8 +472,11 @@ def main():
         test_dataset = datasets["test"]
         if data_args.max_test_samples is not None:
             test_dataset = test_dataset.select(range(data_args.max_test_samples))
-        test_dataset = test_dataset.map(
+        test_dataset = map_dataset(
+            test_dataset,
             preprocess_function_eval,
+            cache=cache,
+            cache_key=preprocess_key(),
             batched=True,
             num_proc=data_args.preprocessing_num_workers,
             remove_columns=column_names,
@@ -485,6 +523,7 @@ def main():
             ),
             spot_asoc_nosier=spot_asoc_nosier,
             decoding_format=data_args.decoding_format,
+            pack_sequences=training_args.pack_sequences,
         )
     else:
         data_collator = DataCollatorForSeq2Seq(
@@ -565,12 +604,24 @@ def main():
         results = trainer.evaluate(max_length=data_args.val_max_target_length, num_beams=data_args.num_beams)
         results = {k: round(v, 4) for k, v in results.items()}
 
-        eval_results = trainer.predict(
-            eval_dataset,
-            metric_key_prefix="eval",
-            max_length=data_args.val_max_target_length,
-            num_beams=data_args.num_beams,
-        )
+        output_eval_preds_file = os.path.join(training_args.output_dir, "eval_preds_seq2seq.txt")
+        if training_args.predict_with_generate and training_args.stream_predictions:
+            trainer.predict_stream(
+                eval_dataset,
+                output_file=output_eval_preds_file,
+                postprocess_text=postprocess_text,
+                metric_key_prefix="eval",
+                max_length=data_args.val_max_target_length,
+                num_beams=data_args.num_beams,
+            )
+            eval_results = None
+        else:
+            eval_results = trainer.predict(
+                eval_dataset,
+                metric_key_prefix="eval",
+                max_length=data_args.val_max_target_length,
+                num_beams=data_args.num_beams,
+            )
 
         output_eval_file = os.path.join(training_args.output_dir, "eval_results_seq2seq.txt")
         if trainer.is_world_process_zero():
@@ -580,26 +631,43 @@ def main():
                     logger.info(f"  {key} = {value}")
                     writer.write(f"{key} = {value}\n")
 
-            if training_args.predict_with_generate:
+            if eval_results is not None and training_args.predict_with_generate:
                 eval_preds = tokenizer.batch_decode(
                     eval_results.predictions, skip_special_tokens=False, clean_up_tokenization_spaces=False
                 )
                 eval_preds = [postprocess_text(pred) for pred in eval_preds]
-                output_test_preds_file = os.path.join(training_args.output_dir, "eval_preds_seq2seq.txt")
-                with open(output_test_preds_file, "w") as writer:
+                with open(output_eval_preds_file, "w") as writer:
                     writer.write("\n".join(eval_preds))
 
     if training_args.do_predict:
         logger.info("*** Test ***")
 
-        test_results = trainer.predict(
-            test_dataset,
-            metric_key_prefix="test",
-            max_length=data_args.val_max_target_length,
-            num_beams=data_args.num_beams,
-        )
-        test_metrics = test_results.metrics
-        test_metrics["test_loss"] = round(test_metrics["test_loss"], 4)
+        output_test_preds_file = os.path.join(training_args.output_dir, "test_preds_seq2seq.txt")
+        if training_args.predict_with_generate and training_args.stream_predictions:
+            test_metrics = trainer.predict_stream(
+                test_dataset,
+                output_file=output_test_preds_file,
+                postprocess_text=postprocess_text,
+                metric=get_extraction_metric(
+                    label_constraint=record_schema,
+                    decoding_format=data_args.decoding_format,
+                ),
+                metric_key_prefix="test",
+                max_length=data_args.val_max_target_length,
+                num_beams=data_args.num_beams,
+            )
+            test_metrics = {k: round(v, 4) for k, v in test_metrics.items()}
+            test_results = None
+        else:
+            test_results = trainer.predict(
+                test_dataset,
+                metric_key_prefix="test",
+                max_length=data_args.val_max_target_length,
+                num_beams=data_args.num_beams,
+            )
+            test_metrics = test_results.metrics
+        if "test_loss" in test_metrics:
+            test_metrics["test_loss"] = round(test_metrics["test_loss"], 4)
 
         output_test_result_file = os.path.join(training_args.output_dir, "test_results_seq2seq.txt")
         if trainer.is_world_process_zero():
@@ -609,15 +677,18 @@ def main():
                     logger.info(f"  {key} = {value}")
                     writer.write(f"{key} = {value}\n")
 
-            if training_args.predict_with_generate:
+            if test_results is not None and training_args.predict_with_generate:
                 test_preds = tokenizer.batch_decode(
                     test_results.predictions, skip_special_tokens=False, clean_up_tokenization_spaces=False
                 )
                 test_preds = [postprocess_text(pred) for pred in test_preds]
-                output_test_preds_file = os.path.join(training_args.output_dir, "test_preds_seq2seq.txt")
                 with open(output_test_preds_file, "w") as writer:
                     writer.write("\n".join(test_preds))
 
+    if cache is not None:
+        cache.tokenizer = tokenizer
+        cache.model = trainer.model
+
     return results
 
 
@@ -51,3 +51,75 @@ class PrefixTree:
 
     def is_end_of_tree(self, tree: Dict):
         return len(tree) == 1 and self._end_symbol in tree
+
+
+class CompiledLabelTrie:
+    """
+    Label name prefix tree compiled to integer node ids.
+
+    - children of node `i` are `child_tokens[child_offsets[i]:child_offsets[i + 1]]` (CSR), ending label excluded
+    - `transition` maps (node, token) to the child node in O(1)
+    - `valid_tokens[i]` is the precomputed valid next token tuple of node `i`,
+      where finishing the label at node `i` is represented by `end_search_tokens`
+    """
+
+    root = 0
+
+    def __init__(self, label_name_list, tokenizer, end_search_tokens):
+        label_name_tree = get_label_name_tree(label_name_list, tokenizer, end_symbol=None)
+        self.end_search_tokens = tuple(end_search_tokens)
+
+        self.child_offsets = [0]
+        self.child_tokens = list()
+        self.child_nodes = list()
+        self.is_end = list()
+        self.is_leaf = list()
+        self._transition = dict()
+
+        # Breadth-first numbering, children of a node are contiguous in the CSR table
+        node_trees = [label_name_tree]
+        for node, tree in enumerate(node_trees):
+            self.is_end += [None in tree]
+            self.is_leaf += [len(tree) == 1 and None in tree]
+            for token, subtree in tree.items():
+                if token is None:
+                    continue
+                child = len(node_trees)
+                node_trees += [subtree]
+                self.child_tokens += [token]
+                self.child_nodes += [child]
+                self._transition[(node, token)] = child
+            self.child_offsets += [len(self.child_tokens)]
+
+        self.valid_tokens = [self._get_valid_tokens(node) for node in range(self.node_number)]
+
+    @property
+    def node_number(self):
+        return len(self.is_end)
+
+    def children(self, node):
+        return self.child_tokens[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def _get_valid_tokens(self, node):
+        if self.is_leaf[node]:
+            return self.end_search_tokens
+        valid_tokens = tuple(self.children(node))
+        if self.is_end[node]:
+            valid_tokens += self.end_search_tokens
+        return valid_tokens
+
+    def transition(self, node, token):
+        return self._transition[(node, token)]
+
+    def walk(self, generated):
+        """ Node reached by `generated` label tokens, stop early once a label is finished """
+        node = self.root
+        for token in generated:
+            node = self.transition(node, token)
+            if self.is_leaf[node]:
+                break
+        return node
+
+    def search(self, generated):
+        """ Valid next tokens after `generated` label tokens """
+        return self.valid_tokens[self.walk(generated)]
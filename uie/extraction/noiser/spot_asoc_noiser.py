@@ -12,34 +12,45 @@ class SpotAsocNoiser:
     asoc_noise_ratio: float = 0.1
     null_span: str = constants.null_span
 
-    def random_insert_spot(self, spot_asoc, spot_label_list=None):
+    @staticmethod
+    def get_random_functions(generator=None):
+        """ (binomial, integers, choice) of `generator`, or of the global NumPy state if `generator` is None
+        """
+        if generator is None:
+            return np.random.binomial, np.random.randint, np.random.choice
+        return generator.binomial, generator.integers, generator.choice
+
+    def random_insert_spot(self, spot_asoc, spot_label_list=None, generator=None):
         """随机插入 Spot，类别从 spot_label_list 中自动选择
 
         Args:
             spot_asoc ([type]): [description]
             spot_label_list ([type], optional): [description]. Defaults to None.
+            generator (np.random.Generator, optional): Defaults to None, the global NumPy state.
 
         Returns:
             [type]: [description]
         """
         if spot_label_list is None or len(spot_label_list) == 0:
             return spot_asoc
-        random_num = sum(np.random.binomial(1, self.spot_noise_ratio, len(spot_asoc)))
+        binomial, integers, choice = self.get_random_functions(generator)
+        random_num = sum(binomial(1, self.spot_noise_ratio, len(spot_asoc)))
         for _ in range(random_num):
-            random_position = np.random.randint(low=0, high=len(spot_asoc))
-            random_label = np.random.choice(spot_label_list)
+            random_position = integers(low=0, high=len(spot_asoc))
+            random_label = choice(spot_label_list)
             spot_asoc.insert(
                 random_position,
                 {"span": self.null_span, "label": random_label, 'asoc': list()}
             )
         return spot_asoc
 
-    def random_insert_asoc(self, spot_asoc, asoc_label_list=None):
+    def random_insert_asoc(self, spot_asoc, asoc_label_list=None, generator=None):
         """随机插入 Asoc，类别从 asoc_label_list 中自动选择
 
         Args:
             spot_asoc ([type]): [description]
             asoc_label_list ([type], optional): [description]. Defaults to None.
+            generator (np.random.Generator, optional): Defaults to None, the global NumPy state.
 
         Returns:
             [type]: [description]
@@ -48,25 +59,28 @@ class SpotAsocNoiser:
             return spot_asoc
         # asoc_sum = sum([len(x['asoc']) for x in spot_asoc])
         spot_sum = len(spot_asoc)
-        random_num = sum(np.random.binomial(1, self.asoc_noise_ratio, spot_sum))
+        binomial, integers, choice = self.get_random_functions(generator)
+        random_num = sum(binomial(1, self.asoc_noise_ratio, spot_sum))
         for _ in range(random_num):
-            random_label = np.random.choice(asoc_label_list)
-            spot_position = np.random.randint(low=0, high=len(spot_asoc))
-            asoc_position = np.random.randint(low=0, high=len(spot_asoc[spot_position]['asoc']) + 1)
+            random_label = choice(asoc_label_list)
+            spot_position = integers(low=0, high=len(spot_asoc))
+            asoc_position = integers(low=0, high=len(spot_asoc[spot_position]['asoc']) + 1)
             spot_asoc[spot_position]['asoc'].insert(
                 asoc_position,
                 (random_label, self.null_span)
             )
         return spot_asoc
 
-    def add_noise(self, spot_asoc, spot_label_list, asoc_label_list):
+    def add_noise(self, spot_asoc, spot_label_list, asoc_label_list, generator=None):
         spot_asoc = self.random_insert_asoc(
             spot_asoc=spot_asoc,
             asoc_label_list=asoc_label_list,
+            generator=generator,
         )
         spot_asoc = self.random_insert_spot(
             spot_asoc=spot_asoc,
             spot_label_list=spot_label_list,
+            generator=generator,
         )
         return spot_asoc
 
@@ -84,3 +84,119 @@ convert_to_record_function = {
     'spotasoc': convert_spot_asoc,
     'spotasocname': convert_spot_asoc_name,
 }
+
+
+def encode_chunk(text, tokenizer):
+    """ Ids of `text` between two structure markers of the target string, which are joined by single spaces:
+    the spaces are tokenized with the text (e.g., the lone '▁' of T5TokenizerFast) """
+    return tokenizer.encode(f' {text} ', add_special_tokens=False)
+
+
+def tokenize_spot_asoc(spot_asoc_instance, tokenizer):
+    """将一个 Spot-Asoc 实例的 Span 预先切分为 token id 片段
+
+    Args:
+        spot_asoc_instance ([type]): [description]
+        tokenizer ([type]): [description]
+
+    Returns:
+        List[List[int]]: span ids (`encode_chunk`) of spots and their asocs,
+            in the order of `spot span, asoc span, ..., next spot span`
+    """
+    span_ids_list = list()
+    for spot in spot_asoc_instance:
+        span_ids_list += [encode_chunk(spot['span'], tokenizer)]
+        for _, asoc_span in spot.get('asoc', list()):
+            span_ids_list += [encode_chunk(asoc_span, tokenizer)]
+    return span_ids_list
+
+
+class SpotAsocIdsConverter:
+    """
+    Build the target ids of `convert_to_record_function` by splicing structure marker ids with label and span ids,
+    instead of re-tokenizing the target string.
+    Structure markers are special tokens, which split the target string into chunks tokenized independently,
+    every chunk is encoded with its surrounding spaces by `encode_chunk`.
+    Tokenizers may still differ (e.g., a slow tokenizer stripping spaces around special tokens only when splitting),
+    `exact` tells whether the spliced ids of probe instances equal `tokenizer.encode(target_text)`.
+    """
+
+    probe_instances = [
+        [],
+        [{'label': 'person', 'span': 'John Wilkes Booth', 'asoc': [('kill', 'President Lincoln')]},
+         {'label': 'location', 'span': 'Washington , D.C.', 'asoc': list()}],
+    ]
+
+    def __init__(self, tokenizer, structure_maker, decoding_format='spotasoc', cache_size=4096):
+        if decoding_format not in convert_to_record_function:
+            raise NotImplementedError(f'{decoding_format} is not implemented.')
+        self.tokenizer = tokenizer
+        self.name_first = decoding_format == 'spotasoc'
+        self.cache_size = cache_size
+        self._cache = dict()
+
+        def marker_id(marker):
+            return tokenizer.convert_tokens_to_ids([marker])[0]
+
+        self.sent_start = marker_id(structure_maker.sent_start)
+        self.sent_end = marker_id(structure_maker.sent_end)
+        self.record_start = marker_id(structure_maker.record_start)
+        self.record_end = marker_id(structure_maker.record_end)
+        self.span_start = marker_id(structure_maker.span_start)
+        self.span_end = marker_id(structure_maker.span_end)
+        self.target_span_start = marker_id(structure_maker.target_span_start)
+        # Chunks between two adjacent markers, and between the markers of an empty instance
+        self.space_ids = tokenizer.encode(' ', add_special_tokens=False)
+        self.empty_ids = tokenizer.encode('  ', add_special_tokens=False)
+
+        convert_function = convert_to_record_function[decoding_format]
+        self.exact = all(
+            self.convert(self.attach(instance, tokenize_spot_asoc(instance, tokenizer))) == tokenizer.encode(
+                convert_function(instance, structure_maker=structure_maker))
+            for instance in self.probe_instances
+        )
+
+    def encode(self, text):
+        """ Ids of labels and spans without pre-tokenized ids (e.g., null span of noise), cached """
+        if text not in self._cache:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[text] = encode_chunk(text, self.tokenizer)
+        return self._cache[text]
+
+    @staticmethod
+    def attach(spot_asoc_instance, span_ids_list):
+        """ Attach span ids of `tokenize_spot_asoc` to a copy of the instance, kept with spots and asocs when
+        they are filtered or noised: spot['span_ids'], asoc (label, span, span_ids) """
+        span_ids_iter = iter(span_ids_list)
+        attached = list()
+        for spot in spot_asoc_instance:
+            attached_spot = dict(spot, span_ids=next(span_ids_iter))
+            attached_spot['asoc'] = [(asoc_label, asoc_span, next(span_ids_iter))
+                                     for asoc_label, asoc_span in spot.get('asoc', list())]
+            attached += [attached_spot]
+        return attached
+
+    def convert(self, spot_asoc_instance):
+        """ Target ids of `spot_asoc_instance`, with special tokens of the tokenizer (e.g., eos) """
+        ids = [self.sent_start]
+        for spot in spot_asoc_instance:
+            span_ids = spot.get('span_ids')
+            span_ids = self.encode(spot['span']) if span_ids is None else span_ids
+            label_ids = self.encode(spot['label'])
+            ids += self.space_ids + [self.record_start]
+            ids += label_ids if self.name_first else span_ids
+            ids += [self.target_span_start]
+            ids += span_ids if self.name_first else label_ids
+            for asoc in spot.get('asoc', list()):
+                asoc_span_ids = asoc[2] if len(asoc) > 2 else self.encode(asoc[1])
+                asoc_label_ids = self.encode(asoc[0])
+                ids += [self.span_start]
+                ids += asoc_label_ids if self.name_first else asoc_span_ids
+                ids += [self.target_span_start]
+                ids += asoc_span_ids if self.name_first else asoc_label_ids
+                ids += [self.span_end] + self.space_ids
+            ids += [self.record_end]
+        ids += self.space_ids if len(spot_asoc_instance) > 0 else self.empty_ids
+        ids += [self.sent_end]
+        return self.tokenizer.build_inputs_with_special_tokens(ids)
@@ -3,17 +3,62 @@
 import torch
 import torch.nn as nn
 from dataclasses import dataclass, field
-from typing import Union, List, Dict, Tuple, Any, Optional
+from typing import Union, List, Dict, Tuple, Any, Optional, Callable
 from torch.cuda.amp import autocast
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from transformers import (
     Seq2SeqTrainer,
     Seq2SeqTrainingArguments, )
+from transformers.modeling_outputs import BaseModelOutput
+from transformers.modeling_utils import unwrap_model
 from transformers.trainer_pt_utils import LabelSmoother
 
 from transformers.trainer import *
 
-from uie.seq2seq.constraint_decoder import get_constraint_decoder
+from uie.seq2seq.constraint_decoder import (
+    get_constraint_decoder,
+    ConstraintLogitsProcessor,
+    append_logits_processor
+)
+from uie.seq2seq.sampler import LengthSortedSampler, TokenBudgetBatchSampler
+from uie.seq2seq.data_collator.sequence_packing import get_packed_attention_masks
+
+
+class SetEpochCallback(TrainerCallback):
+    """
+    Call `set_epoch` of the training batch sampler (e.g., `TokenBudgetBatchSampler`) and of an iterable training dataset
+    (e.g., `HardInstanceIterableDataset`) at the beginning of every epoch, the Trainer only does it for
+    `DistributedSampler` and `IterableDatasetShard` in distributed training.
+    Epochs are counted from the epoch the Trainer starts (or resumes) from, as `state.epoch` is only updated by
+    optimizer steps and stays below the epoch number when gradient accumulation leaves steps at the end of an epoch.
+    """
+
+    def __init__(self):
+        self.epoch = 0
+
+    def on_train_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        # The first epoch of `Trainer.train`, also when resuming from a checkpoint
+        dataset = train_dataloader.dataset
+        if isinstance(dataset, IterableDatasetShard):
+            dataset = dataset.dataset
+        if isinstance(dataset, collections.abc.Sized):
+            num_update_steps_per_epoch = max(len(train_dataloader) // args.gradient_accumulation_steps, 1)
+        else:
+            num_update_steps_per_epoch = state.max_steps
+        self.epoch = state.global_step // num_update_steps_per_epoch
+
+    def on_epoch_begin(self, args, state, control, train_dataloader=None, **kwargs):
+        batch_sampler = getattr(train_dataloader, 'batch_sampler', None)
+        if hasattr(batch_sampler, 'set_epoch'):
+            batch_sampler.set_epoch(self.epoch)
+        dataset = getattr(train_dataloader, 'dataset', None)
+        if isinstance(dataset, IterableDataset) and not isinstance(dataset, IterableDatasetShard) \
+                and hasattr(dataset, 'set_epoch'):
+            dataset.set_epoch(self.epoch)
+        self.epoch += 1
 
 
 @dataclass
@@ -23,8 +68,56 @@ class ConstraintSeq2SeqTrainingArguments(Seq2SeqTrainingArguments):
         constraint_decoding (:obj:`bool`, `optional`, defaults to :obj:`False`):
             Whether to use Constraint Decoding
         structure_weight (:obj:`float`, `optional`, defaults to :obj:`None`):
+        batch_constraint_decoding (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to apply Constraint Decoding as one batched LogitsProcessor instead of `prefix_allowed_tokens_fn`
+        jump_forward_decoding (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to append the tokens forced by Constraint Decoding without predicting them (greedy search only)
+        prediction_loss_mode (:obj:`str`, `optional`, defaults to :obj:`reuse_encoder`):
+            How to compute the loss when predicting with generate: `reuse_encoder` feeds the encoder outputs of
+            generation to the teacher-forced forward, `forward` runs a full second forward, `skip` returns no loss,
+            `auto` skips the loss when `metric_for_best_model` is not a loss and reuses the encoder otherwise
+        sort_eval_by_length (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to batch evaluation and prediction examples by descending collated input length (SSI prefix
+            included), predictions are returned in dataset order
+        max_tokens_per_batch (:obj:`int`, `optional`, defaults to :obj:`0`):
+            Token budget of a training batch, `batch size * (max source length + max target length)` after
+            collating, replacing `per_device_train_batch_size` when greater than 0
+        stream_predictions (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to decode and write generated predictions batch by batch with `predict_stream`
+        pack_sequences (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to pack short training examples into rows with segment ids (T5 only), the collator packs and
+            the trainer masks attention across segments
     """
     constraint_decoding: bool = field(default=False, metadata={"help": "Whether to Constraint Decoding or not."})
+    batch_constraint_decoding: bool = field(
+        default=False,
+        metadata={"help": "Whether to build the Constraint Decoding mask for the whole batch in a LogitsProcessor."}
+    )
+    jump_forward_decoding: bool = field(
+        default=False,
+        metadata={"help": "Whether to jump over the tokens forced by Constraint Decoding in greedy search."}
+    )
+    prediction_loss_mode: str = field(
+        default='reuse_encoder',
+        metadata={"help": "Loss of predict_with_generate: reuse_encoder, forward, skip or auto.",
+                  "choices": ['reuse_encoder', 'forward', 'skip', 'auto']}
+    )
+    sort_eval_by_length: bool = field(
+        default=False,
+        metadata={"help": "Whether to sort evaluation and prediction examples by input length to reduce padding."}
+    )
+    max_tokens_per_batch: int = field(
+        default=0,
+        metadata={"help": "Token budget of padded source and target tokens in a training batch, 0 for fixed batch size."}
+    )
+    stream_predictions: bool = field(
+        default=False,
+        metadata={"help": "Whether to decode and write predictions batch by batch instead of gathering all of them."}
+    )
+    pack_sequences: bool = field(
+        default=False,
+        metadata={"help": "Whether to pack short training examples into one row with segment attention masks (T5)."}
+    )
     save_better_checkpoint: bool = field(default=False,
                                          metadata={"help": "Whether to save better metric checkpoint"})
     start_eval_step: int = field(default=0, metadata={"help": "Start Evaluation after Eval Step"})
@@ -52,9 +145,18 @@ class ConstraintSeq2SeqTrainer(Seq2SeqTrainer):
                                                              task_name=task)
         else:
             self.constraint_decoder = None
+        self.constraint_mask_cache = dict()
+
+        # Packed segments rely on the relative position bias of T5
+        if self.args.pack_sequences and self.model.config.model_type not in ['t5', 'mt5']:
+            raise ValueError(f"pack_sequences only supports T5, not {self.model.config.model_type}.")
+        # Non-padding and all tokens of packed batches since the last log
+        self.packed_tokens = [0, 0]
 
         self.oom_batch = 0
 
+        self.add_callback(SetEpochCallback)
+
     def training_step(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]]) -> torch.Tensor:
         """
         Perform a training step on a batch of inputs.
@@ -74,6 +176,11 @@ class ConstraintSeq2SeqTrainer(Seq2SeqTrainer):
             :obj:`torch.Tensor`: The tensor with training loss on this batch.
         """
 
+        if 'segment_ids' in inputs:
+            for key in ['segment_ids', 'decoder_segment_ids']:
+                self.packed_tokens[0] += (inputs[key] > 0).sum().item()
+                self.packed_tokens[1] += inputs[key].numel()
+
         oom = False
         oom_message = ""
         try:
@@ -114,6 +221,10 @@ class ConstraintSeq2SeqTrainer(Seq2SeqTrainer):
 
             logs["loss"] = round(tr_loss_scalar / (self.state.global_step - self._globalstep_last_logged), 4)
             logs["learning_rate"] = self._get_learning_rate()
+            if self.packed_tokens[1] > 0:
+                # Ratio of non-padding tokens in packed batches
+                logs["packed_token_rate"] = round(self.packed_tokens[0] / self.packed_tokens[1], 4)
+                self.packed_tokens = [0, 0]
 
             self._total_loss_scalar += tr_loss_scalar
             self._globalstep_last_logged = self.state.global_step
@@ -139,6 +250,275 @@ class ConstraintSeq2SeqTrainer(Seq2SeqTrainer):
             self._save_checkpoint(model, trial, metrics=metrics)
             self.control = self.callback_handler.on_save(self.args, self.state, self.control)
 
+    def compute_loss(self, model, inputs, return_outputs=False):
+        if 'segment_ids' in inputs:
+            inputs = self.get_packed_inputs(model, inputs)
+        return super().compute_loss(model, inputs, return_outputs=return_outputs)
+
+    @staticmethod
+    def run_encoder(model: nn.Module, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> BaseModelOutput:
+        """
+        Run the encoder of the (possibly wrapped) `model` alone.
+        With `nn.DataParallel`, the encoder is wrapped the same way, so that the batch is split over the same devices as
+        the full forward. Other wrappers (e.g., `DistributedDataParallel`) keep one batch per process.
+        """
+        encoder = unwrap_model(model).get_encoder()
+        # `nn.DataParallel` without devices runs the module directly
+        if isinstance(model, nn.DataParallel) and len(model.device_ids) > 0:
+            encoder = nn.DataParallel(encoder, device_ids=model.device_ids, output_device=model.output_device,
+                                      dim=model.dim)
+        return encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+
+    @classmethod
+    def get_packed_inputs(cls, model, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        Model inputs of a packed batch.
+        T5 passes one `attention_mask` to both the encoder and the decoder cross-attention, so the encoder runs first
+        with the block-diagonal mask, and `attention_mask` of the model is the decoder-encoder segment mask.
+        """
+        inputs = dict(inputs)
+        segment_ids = inputs.pop('segment_ids')
+        decoder_segment_ids = inputs.pop('decoder_segment_ids')
+        encoder_mask, decoder_mask, cross_mask = get_packed_attention_masks(segment_ids, decoder_segment_ids)
+        inputs['encoder_outputs'] = cls.run_encoder(model, inputs.pop('input_ids'), encoder_mask)
+        inputs['attention_mask'] = cross_mask
+        inputs['decoder_attention_mask'] = decoder_mask
+        return inputs
+
+    @staticmethod
+    def read_length_columns(dataset: Dataset, list_columns: Tuple[str, ...], value_columns: Tuple[str, ...] = ()
+                            ) -> Dict[str, Union[np.ndarray, List]]:
+        """
+        Lengths of the list columns `list_columns` and values of the columns `value_columns` of `dataset`, in dataset
+        order; missing columns are left out.
+        Lengths of a :obj:`datasets.Dataset` are read from the Arrow list offsets, rows are not converted to Python.
+        """
+        columns = dict()
+        if is_datasets_available() and isinstance(dataset, datasets.Dataset):
+            indices = dataset._indices.column(0).to_numpy() if dataset._indices is not None else None
+            for name in list_columns:
+                if name in dataset.column_names:
+                    lengths = pc.fill_null(pc.list_value_length(dataset.data.column(name)), 0).to_numpy()
+                    columns[name] = lengths if indices is None else lengths[indices]
+            for name in value_columns:
+                if name in dataset.column_names:
+                    column = dataset.data.column(name)
+                    columns[name] = (column if indices is None else column.take(pa.array(indices))).to_pylist()
+            return columns
+
+        features = list(dataset)
+        for name in list_columns:
+            if len(features) > 0 and name in features[0]:
+                columns[name] = np.array([len(feature[name]) for feature in features], dtype=np.int64)
+        for name in value_columns:
+            if len(features) > 0 and name in features[0]:
+                columns[name] = [feature[name] for feature in features]
+        return columns
+
+    def get_feature_lengths(self, dataset: Dataset) -> Tuple[List[int], List[int]]:
+        """
+        Source and target lengths of collated features.
+        Collators with `get_feature_lengths` (e.g., meta collators, which prepend the SSI and inject rejection noise)
+        estimate them from the columns they list, otherwise the lengths of `input_ids` and `labels` are used.
+        """
+        get_feature_lengths = getattr(self.data_collator, 'get_feature_lengths', None)
+        if get_feature_lengths is not None:
+            columns = self.read_length_columns(
+                dataset,
+                list_columns=self.data_collator.feature_length_columns,
+                value_columns=self.data_collator.feature_value_columns,
+            )
+            source_lengths, target_lengths = get_feature_lengths(columns)
+            return source_lengths.tolist(), target_lengths.tolist()
+
+        columns = self.read_length_columns(dataset, list_columns=('input_ids', 'labels'))
+        source_lengths = columns['input_ids']
+        target_lengths = columns.get('labels', np.zeros_like(source_lengths))
+        max_target_length = getattr(self.data_collator, 'max_target_length', None)
+        if max_target_length:
+            target_lengths = np.minimum(target_lengths, max_target_length)
+        return source_lengths.tolist(), target_lengths.tolist()
+
+    def get_data_collator(self, training: bool):
+        """
+        Data collator of training or evaluation DataLoaders.
+        Collators with `with_training` (e.g., meta collators) get an explicit mode instead of reading `model.training`,
+        which is not available in DataLoader workers.
+        """
+        with_training = getattr(self.data_collator, 'with_training', None)
+        return self.data_collator if with_training is None else with_training(training)
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.args.max_tokens_per_batch <= 0 or not isinstance(self.train_dataset, collections.abc.Sized) \
+                or isinstance(self.train_dataset, IterableDataset):
+            dataloader = super().get_train_dataloader()
+            dataloader.collate_fn = self.get_data_collator(training=True)
+            return dataloader
+
+        train_dataset = self.train_dataset
+        if is_datasets_available() and isinstance(train_dataset, datasets.Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+
+        source_lengths, target_lengths = self.get_feature_lengths(train_dataset)
+        batch_sampler = TokenBudgetBatchSampler(
+            source_lengths=source_lengths,
+            target_lengths=target_lengths,
+            max_tokens=self.args.max_tokens_per_batch,
+            seed=self.args.seed,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+        )
+
+        # Report the batch size in examples, for scaling the learning rate tuned with a fixed batch size
+        mean_batch_size = len(train_dataset) / len(batch_sampler.batches)
+        scale = mean_batch_size / self.args.per_device_train_batch_size
+        logger.info(f"Token budget batching: {self.args.max_tokens_per_batch} tokens, "
+                    f"{len(batch_sampler.batches)} batches, {mean_batch_size:.2f} examples per batch on average "
+                    f"(per_device_train_batch_size {self.args.per_device_train_batch_size})")
+        logger.info(f"Effective learning rate scaling: x{scale:.3f}, "
+                    f"linear-scaled learning rate {self.args.learning_rate * scale:.3e}, "
+                    f"sqrt-scaled learning rate {self.args.learning_rate * math.sqrt(scale):.3e}")
+
+        return DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.get_data_collator(training=True),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def get_eval_dataloader(self, eval_dataset: Optional[Dataset] = None) -> DataLoader:
+        dataloader = super().get_eval_dataloader(eval_dataset)
+        dataloader.collate_fn = self.get_data_collator(training=False)
+        return dataloader
+
+    def get_test_dataloader(self, test_dataset: Dataset) -> DataLoader:
+        dataloader = super().get_test_dataloader(test_dataset)
+        dataloader.collate_fn = self.get_data_collator(training=False)
+        return dataloader
+
+    def _get_eval_sampler(self, eval_dataset: Dataset) -> Optional[torch.utils.data.sampler.Sampler]:
+        if self.args.sort_eval_by_length and self.args.world_size <= 1 and not self.args.use_legacy_prediction_loop:
+            source_lengths, _ = self.get_feature_lengths(eval_dataset)
+            return LengthSortedSampler(source_lengths)
+        return super()._get_eval_sampler(eval_dataset)
+
+    def evaluation_loop(self, dataloader: DataLoader, *args, **kwargs) -> EvalLoopOutput:
+        output = super().evaluation_loop(dataloader, *args, **kwargs)
+        if isinstance(dataloader.sampler, LengthSortedSampler):
+            # Metrics are order-free, only restore the dataset order of predictions and labels
+            output = output._replace(
+                predictions=dataloader.sampler.restore_order(output.predictions),
+                label_ids=dataloader.sampler.restore_order(output.label_ids),
+            )
+        return output
+
+    def predict_stream(
+        self,
+        test_dataset: Dataset,
+        output_file: str,
+        postprocess_text: Optional[Callable[[str], str]] = None,
+        metric=None,
+        metric_key_prefix: str = "test",
+        max_length: Optional[int] = None,
+        num_beams: Optional[int] = None,
+    ) -> Dict[str, float]:
+        """
+        Generate, decode and post-process predictions batch by batch, and append them to `output_file` in dataset order
+        (the same content as joining all predictions with newlines), so memory does not grow with the dataset.
+
+        Args:
+            test_dataset (:obj:`Dataset`):
+            output_file (:obj:`str`):
+            postprocess_text (:obj:`Callable[[str], str]`, `optional`):
+                Clean the decoded prediction and label, e.g., remove `bos` `eos` `pad`
+            metric (`optional`):
+                Accumulator with `update(gold_list, pred_list)` and `compute()`,
+                e.g., :obj:`uie.extraction.extraction_metrics.ExtractionMetric`
+            metric_key_prefix (:obj:`str`, `optional`, defaults to :obj:`"test"`):
+            max_length (:obj:`int`, `optional`):
+            num_beams (:obj:`int`, `optional`):
+
+        Returns:
+            :obj:`Dict[str, float]`: metrics with `gen_len` and loss, as `predict(...).metrics` without memory metrics
+            (the memory tracker of transformers 4.6 only accepts calls from `train`, `evaluate` and `predict`)
+        """
+        self._max_length = max_length
+        self._num_beams = num_beams
+        postprocess_text = postprocess_text or (lambda x: x)
+
+        # Sharded predictions of multiple processes are only in order after gathering
+        if self.args.world_size > 1:
+            output = self.predict(test_dataset, metric_key_prefix=metric_key_prefix,
+                                  max_length=max_length, num_beams=num_beams)
+            if self.is_world_process_zero():
+                preds = self.tokenizer.batch_decode(
+                    output.predictions, skip_special_tokens=False, clean_up_tokenization_spaces=False
+                )
+                with open(output_file, "w") as writer:
+                    writer.write("\n".join([postprocess_text(pred) for pred in preds]))
+            return output.metrics
+
+        if is_datasets_available() and isinstance(test_dataset, datasets.Dataset):
+            test_dataset = self._remove_unused_columns(test_dataset, description="test")
+        dataloader = DataLoader(
+            test_dataset,
+            sampler=SequentialSampler(test_dataset),
+            batch_size=self.args.eval_batch_size,
+            collate_fn=self.get_data_collator(training=False),
+            drop_last=self.args.dataloader_drop_last,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+        logger.info("***** Running Streaming Prediction *****")
+        logger.info(f"  Num examples = {self.num_examples(dataloader)}")
+        logger.info(f"  Batch size = {dataloader.batch_size}")
+
+        model = self._wrap_model(self.model, training=False)
+        model.eval()
+        self.callback_handler.eval_dataloader = dataloader
+        start_time = time.time()
+
+        pad_token_id = self.tokenizer.pad_token_id
+        num_samples, loss_sum, loss_num, gen_len_sum = 0, 0., 0, 0
+        with open(output_file, "w") as writer:
+            for inputs in dataloader:
+                loss, generated_tokens, labels = self.prediction_step(model, inputs, prediction_loss_only=False)
+                batch_size = generated_tokens.size(0)
+                if loss is not None:
+                    loss_sum += loss.item() * batch_size
+                    loss_num += batch_size
+
+                generated_tokens = generated_tokens.cpu()
+                preds = self.tokenizer.batch_decode(
+                    generated_tokens, skip_special_tokens=False, clean_up_tokenization_spaces=False
+                )
+                preds = [postprocess_text(pred) for pred in preds]
+                gen_len_sum += (generated_tokens != pad_token_id).sum().item()
+
+                if metric is not None and labels is not None:
+                    # Replace -100 in the labels as we can't decode them.
+                    labels = labels.cpu().masked_fill(labels.cpu() == -100, pad_token_id)
+                    golds = self.tokenizer.batch_decode(
+                        labels, skip_special_tokens=False, clean_up_tokenization_spaces=False
+                    )
+                    metric.update(gold_list=[postprocess_text(gold) for gold in golds], pred_list=preds)
+
+                writer.write(("\n" if num_samples > 0 else "") + "\n".join(preds))
+                num_samples += batch_size
+                self.control = self.callback_handler.on_prediction_step(self.args, self.state, self.control)
+
+        metrics = metric.compute() if metric is not None else dict()
+        if num_samples > 0:
+            metrics["gen_len"] = gen_len_sum / num_samples
+        metrics = {f"{metric_key_prefix}_{key}": value for key, value in metrics.items()}
+        if loss_num > 0:
+            metrics[f"{metric_key_prefix}_loss"] = loss_sum / loss_num
+        metrics.update(speed_metrics(metric_key_prefix, start_time, num_samples))
+
+        return metrics
+
     def prediction_step(
             self,
             model: nn.Module,
@@ -183,35 +563,91 @@ class ConstraintSeq2SeqTrainer(Seq2SeqTrainer):
         has_labels = "labels" in inputs
         inputs = self._prepare_inputs(inputs)
 
+        batch_constraint_decoding = self.constraint_decoder is not None and self.args.batch_constraint_decoding
         gen_kwargs = {
             "max_length": self._max_length if self._max_length is not None else self.model.config.max_length,
             "num_beams": self._num_beams if self._num_beams is not None else self.model.config.num_beams,
-            "prefix_allowed_tokens_fn": prefix_allowed_tokens_fn if self.constraint_decoder else None,
+            "prefix_allowed_tokens_fn": prefix_allowed_tokens_fn if self.constraint_decoder and not batch_constraint_decoding else None,
         }
 
-        generated_tokens = self.model.generate(
-            inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
-            **gen_kwargs,
-        )
+        jump_forward_decoding = self.constraint_decoder is not None and self.args.jump_forward_decoding
+        if jump_forward_decoding and gen_kwargs["num_beams"] > 1:
+            logger.warning(f"Jump forward decoding only supports greedy search, use beam search with {gen_kwargs['num_beams']} beams.")
+            jump_forward_decoding = False
+
+        prediction_loss_mode = self.args.prediction_loss_mode
+        if prediction_loss_mode == 'auto':
+            metric_for_best_model = self.args.metric_for_best_model
+            prediction_loss_mode = 'skip' if metric_for_best_model is not None and not metric_for_best_model.endswith('loss') else 'reuse_encoder'
+        if not has_labels:
+            prediction_loss_mode = 'skip'
+
+        if prediction_loss_mode == 'reuse_encoder':
+            # Run the encoder once for both generation and the teacher-forced loss,
+            # on the same wrapped model and precision as the `forward` loss
+            with torch.no_grad():
+                if self.use_amp:
+                    with autocast():
+                        encoder_outputs = self.run_encoder(model, inputs["input_ids"], inputs["attention_mask"])
+                else:
+                    encoder_outputs = self.run_encoder(model, inputs["input_ids"], inputs["attention_mask"])
+            # Beam search expands `last_hidden_state` of the given outputs in place, pass a shallow copy
+            gen_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=encoder_outputs.last_hidden_state)
+        else:
+            encoder_outputs = None
+
+        if jump_forward_decoding:
+            generated_tokens = self.jump_forward_generate(
+                inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_length=gen_kwargs["max_length"],
+                encoder_outputs=encoder_outputs,
+            )
+        elif batch_constraint_decoding:
+            logits_processor = ConstraintLogitsProcessor(
+                constraint_decoder=self.constraint_decoder,
+                src_sentences=inputs["input_ids"],
+                num_beams=gen_kwargs["num_beams"],
+                mask_cache=self.constraint_mask_cache,
+            )
+            with append_logits_processor(self.model, logits_processor):
+                generated_tokens = self.model.generate(
+                    inputs["input_ids"],
+                    attention_mask=inputs["attention_mask"],
+                    **gen_kwargs,
+                )
+        else:
+            generated_tokens = self.model.generate(
+                inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                **gen_kwargs,
+            )
 
         # in case the batch is shorter than max length, the output should be padded
         if generated_tokens.shape[-1] < gen_kwargs["max_length"]:
             generated_tokens = self._pad_tensors_to_max_len(generated_tokens, gen_kwargs["max_length"])
 
-        with torch.no_grad():
-            if self.use_amp:
-                with autocast():
-                    outputs = model(**inputs)
+        if prediction_loss_mode == 'skip':
+            loss = None
+        else:
+            if prediction_loss_mode == 'reuse_encoder':
+                loss_inputs = {key: value for key, value in inputs.items() if key != 'input_ids'}
+                loss_inputs["encoder_outputs"] = encoder_outputs
             else:
-                outputs = model(**inputs)
-            if has_labels:
-                if self.label_smoother is not None:
-                    loss = self.label_smoother(outputs, inputs["labels"]).mean().detach()
+                loss_inputs = inputs
+            with torch.no_grad():
+                if self.use_amp:
+                    with autocast():
+                        outputs = model(**loss_inputs)
                 else:
-                    loss = (outputs["loss"] if isinstance(outputs, dict) else outputs[0]).mean().detach()
-            else:
-                loss = None
+                    outputs = model(**loss_inputs)
+                if has_labels:
+                    if self.label_smoother is not None:
+                        loss = self.label_smoother(outputs, inputs["labels"]).mean().detach()
+                    else:
+                        loss = (outputs["loss"] if isinstance(outputs, dict) else outputs[0]).mean().detach()
+                else:
+                    loss = None
 
         if self.args.prediction_loss_only:
             return loss, None, None
@@ -222,6 +658,113 @@ class ConstraintSeq2SeqTrainer(Seq2SeqTrainer):
 
         return loss, generated_tokens, labels
 
+    @torch.no_grad()
+    def jump_forward_generate(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, max_length: int,
+                              encoder_outputs: BaseModelOutput = None) -> torch.Tensor:
+        """
+        Greedy constraint decoding that jumps over forced tokens.
+
+        When the constraint decoder allows exactly one token (`start` -> `type_start`, `end_generate` -> eos,
+        the end of a unique label path, `null_span` -> `type_end`, ...), the token is appended without
+        predicting it. Appended tokens are fed to the decoder cache together in one multi-token step;
+        all rows feed the same number of tokens, the shortest run of known tokens among unfinished rows.
+
+        Return:
+            :obj:`torch.Tensor`: generated tokens starting with `decoder_start_token_id`, padded with `pad_token_id`
+        """
+        model = self.model
+        decoder_start_token_id = model.config.decoder_start_token_id
+        pad_token_id = model.config.pad_token_id
+        eos_token_id = model.config.eos_token_id
+
+        if encoder_outputs is None:
+            encoder_outputs = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+        logits_processor = ConstraintLogitsProcessor(
+            constraint_decoder=self.constraint_decoder,
+            src_sentences=input_ids,
+            num_beams=1,
+            mask_cache=self.constraint_mask_cache,
+        )
+        src_indexes = logits_processor.src_indexes
+
+        def append_forced_tokens(batch_id):
+            sequence = sequences[batch_id]
+            while len(sequence) < max_length:
+                # Only the tokens appended since the last update are scanned
+                marker_states[batch_id] = self.constraint_decoder.advance_state(marker_states[batch_id], sequence)
+                valid_sets[batch_id] = self.constraint_decoder.get_valid_set(
+                    src_indexes[batch_id], sequence, marker_state=marker_states[batch_id]
+                )
+                forced_token = self.constraint_decoder.get_forced_token(valid_sets[batch_id])
+                if forced_token is None:
+                    return
+                sequence += [forced_token]
+                if forced_token == eos_token_id:
+                    break
+            finished[batch_id] = True
+
+        batch_size = input_ids.size(0)
+        sequences = [[decoder_start_token_id] for _ in range(batch_size)]
+        finished = [False] * batch_size
+        marker_states = [None] * batch_size
+        valid_sets = [None] * batch_size
+        for batch_id in range(batch_size):
+            append_forced_tokens(batch_id)
+
+        past_key_values = None
+        fed_length = 0
+        while not all(finished):
+            step_length = min(len(sequences[batch_id]) - fed_length for batch_id in range(batch_size) if not finished[batch_id])
+            decoder_input_ids = list()
+            for batch_id, sequence in enumerate(sequences):
+                if len(sequence) < fed_length + step_length:
+                    # Finished sequences are padded as in greedy search
+                    sequence += [pad_token_id] * (fed_length + step_length - len(sequence))
+                decoder_input_ids += [sequence[fed_length:fed_length + step_length]]
+
+            # `model.forward` keeps only the last decoder token when `past_key_values` is given, call the decoder stack
+            decoder_outputs = model.get_decoder()(
+                input_ids=torch.tensor(decoder_input_ids, dtype=torch.long, device=input_ids.device),
+                encoder_hidden_states=encoder_outputs.last_hidden_state,
+                encoder_attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+            past_key_values = decoder_outputs.past_key_values
+            fed_length += step_length
+
+            predict_rows = [batch_id for batch_id in range(batch_size)
+                            if not finished[batch_id] and len(sequences[batch_id]) == fed_length]
+            if len(predict_rows) == 0:
+                continue
+
+            sequence_output = decoder_outputs.last_hidden_state[predict_rows, -1, :]
+            if model.config.tie_word_embeddings:
+                # Rescale output before projecting on vocab as T5ForConditionalGeneration
+                sequence_output = sequence_output * (model.model_dim ** -0.5)
+            next_token_logits = model.lm_head(sequence_output)
+
+            # Valid sets of the predicted rows are left by `append_forced_tokens`
+            masks = logits_processor.get_masks(
+                [valid_sets[batch_id] for batch_id in predict_rows],
+                next_token_logits.size(-1),
+                input_ids.device,
+            )
+            next_token_scores = next_token_logits.masked_fill(~masks, -float("inf"))
+            next_tokens = torch.argmax(next_token_scores, dim=-1).tolist()
+
+            for batch_id, next_token in zip(predict_rows, next_tokens):
+                sequences[batch_id] += [next_token]
+                if next_token == eos_token_id or len(sequences[batch_id]) >= max_length:
+                    finished[batch_id] = True
+                else:
+                    append_forced_tokens(batch_id)
+
+        generated_length = max(len(sequence) for sequence in sequences)
+        sequences = [sequence + [pad_token_id] * (generated_length - len(sequence)) for sequence in sequences]
+        return torch.tensor(sequences, dtype=torch.long, device=input_ids.device)
+
 
 def main(): pass
 
@@ -4,6 +4,10 @@ from uie.seq2seq.constraint_decoder.spotasoc_constraint_decoder import (
     SpotAsocConstraintDecoder,
     SpotConstraintDecoder
 )
+from uie.seq2seq.constraint_decoder.constraint_logits_processor import (
+    ConstraintLogitsProcessor,
+    append_logits_processor
+)
 
 
 def get_constraint_decoder(tokenizer, type_schema, decoding_schema, task_name='event', source_prefix=None):
@@ -2,7 +2,7 @@
 # -*- coding:utf-8 -*-
 from collections import defaultdict
 import os
-from typing import List
+from typing import List, Union
 
 
 def match_sublist(the_list, to_match):
@@ -71,16 +71,113 @@ def generated_search_src_sequence(generated, src_sequence, end_sequence_search_t
     return valid_token
 
 
+class SuffixAutomaton:
+    """
+    Suffix automaton of a source token sequence, built once per sequence.
+    Every substring of the source is a path from the root, and the transitions of the
+    reached state are exactly the tokens that follow some occurrence of that substring.
+    """
+
+    def __init__(self, sequence):
+        self.sequence = list(sequence)
+        self.transitions = [dict()]
+        self.link = [-1]
+        self.length = [0]
+        last = 0
+        for token in sequence:
+            last = self._extend(last, token)
+
+    def _extend(self, last, token):
+        current = self._new_state(self.length[last] + 1)
+        state = last
+        while state != -1 and token not in self.transitions[state]:
+            self.transitions[state][token] = current
+            state = self.link[state]
+        if state == -1:
+            self.link[current] = 0
+            return current
+
+        next_state = self.transitions[state][token]
+        if self.length[state] + 1 == self.length[next_state]:
+            self.link[current] = next_state
+            return current
+
+        clone = self._new_state(self.length[state] + 1)
+        self.transitions[clone] = dict(self.transitions[next_state])
+        self.link[clone] = self.link[next_state]
+        while state != -1 and self.transitions[state].get(token) == next_state:
+            self.transitions[state][token] = clone
+            state = self.link[state]
+        self.link[next_state] = self.link[current] = clone
+        return current
+
+    def _new_state(self, length):
+        self.transitions += [dict()]
+        self.link += [-1]
+        self.length += [length]
+        return len(self.length) - 1
+
+    def walk(self, generated):
+        """ State reached by `generated`, None if `generated` is not a sub-sequence of the source """
+        state = 0
+        for token in generated:
+            state = self.transitions[state].get(token)
+            if state is None:
+                return None
+        return state
+
+    def next_tokens(self, state):
+        return list(self.transitions[state])
+
+
+def generated_search_src_index(generated, src_index: SuffixAutomaton, end_sequence_search_tokens=None):
+    """ Same valid token set as `generated_search_src_sequence`, looked up in a prebuilt source index """
+    if len(generated) == 0:
+        # All src tokens are valid before generation
+        return src_index.next_tokens(0)
+
+    state = src_index.walk(generated)
+    valid_token = src_index.next_tokens(state) if state is not None else list()
+
+    if end_sequence_search_tokens:
+        valid_token += end_sequence_search_tokens
+
+    return valid_token
+
+
 class ConstraintDecoder:
     def __init__(self, tokenizer, source_prefix):
         self.tokenizer = tokenizer
         self.source_prefix = source_prefix
         self.source_prefix_tokenized = tokenizer.encode(source_prefix,
                                                         add_special_tokens=False) if source_prefix else []
+        # Valid token sets of structural states, shared by all sentences
+        self.valid_token_sets = list()
+
+    def add_valid_token_set(self, valid_tokens: List[int]) -> int:
+        self.valid_token_sets += [tuple(valid_tokens)]
+        return len(self.valid_token_sets) - 1
+
+    def get_valid_tokens(self, valid_set: Union[int, List[int]]) -> List[int]:
+        """ Valid token list of the result of `get_valid_set` """
+        return list(self.valid_token_sets[valid_set]) if isinstance(valid_set, int) else valid_set
 
-    def get_state_valid_tokens(self, src_sentence: List[str], tgt_generated: List[str]) -> List[str]:
+    def get_source_index(self, src_sentence: List[int]):
+        """ Source sentence prepared for `get_valid_set`, once per sentence """
+        return src_sentence
+
+    def get_valid_set(self, src_index, tgt_generated: List[int], marker_state=None) -> Union[int, List[int]]:
+        """ Index of a set in `valid_token_sets` for structural states, the valid token list otherwise """
         pass
 
+    def get_state_valid_tokens(self, src_sentence: List[str], tgt_generated: List[str], marker_state=None) -> List[str]:
+        valid_set = self.get_valid_set(self.get_source_index(src_sentence), tgt_generated, marker_state=marker_state)
+        return self.get_valid_tokens(valid_set)
+
+    def advance_state(self, state, tgt_generated: List[int]):
+        """ Decoding state of `tgt_generated` advanced from the state of one of its prefixes, None if not tracked """
+        return None
+
     def constraint_decoding(self, src_sentence, tgt_generated):
         if self.source_prefix_tokenized:
             # Remove Source Prefix for Generation
@@ -89,3 +186,14 @@ class ConstraintDecoder:
         valid_token_ids = self.get_state_valid_tokens(src_sentence.tolist(), tgt_generated.tolist())
 
         return valid_token_ids
+
+    def get_forced_token(self, valid_set: Union[int, List[int]]):
+        """
+        :param valid_set: result of `get_valid_set`
+        :return:
+            the only valid next token, None if the state allows several tokens
+        """
+        valid_token_ids = set(self.get_valid_tokens(valid_set))
+        if len(valid_token_ids) == 1:
+            return valid_token_ids.pop()
+        return None
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Union
+
+import torch
+from transformers import LogitsProcessor
+
+from uie.seq2seq.constraint_decoder.constraint_decoder import ConstraintDecoder
+
+
+class ConstraintLogitsProcessor(LogitsProcessor):
+    """
+    Batched replacement of `prefix_allowed_tokens_fn` for constraint decoding.
+
+    Source sentences are indexed once per batch and the generated ids are converted to lists once per step.
+    Structural states of the constraint decoder (labels, markers, end of generation) map to a fixed list of valid
+    token sets, whose boolean vocabulary masks are built once as a table; the masks of all rows are gathered from
+    the table by one index op, and only rows copying a source span scatter their own valid tokens.
+
+    Decoding states of the rows are kept between steps and carried through beam reordering (see `reorder`),
+    so the state of a row is advanced from the state of its parent row by the newest token only.
+    """
+
+    def __init__(self, constraint_decoder: ConstraintDecoder, src_sentences: torch.Tensor, num_beams: int,
+                 mask_cache: Dict[Tuple[int, str], torch.Tensor] = None):
+        """
+        :param constraint_decoder:
+        :param src_sentences: encoder input ids of the batch
+        :param num_beams:
+        :param mask_cache: shared between batches to keep the mask table of `constraint_decoder`,
+            one table for every vocabulary size and device
+        """
+        self.constraint_decoder = constraint_decoder
+        self.num_beams = num_beams
+        self._mask_cache = mask_cache if mask_cache is not None else dict()
+
+        prefix_length = len(constraint_decoder.source_prefix_tokenized)
+        self.src_indexes = [constraint_decoder.get_source_index(src_sentence[prefix_length:])
+                            for src_sentence in src_sentences.tolist()]
+
+        # Decoding states of the rows in the last call, and the parent row of every row after reordering
+        self._marker_states = None
+        self._beam_idx = None
+
+    def get_mask_table(self, vocab_size: int, device) -> torch.Tensor:
+        """ Boolean vocabulary masks of `constraint_decoder.valid_token_sets`, one row for every set """
+        key = (vocab_size, str(device))
+        if key not in self._mask_cache:
+            valid_token_sets = self.constraint_decoder.valid_token_sets
+            set_index = [index for index, valid_tokens in enumerate(valid_token_sets) for _ in valid_tokens]
+            token_index = [token for valid_tokens in valid_token_sets for token in valid_tokens]
+            mask_table = torch.zeros(len(valid_token_sets), vocab_size, dtype=torch.bool, device=device)
+            mask_table[set_index, token_index] = True
+            self._mask_cache[key] = mask_table
+        return self._mask_cache[key]
+
+    def get_masks(self, valid_sets: List[Union[int, List[int]]], vocab_size: int, device) -> torch.Tensor:
+        """ Vocabulary masks of rows from the results of `constraint_decoder.get_valid_set` """
+        span_rows = [row for row, valid_set in enumerate(valid_sets) if not isinstance(valid_set, int)]
+        set_index = [valid_set if isinstance(valid_set, int) else 0 for valid_set in valid_sets]
+        masks = self.get_mask_table(vocab_size, device)[torch.tensor(set_index, device=device)]
+        if len(span_rows) > 0:
+            # Span copying tokens depend on the source sentence, at most the sentence length and not cached
+            row_index = [row for row in span_rows for _ in valid_sets[row]]
+            token_index = [token for row in span_rows for token in valid_sets[row]]
+            masks[span_rows] = False
+            masks[row_index, token_index] = True
+        return masks
+
+    def reorder(self, beam_idx: torch.LongTensor):
+        """ Called when beam search reorders rows, `beam_idx[row]` is the parent row of the new `row` """
+        self._beam_idx = beam_idx.tolist()
+
+    def get_parent_states(self, input_ids: torch.LongTensor) -> List:
+        """ States of the parent rows in the last call, None for rows whose parent is unknown """
+        row_number, length = input_ids.size()
+        parent_states = [None] * row_number
+        if self._marker_states is None or len(self._marker_states) != row_number \
+                or self._marker_states[0] is None or self._marker_states[0][0] + 1 != length:
+            return parent_states
+
+        if self.num_beams == 1:
+            # Greedy search and sampling keep the order of rows
+            parent_rows = range(row_number)
+        elif self._beam_idx is not None and len(self._beam_idx) == row_number:
+            parent_rows = self._beam_idx
+        else:
+            # E.g., generating without `past` does not reorder the cache
+            return parent_states
+        return [self._marker_states[row] for row in parent_rows]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        vocab_size = scores.size(-1)
+        parent_states = self.get_parent_states(input_ids)
+        marker_states, valid_sets = list(), list()
+        for row, tgt_generated in enumerate(input_ids.tolist()):
+            marker_state = self.constraint_decoder.advance_state(parent_states[row], tgt_generated)
+            valid_sets += [self.constraint_decoder.get_valid_set(
+                self.src_indexes[row // self.num_beams],
+                tgt_generated,
+                marker_state=marker_state,
+            )]
+            marker_states += [marker_state]
+        self._marker_states, self._beam_idx = marker_states, None
+        masks = self.get_masks(valid_sets, vocab_size, scores.device)
+        return scores.masked_fill(~masks, -float("inf"))
+
+
+@contextmanager
+def append_logits_processor(model, logits_processor: LogitsProcessor):
+    """
+    `generate` of transformers 4.6 does not accept extra logits processors,
+    append `logits_processor` to the list built by `model._get_logits_processor` during the context.
+    Beam indices passed to `model._reorder_cache` are also passed to `logits_processor.reorder` if it has one.
+    """
+    get_logits_processor = model._get_logits_processor
+    reorder_cache = model._reorder_cache
+    reorder = getattr(logits_processor, 'reorder', None)
+
+    def _get_logits_processor(*args, **kwargs):
+        processors = get_logits_processor(*args, **kwargs)
+        processors.append(logits_processor)
+        return processors
+
+    def _reorder_cache(past, beam_idx):
+        reorder(beam_idx)
+        return reorder_cache(past, beam_idx)
+
+    model._get_logits_processor = _get_logits_processor
+    if reorder is not None:
+        model._reorder_cache = _reorder_cache
+    try:
+        yield model
+    finally:
+        del model._get_logits_processor
+        if reorder is not None:
+            del model._reorder_cache
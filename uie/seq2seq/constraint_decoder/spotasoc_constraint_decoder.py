@@ -2,7 +2,7 @@
 # -*- coding:utf-8 -*-
 import os
 from typing import List, Dict
-from uie.extraction.label_tree import get_label_name_tree
+from uie.extraction.label_tree import CompiledLabelTrie
 from uie.extraction.constants import (
     span_start,
     type_start,
@@ -12,7 +12,8 @@ from uie.extraction.constants import (
 )
 from uie.seq2seq.constraint_decoder.constraint_decoder import (
     ConstraintDecoder,
-    find_bracket_position,
+    SuffixAutomaton,
+    generated_search_src_index,
     generated_search_src_sequence
 )
 
@@ -24,31 +25,85 @@ class SpotAsocConstraintDecoder(ConstraintDecoder):
     def __init__(self, tokenizer, type_schema, *args, **kwargs):
         super().__init__(tokenizer, *args, **kwargs)
         self.tree_end = self.tokenizer.convert_tokens_to_ids([span_start])[0]
-        self.type_tree = get_label_name_tree(type_schema.type_list, self.tokenizer, end_symbol=self.tree_end)
-        self.role_tree = get_label_name_tree(type_schema.role_list, self.tokenizer, end_symbol=self.tree_end)
         self.type_start = self.tokenizer.convert_tokens_to_ids([type_start])[0]
         self.type_end = self.tokenizer.convert_tokens_to_ids([type_end])[0]
         self.span_start = self.tokenizer.convert_tokens_to_ids([span_start])[0]
         self.null_span = self.tokenizer.convert_tokens_to_ids([null_span])[0]
         self.text_start = self.tokenizer.convert_tokens_to_ids([text_start])[0]
+        self.type_trie = CompiledLabelTrie(type_schema.type_list, self.tokenizer, end_search_tokens=[self.span_start])
+        self.role_trie = CompiledLabelTrie(type_schema.role_list, self.tokenizer, end_search_tokens=[self.span_start])
+        self.special_token_set = {self.type_start, self.type_end, self.span_start}
+        self.source_index_cache_size = 1024
+        self._source_index_cache = dict()
+
+        # Valid token sets of structural states, the trie sets are indexed by trie node
+        self.eos_set = self.add_valid_token_set([self.tokenizer.eos_token_id])
+        self.type_start_set = self.add_valid_token_set([self.type_start])
+        self.type_start_end_set = self.add_valid_token_set([self.type_start, self.type_end])
+        self.type_end_set = self.add_valid_token_set([self.type_end])
+        self.type_trie_sets = [self.add_valid_token_set(tokens) for tokens in self.type_trie.valid_tokens]
+        self.role_trie_sets = [self.add_valid_token_set(tokens) for tokens in self.role_trie.valid_tokens]
+
+    def get_source_index(self, src_sentence):
+        """ Suffix automaton of the text of `src_sentence` + `[null_span]`, built once per source sentence
+
+        :param src_sentence: source token ids without source prefix, the text starts after `text_start`
+        :return:
+            SuffixAutomaton
+        """
+        if self.tokenizer.eos_token_id in src_sentence:
+            src_sentence = src_sentence[:src_sentence.index(self.tokenizer.eos_token_id)]
+
+        if self.text_start in src_sentence:
+            src_sentence = src_sentence[src_sentence.index(self.text_start) + 1:]
 
-    def check_state(self, tgt_generated):
+        key = tuple(src_sentence)
+        if key not in self._source_index_cache:
+            if len(self._source_index_cache) >= self.source_index_cache_size:
+                self._source_index_cache.clear()
+            self._source_index_cache[key] = SuffixAutomaton(src_sentence + [self.null_span])
+        return self._source_index_cache[key]
+
+    def advance_state(self, state, tgt_generated):
+        """ Marker counts of `tgt_generated`, advanced from the counts of one of its prefixes
+
+        Only tokens after the prefix are scanned, i.e. only the newest token when `state` is the state of the parent beam.
+
+        :param state: (length, start_number, end_number, special_number, last_special_index, last_special_token)
+            of `tgt_generated[:length]`, None to scan from scratch
+        :param tgt_generated:
+        :return:
+            state of `tgt_generated`
+        """
+        if state is None:
+            state = (0, 0, 0, 0, -1, None)
+        length, start_number, end_number, special_number, last_special_index, last_special_token = state
+        for index in range(length, len(tgt_generated)):
+            token = tgt_generated[index]
+            if token not in self.special_token_set:
+                continue
+            if token == self.type_start:
+                start_number += 1
+            elif token == self.type_end:
+                end_number += 1
+            special_number += 1
+            last_special_index, last_special_token = index, token
+        return len(tgt_generated), start_number, end_number, special_number, last_special_index, last_special_token
+
+    def check_state(self, tgt_generated, marker_state=None):
         if tgt_generated[-1] == self.tokenizer.pad_token_id:
             return 'start', -1
 
-        # special_token_set = {EVENT_TYPE_LEFT, EVENT_TYPE_RIGHT}
-        special_token_set = {self.type_start, self.type_end, self.span_start}
-        special_index_token = list(filter(lambda x: x[1] in special_token_set, list(enumerate(tgt_generated))))
+        _, start_number, end_number, special_number, last_special_index, last_special_token = self.advance_state(
+            marker_state, tgt_generated)
 
-        last_special_index, last_special_token = special_index_token[-1]
+        if special_number == 0:
+            raise IndexError('No structure marker in %s' % tgt_generated)
 
-        if len(special_index_token) == 1:
+        if special_number == 1:
             if last_special_token != self.type_start:
                 return 'error', 0
 
-        bracket_position = find_bracket_position(tgt_generated, _type_start=self.type_start, _type_end=self.type_end)
-        start_number, end_number = len(bracket_position[self.type_start]), len(bracket_position[self.type_end])
-
         if start_number == end_number:
             return 'end_generate', -1
         if start_number == end_number + 1:
@@ -103,62 +158,55 @@ class SpotAsocConstraintDecoder(ConstraintDecoder):
         valid_token = list(tree.keys())
         return valid_token
 
-    def get_state_valid_tokens(self, src_sentence, tgt_generated):
+    def get_valid_set(self, src_index, tgt_generated, marker_state=None):
         """
 
-        :param src_sentence:
+        :param src_index: `get_source_index` of the source sentence
         :param tgt_generated:
+        :param marker_state: `advance_state` of a prefix of `tgt_generated`, e.g. of the parent beam, scanned from scratch if None
         :return:
-            List[str], valid token list
+            int, index of the valid token set in `valid_token_sets` for structural states
+            List[int], valid token list for span copying states
         """
-        if self.tokenizer.eos_token_id in src_sentence:
-            src_sentence = src_sentence[:src_sentence.index(self.tokenizer.eos_token_id)]
-
-        if self.text_start in src_sentence:
-            src_sentence = src_sentence[src_sentence.index(self.text_start) + 1:]
-
-        state, index = self.check_state(tgt_generated)
+        state, index = self.check_state(tgt_generated, marker_state=marker_state)
 
         print("State: %s" % state) if debug else None
 
         if state == 'error':
             print("Decode Error:")
-            print("Src:", self.tokenizer.convert_ids_to_tokens(src_sentence))
+            # Without the appended `null_span`
+            print("Src:", self.tokenizer.convert_ids_to_tokens(src_index.sequence[:-1]))
             print("Tgt:", self.tokenizer.convert_ids_to_tokens(tgt_generated))
-            valid_tokens = [self.tokenizer.eos_token_id]
+            valid_set = self.eos_set
 
         elif state == 'start':
-            valid_tokens = [self.type_start]
+            valid_set = self.type_start_set
 
         elif state == 'start_first_generation':
-            valid_tokens = [self.type_start, self.type_end]
+            valid_set = self.type_start_end_set
 
         elif state == 'generate_trigger':
 
             if tgt_generated[-1] == self.type_start:
                 # Start Event Label
-                return list(self.type_tree.keys())
+                return self.type_trie_sets[self.type_trie.root]
 
             elif tgt_generated[-1] == self.type_end:
                 # EVENT_TYPE_LEFT: Start a new role
                 # EVENT_TYPE_RIGHT: End this event
-                return [self.type_start, self.type_end]
+                return self.type_start_end_set
             else:
-                valid_tokens = self.search_prefix_tree(
-                    generated=tgt_generated[index + 1:],
-                    prefix_tree=self.type_tree,
-                    end_search_tokens=[self.span_start]
-                )
+                valid_set = self.type_trie_sets[self.type_trie.walk(tgt_generated[index + 1:])]
 
         elif state in {'generate_trigger_text'}:
             generated = tgt_generated[index + 1:]
 
             if len(generated) > 0 and generated[-1] == self.null_span:
-                return [self.type_end, self.type_start]
+                return self.type_start_end_set
 
-            valid_tokens = generated_search_src_sequence(
+            valid_set = generated_search_src_index(
                 generated=generated,
-                src_sequence=src_sentence + [self.null_span],
+                src_index=src_index,
                 end_sequence_search_tokens=[self.type_end, self.type_start],
             )
 
@@ -166,11 +214,11 @@ class SpotAsocConstraintDecoder(ConstraintDecoder):
             generated = tgt_generated[index + 1:]
 
             if len(generated) > 0 and generated[-1] == self.null_span:
-                return [self.type_end]
+                return self.type_end_set
 
-            valid_tokens = generated_search_src_sequence(
+            valid_set = generated_search_src_index(
                 generated=generated,
-                src_sequence=src_sentence + [self.null_span],
+                src_index=src_index,
                 end_sequence_search_tokens=[self.type_end],
             )
 
@@ -178,69 +226,38 @@ class SpotAsocConstraintDecoder(ConstraintDecoder):
 
             if tgt_generated[-1] == self.type_start:
                 # Start Role Label
-                return list(self.role_tree.keys())
+                return self.role_trie_sets[self.role_trie.root]
 
-            generated = tgt_generated[index + 1:]
-            valid_tokens = self.search_prefix_tree(
-                generated=generated,
-                prefix_tree=self.role_tree,
-                end_search_tokens=[self.span_start]
-            )
+            valid_set = self.role_trie_sets[self.role_trie.walk(tgt_generated[index + 1:])]
 
         elif state == 'end_generate':
-            valid_tokens = [self.tokenizer.eos_token_id]
+            valid_set = self.eos_set
 
         else:
             raise NotImplementedError('State `%s` for %s is not implemented.' % (state, self.__class__))
 
-        print("Valid: %s" % self.tokenizer.convert_ids_to_tokens(valid_tokens)) if debug else None
-        return valid_tokens
-
-    def search_prefix_tree(self, generated: List[str], prefix_tree: Dict,
-                           end_search_tokens: List[str] = None):
-        """
-        Generate Type Name + Text Span
-        :param generated:
-        :param prefix_tree:
-        :param src_sentence:
-        :param end_search_tokens:
-        :return:
-        """
-        tree = prefix_tree
-        for index, token in enumerate(generated):
-            tree = tree[token]
-            is_tree_end = len(tree) == 1 and self.tree_end in tree
-
-            if is_tree_end:
-                return end_search_tokens
-
-        valid_token = list(tree.keys())
-        if self.tree_end in valid_token:
-            valid_token.remove(self.tree_end)
-            valid_token += end_search_tokens
-        return valid_token
+        print("Valid: %s" % self.tokenizer.convert_ids_to_tokens(self.get_valid_tokens(valid_set))) if debug else None
+        return valid_set
 
 
 class SpotConstraintDecoder(SpotAsocConstraintDecoder):
     def __init__(self, tokenizer, *args, **kwargs):
         super().__init__(tokenizer, *args, **kwargs)
 
-    def check_state(self, tgt_generated):
+    def check_state(self, tgt_generated, marker_state=None):
         if tgt_generated[-1] == self.tokenizer.pad_token_id:
             return 'start', -1
 
-        special_token_set = {self.type_start, self.type_end, self.span_start}
-        special_index_token = list(filter(lambda x: x[1] in special_token_set, list(enumerate(tgt_generated))))
+        _, start_number, end_number, special_number, last_special_index, last_special_token = self.advance_state(
+            marker_state, tgt_generated)
 
-        last_special_index, last_special_token = special_index_token[-1]
+        if special_number == 0:
+            raise IndexError('No structure marker in %s' % tgt_generated)
 
-        if len(special_index_token) == 1:
+        if special_number == 1:
             if last_special_token != self.type_start:
                 return 'error', 0
 
-        bracket_position = find_bracket_position(tgt_generated, _type_start=self.type_start, _type_end=self.type_end)
-        start_number, end_number = len(bracket_position[self.type_start]), len(bracket_position[self.type_end])
-
         if start_number == end_number:
             return 'end_generate', -1
         if start_number == end_number + 1:
@@ -253,65 +270,58 @@ class SpotConstraintDecoder(SpotAsocConstraintDecoder):
             state = 'error'
         return state, last_special_index
 
-    def get_state_valid_tokens(self, src_sentence, tgt_generated):
+    def get_valid_set(self, src_index, tgt_generated, marker_state=None):
         """
 
-        :param src_sentence:
+        :param src_index: `get_source_index` of the source sentence
         :param tgt_generated:
+        :param marker_state: `advance_state` of a prefix of `tgt_generated`, e.g. of the parent beam, scanned from scratch if None
         :return:
-            List[str], valid token list
+            int, index of the valid token set in `valid_token_sets` for structural states
+            List[int], valid token list for span copying states
         """
-        if self.tokenizer.eos_token_id in src_sentence:
-            src_sentence = src_sentence[:src_sentence.index(self.tokenizer.eos_token_id)]
-
-        if self.text_start in src_sentence:
-            src_sentence = src_sentence[src_sentence.index(self.text_start) + 1:]
-
-        state, index = self.check_state(tgt_generated)
+        state, index = self.check_state(tgt_generated, marker_state=marker_state)
 
         print("State: %s" % state) if debug else None
 
         if state == 'error':
             print("Decode Error:")
-            print("Src:", self.tokenizer.convert_ids_to_tokens(src_sentence))
+            # Without the appended `null_span`
+            print("Src:", self.tokenizer.convert_ids_to_tokens(src_index.sequence[:-1]))
             print("Tgt:", self.tokenizer.convert_ids_to_tokens(tgt_generated))
-            valid_tokens = [self.tokenizer.eos_token_id]
+            valid_set = self.eos_set
 
         elif state == 'start':
-            valid_tokens = [self.type_start]
+            valid_set = self.type_start_set
 
         elif state == 'start_first_generation':
-            valid_tokens = [self.type_start, self.type_end]
+            valid_set = self.type_start_end_set
 
         elif state == 'generate_span':
 
             if tgt_generated[-1] == self.type_start:
                 # Start Event Label
-                return list(self.type_tree.keys())
+                return self.type_trie_sets[self.type_trie.root]
 
             elif tgt_generated[-1] == self.type_end:
                 raise RuntimeError('Invalid %s in %s' % (self.type_end, tgt_generated))
 
             else:
-                valid_tokens = self.search_prefix_tree(
-                    generated=tgt_generated[index + 1:],
-                    prefix_tree=self.type_tree,
-                    end_search_tokens=[self.span_start]
-                )
+                valid_set = self.type_trie_sets[self.type_trie.walk(tgt_generated[index + 1:])]
 
         elif state == 'generate_span_text':
             generated = tgt_generated[index + 1:]
-            valid_tokens = generated_search_src_sequence(
+            valid_set = generated_search_src_index(
                 generated=generated,
-                src_sequence=src_sentence + [self.null_span],
+                src_index=src_index,
                 end_sequence_search_tokens=[self.type_end],
             )
 
         elif state == 'end_generate':
-            valid_tokens = [self.tokenizer.eos_token_id]
+            valid_set = self.eos_set
 
         else:
             raise NotImplementedError('State `%s` for %s is not implemented.' % (state, self.__class__))
 
-        print("Valid: %s" % valid_tokens) if debug else None
-        return valid_tokens
+        print("Valid: %s" % self.get_valid_tokens(valid_set)) if debug else None
+        return valid_set
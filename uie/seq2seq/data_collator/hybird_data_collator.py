@@ -2,15 +2,28 @@
 # coding=utf-8
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, List
-import numpy as np
+from typing import Dict, List, Tuple
+import torch
+from transformers.file_utils import PaddingStrategy
+
+from uie.seq2seq.data_collator.sequence_packing import padded_length, scatter_sequences
 
 
 @dataclass
 class HybirdDataCollator:
+    """
+    Collate a batch mixing several tasks, every task (`feature['task']`) is collated by its data collator.
+
+    Rows of all buckets are written into one buffer per feature, allocated with the final shape.
+    Collators with `process_features` (e.g., meta collators) give unpadded rows, which are padded only once in the
+    buffer; other collators return padded tensors, which are copied into the buffer.
+    With `pin_memory`, buffers are allocated in pinned memory in the main process; batches of DataLoader workers are
+    moved through shared memory, and are pinned by `DataLoader(pin_memory=True)` instead.
+    """
     data_collator_dict: Dict
     label_pad_token_id: int = -100
     meta_bucket_name: List[str] = None
+    pin_memory: bool = False
 
     def data_group(self, features):
         bucket = defaultdict(list)
@@ -20,7 +33,44 @@ class HybirdDataCollator:
             bucket[task_name] += [feature]
         return bucket
 
-    def __call__(self, features) -> Dict[str, np.ndarray]:
+    @staticmethod
+    def support_process_features(data_collator):
+        """ Whether `data_collator` pads the features of `process_features` to the longest on the right
+        """
+        return (hasattr(data_collator, 'process_features')
+                and not getattr(data_collator, 'pack_sequences', False)
+                and data_collator.padding in [True, 'longest', PaddingStrategy.LONGEST]
+                and data_collator.tokenizer.padding_side == 'right')
+
+    @staticmethod
+    def get_unpadded_batch(data_collator, features) -> Dict[str, Tuple[List[List[int]], int]]:
+        """ Unpadded rows and the padded length of every feature of `data_collator(features)`
+        """
+        features = data_collator.process_features(features)
+        batch = dict()
+
+        input_ids = [feature['input_ids'] for feature in features]
+        input_length = padded_length(input_ids, data_collator.pad_to_multiple_of)
+        batch['input_ids'] = (input_ids, input_length)
+        batch['attention_mask'] = ([feature['attention_mask'] for feature in features], input_length)
+
+        if 'labels' in features[0]:
+            labels = [feature['labels'] for feature in features]
+            label_length = padded_length(labels)
+            batch['labels'] = (labels, label_length)
+            if data_collator.decoder_start_token_id is not None:
+                # Labels shifted right, the same as `shift_labels_right` of the padded labels
+                pad_token_id = data_collator.decoder_pad_token_id
+                decoder_input_ids = list()
+                for label in labels:
+                    row = [data_collator.decoder_start_token_id] + [
+                        pad_token_id if x == data_collator.label_pad_token_id else x for x in label[:label_length - 1]
+                    ]
+                    decoder_input_ids += [row + [pad_token_id] * (label_length - len(row))]
+                batch['decoder_input_ids'] = (decoder_input_ids, label_length)
+        return batch
+
+    def __call__(self, features) -> Dict[str, torch.Tensor]:
         """ Hybird Data Collator
 
         Args:
@@ -40,7 +90,7 @@ class HybirdDataCollator:
         }
 
         bucket = self.data_group(features)
-        features = dict()
+        sub_batches = list()
         for bucket_name, bucket_feature in bucket.items():
             # Pop unused feature;but meta-realted feature pop in DataCollatorForMetaSeq2Seq
             # Pop 无关的参数; Meta 任务不 Pop，在 DataCollatorForMetaSeq2Seq 中自动 Pop
@@ -48,23 +98,30 @@ class HybirdDataCollator:
                 for feature_name in list(bucket_feature[0].keys()):
                     if feature_name not in pad_dict:
                         [feature.pop(feature_name) for feature in bucket_feature]
-            features[bucket_name] = self.data_collator_dict[bucket_name](bucket_feature)
+            data_collator = self.data_collator_dict[bucket_name]
+            if self.support_process_features(data_collator):
+                sub_batches += [self.get_unpadded_batch(data_collator, bucket_feature)]
+            else:
+                sub_batches += [{feature_name: (value, value.size(1))
+                                 for feature_name, value in data_collator(bucket_feature).items()}]
+
+        batch_size = sum([len(sub_batch['input_ids'][0]) for sub_batch in sub_batches])
+        pin_memory = self.pin_memory and torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
 
         new_feature = dict()
         for feature_name, pad_value in pad_dict.items():
-            sub_features = [sub_feature[feature_name] for sub_feature in features.values()]
-            batch_size = sum([x.size(0) for x in sub_features])
-            max_length = max([x.size(1) for x in sub_features])
-
-            sub_feature = sub_features[0].new_full(
-                size=(batch_size, max_length),
-                fill_value=pad_value
-            )
-            start, end = 0, 0
-            for x in sub_features:
-                end = start + x.size(0)
-                sub_feature[start:end, :x.size(1)] = x
-                start = end
-            new_feature[feature_name] = sub_feature
+            sub_features = [sub_batch[feature_name] for sub_batch in sub_batches]
+            max_length = max([length for _, length in sub_features])
+            buffer = torch.full((batch_size, max_length), fill_value=pad_value, dtype=torch.long,
+                                pin_memory=pin_memory)
+
+            start = 0
+            for rows, _ in sub_features:
+                if isinstance(rows, torch.Tensor):
+                    buffer[start:start + rows.size(0), :rows.size(1)] = rows
+                else:
+                    scatter_sequences(buffer, rows, start=start)
+                start += len(rows)
+            new_feature[feature_name] = buffer
 
         return new_feature
@@ -1,21 +1,25 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 import os
-from dataclasses import dataclass
+import copy
+from dataclasses import dataclass, field
+import numpy as np
 import torch
 import logging
 import random
 import math
-from typing import Optional, Union
+from typing import ClassVar, Dict, Optional, Tuple, Union
 from collections import OrderedDict
-from transformers import PreTrainedTokenizerBase, PreTrainedModel
+from transformers import BatchEncoding, PreTrainedTokenizerBase, PreTrainedModel
 from transformers.file_utils import PaddingStrategy
+from torch.utils.data import get_worker_info
 
 from uie.extraction.record_schema import RecordSchema
 from uie.extraction.dataset_processer import spot_prompt, asoc_prompt
 from uie.extraction.constants import BaseStructureMarker, text_start, span_start
-from uie.extraction.utils import convert_to_record_function
+from uie.extraction.utils import convert_to_record_function, SpotAsocIdsConverter
 from uie.extraction.noiser.spot_asoc_noiser import SpotAsocNoiser
+from uie.seq2seq.data_collator.sequence_packing import pack_features, pad_sequences
 
 
 logger = logging.getLogger("__main__")
@@ -26,11 +30,20 @@ HT = '<extra_id_8>'  # event trigger hint
 HA = '<extra_id_9>'  # event argument hint
 
 
+def shift_labels_right(labels: torch.Tensor, pad_token_id: int, decoder_start_token_id: int) -> torch.Tensor:
+    """ `decoder_input_ids` of `labels`, the same as `_shift_right` of T5 without the model
+    """
+    decoder_input_ids = labels.new_zeros(labels.shape)
+    decoder_input_ids[..., 1:] = labels[..., :-1].clone()
+    decoder_input_ids[..., 0] = decoder_start_token_id
+    return decoder_input_ids.masked_fill(decoder_input_ids == -100, pad_token_id)
+
+
 class DynamicSSIGenerator():
     """
     Sample negative spot and asoc to construct SSI
     """
-    def __init__(self, tokenizer: PreTrainedTokenizerBase, schema: RecordSchema, model_name: str, positive_rate=1, negative=5, ordered_prompt=False) -> None:
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, schema: RecordSchema, model_name: str, positive_rate=1, negative=5, ordered_prompt=False, seed=None) -> None:
         self.spot_dict = self.get_ordered_dict(schema.type_list, tokenizer)
         self.asoc_dict = self.get_ordered_dict(schema.role_list, tokenizer)
         self.spot_list = list(self.spot_dict.keys())
@@ -44,8 +57,34 @@ class DynamicSSIGenerator():
         self.positive_rate = positive_rate if positive_rate > 0 and positive_rate < 1 else 1
         self.negative = negative
         self.ordered_prompt = ordered_prompt
+        # Ordered full SSI is fixed, build once for evaluation
+        self.ordered_full_spot = self.convert_prefix(self.spot_list, self.spot_prompt, self.spot_dict, ordered_prompt=True)
+        self.ordered_full_asoc = self.convert_prefix(self.asoc_list, self.asoc_prompt, self.asoc_dict, ordered_prompt=True)
+
+        # Id table of `prompt + name` of all spots/asocs, in the order of `spot_list`/`asoc_list`, for batch sampling
+        self.spot_index = {name: index for index, name in enumerate(self.spot_list)}
+        self.asoc_index = {name: index for index, name in enumerate(self.asoc_list)}
+        self.spot_table, self.spot_offsets = self.get_id_table(self.spot_list, self.spot_prompt, self.spot_dict)
+        self.asoc_table, self.asoc_offsets = self.get_id_table(self.asoc_list, self.asoc_prompt, self.asoc_dict)
+        # Rank of names, the order of ordered prompt
+        self.spot_rank = np.argsort(np.argsort(np.array(self.spot_list, dtype=object)))
+        self.asoc_rank = np.argsort(np.argsort(np.array(self.asoc_list, dtype=object)))
+        # Seeded by the global NumPy state (`set_seed`) by default, re-seeded in DataLoader workers
+        self.generator = np.random.default_rng(seed if seed is not None else np.random.randint(2 ** 31 - 1))
+        self.worker_seed = None
         logger.info(f"Meta Sample, Negative: {self.negative}, Ordered Prompt: {self.ordered_prompt}")
 
+    def get_generator(self):
+        """ NumPy generator of the current process
+        Copies of the sampler in DataLoader workers start from the same state, so every worker re-seeds its copy
+        by the worker seed (`base_seed + worker_id`, `base_seed` is drawn from the torch RNG for every epoch)
+        """
+        worker_info = get_worker_info()
+        if worker_info is not None and worker_info.seed != self.worker_seed:
+            self.worker_seed = worker_info.seed
+            self.generator = np.random.default_rng(worker_info.seed)
+        return self.generator
+
     @staticmethod
     def get_ordered_dict(schema_name_list, tokenizer):
         schema_ordered_dict = OrderedDict()
@@ -53,6 +92,136 @@ class DynamicSSIGenerator():
             schema_ordered_dict[name] = tokenizer.encode(name, add_special_tokens=False)
         return schema_ordered_dict
 
+    @staticmethod
+    def get_id_table(name_list, prompt, mapper):
+        id_list = [[prompt] + mapper[name] for name in name_list]
+        offsets = np.cumsum([0] + [len(ids) for ids in id_list])
+        table = np.array([token for ids in id_list for token in ids], dtype=np.int64)
+        return table, offsets
+
+    @staticmethod
+    def gather_prefix(table, offsets, index_list):
+        """ Concatenate the table segments of `index_list` by one gather
+        """
+        index_list = np.asarray(index_list, dtype=np.int64)
+        starts = offsets[index_list]
+        lengths = offsets[index_list + 1] - starts
+        positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return table[positions]
+
+    @staticmethod
+    def gather_batch_prefix(table, offsets, candidate, candidate_num):
+        """ Prefixes of a batch, concatenated by one gather and split by the candidate number of each instance
+        """
+        segment_length = (offsets[candidate + 1] - offsets[candidate]).tolist()
+        prefix = DynamicSSIGenerator.gather_prefix(table, offsets, candidate).tolist()
+        prefix_list, start, candidate_start = list(), 0, 0
+        for num in candidate_num:
+            length = sum(segment_length[candidate_start:candidate_start + num])
+            prefix_list += [prefix[start:start + length]]
+            start, candidate_start = start + length, candidate_start + num
+        return prefix_list
+
+    def get_key_width(self, batch_positive, name_num):
+        # Keys of negative permutation + positive subset + candidate shuffle
+        max_positive_num = max([len(positive) for positive in batch_positive], default=0)
+        negative_num = name_num if self.negative < 0 else min(self.negative, name_num)
+        return name_num + max_positive_num + max_positive_num + negative_num
+
+    def sample_batch_index(self, batch_positive, rank, positive_rate, keys):
+        """ Sample name indexes of a batch from uniform random keys
+
+        Args:
+            batch_positive (List[List[int]]): positive indexes of every instance
+            rank (np.ndarray): rank of names by string, the order of ordered prompt
+            positive_rate (float): rate of positive kept in SSI
+            keys (np.ndarray): uniform random keys, shape (batch size, `get_key_width`)
+
+        Returns:
+            candidates (positive subset + negative in prompt order) of all instances concatenated,
+            candidate number, positive subset and negative indexes of every instance
+        """
+        batch_size, name_num = len(batch_positive), len(rank)
+        negative_num = name_num if self.negative < 0 else min(self.negative, name_num)
+        positive_num = np.array([len(positive) for positive in batch_positive], dtype=np.int64)
+        max_positive_num = int(positive_num.max(initial=0))
+
+        positive = np.zeros((batch_size, max_positive_num), dtype=np.int64)
+        positive_valid = np.arange(max_positive_num)[None, :] < positive_num[:, None]
+        positive[positive_valid] = [index for indexes in batch_positive for index in indexes]
+        is_positive = np.zeros((batch_size, name_num + 1), dtype=bool)
+        np.put_along_axis(is_positive, np.where(positive_valid, positive, name_num), True, axis=1)
+
+        # First `negative_num` of a random permutation of all names, except positive ones
+        negative = np.argsort(keys[:, :name_num], axis=1)[:, :negative_num]
+        negative_valid = ~np.take_along_axis(is_positive, negative, axis=1)
+
+        # Random subset of `floor(len(positive) * positive_rate)` positive names
+        positive_keys = np.where(positive_valid, keys[:, name_num:name_num + max_positive_num], np.inf)
+        positive = np.take_along_axis(positive, np.argsort(positive_keys, axis=1), axis=1)
+        positive_valid = np.arange(max_positive_num)[None, :] < np.floor(positive_num * positive_rate)[:, None]
+
+        # Order candidates by name (ordered prompt) or by random keys, invalid ones last
+        candidate = np.concatenate([positive, negative], axis=1)
+        candidate_valid = np.concatenate([positive_valid, negative_valid], axis=1)
+        if self.ordered_prompt:
+            order_keys = np.where(candidate_valid, rank[candidate], np.inf)
+        else:
+            order_keys = np.where(candidate_valid, keys[:, name_num + max_positive_num:], np.inf)
+        order = np.argsort(order_keys, axis=1, kind='stable')
+        candidate = np.take_along_axis(candidate, order, axis=1)[np.take_along_axis(candidate_valid, order, axis=1)]
+
+        positive_list = [row[valid].tolist() for row, valid in zip(positive, positive_valid)]
+        negative_list = [row[valid].tolist() for row, valid in zip(negative, negative_valid)]
+        return candidate, candidate_valid.sum(axis=1).tolist(), positive_list, negative_list
+
+    def get_expected_length(self, positive_num, offsets, positive_rate):
+        """ Expected SSI length of instances with `positive_num` positive names, every name of the average length
+        """
+        positive_num = np.asarray(positive_num, dtype=np.int64)
+        name_num = len(offsets) - 1
+        if name_num == 0:
+            return np.zeros_like(positive_num)
+        negative_num = name_num if self.negative < 0 else min(self.negative, name_num)
+        # Negative names are the first `negative_num` of a permutation of all names, except positive ones
+        candidate_num = np.floor(positive_num * positive_rate) + negative_num * (name_num - positive_num) / name_num
+        return np.rint(candidate_num * offsets[-1] / name_num).astype(np.int64)
+
+    def expected_spot_length(self, positive_num):
+        return self.get_expected_length(positive_num, self.spot_offsets, self.positive_rate)
+
+    def expected_asoc_length(self, positive_num):
+        return self.get_expected_length(positive_num, self.asoc_offsets, 1)
+
+    def sample_batch(self, batch_positive_spot, batch_positive_asoc):
+        """ Sample SSI of a batch, all random numbers are drawn by one call of the NumPy generator
+
+        Returns:
+            List of (converted_spot_prefix, positive_spot, negative_spot, converted_asoc_prefix, negative_asoc),
+            the same as `sample_spot` and `sample_asoc` of every instance
+        """
+        batch_spot = [[self.spot_index[spot] for spot in positive] for positive in batch_positive_spot]
+        batch_asoc = [[self.asoc_index[asoc] for asoc in positive] for positive in batch_positive_asoc]
+        spot_width = self.get_key_width(batch_spot, len(self.spot_list))
+        asoc_width = self.get_key_width(batch_asoc, len(self.asoc_list))
+        keys = self.get_generator().random((len(batch_spot), spot_width + asoc_width))
+
+        spot_candidate, spot_num, positive_spot, negative_spot = self.sample_batch_index(
+            batch_spot, self.spot_rank, self.positive_rate, keys[:, :spot_width]
+        )
+        asoc_candidate, asoc_num, _, negative_asoc = self.sample_batch_index(
+            batch_asoc, self.asoc_rank, 1, keys[:, spot_width:]
+        )
+        spot_prefix = self.gather_batch_prefix(self.spot_table, self.spot_offsets, spot_candidate, spot_num)
+        asoc_prefix = self.gather_batch_prefix(self.asoc_table, self.asoc_offsets, asoc_candidate, asoc_num)
+
+        return [(spot_prefix[row],
+                 [self.spot_list[index] for index in positive_spot[row]],
+                 [self.spot_list[index] for index in negative_spot[row]],
+                 asoc_prefix[row],
+                 [self.asoc_list[index] for index in negative_asoc[row]])
+                for row in range(len(batch_spot))]
+
     @staticmethod
     def sample_negative(postive, candidates, k=5):
         if k < 0:
@@ -96,28 +265,16 @@ class DynamicSSIGenerator():
     def full_spot(self, shuffle=False):
         if not self.ordered_prompt and shuffle:
             # Random Prompt + Shuffle
-            ordered_prompt = False
-        else:
-            ordered_prompt = True
-        return self.convert_prefix(
-            candidates=self.spot_list,
-            prompt=self.spot_prompt,
-            mapper=self.spot_dict,
-            ordered_prompt=ordered_prompt,
-        )
+            index_list = self.get_generator().permutation(len(self.spot_list))
+            return self.gather_prefix(self.spot_table, self.spot_offsets, index_list).tolist()
+        return self.ordered_full_spot
 
     def full_asoc(self, shuffle=False):
         if not self.ordered_prompt and shuffle:
             # Random Prompt + Shuffle
-            ordered_prompt = False
-        else:
-            ordered_prompt = True
-        return self.convert_prefix(
-            candidates=self.asoc_list,
-            prompt=self.asoc_prompt,
-            mapper=self.asoc_dict,
-            ordered_prompt=ordered_prompt,
-        )
+            index_list = self.get_generator().permutation(len(self.asoc_list))
+            return self.gather_prefix(self.asoc_table, self.asoc_offsets, index_list).tolist()
+        return self.ordered_full_asoc
 
     @staticmethod
     def convert_prefix(candidates, prompt, mapper, ordered_prompt=True):
@@ -169,6 +326,15 @@ class DataCollatorForMetaSeq2Seq:
             7.5 (Volta).
         label_pad_token_id (:obj:`int`, `optional`, defaults to -100):
             The id to use when padding the labels (-100 will be automatically ignored by PyTorch loss functions).
+        training (:obj:`bool`, `optional`):
+            Whether to shuffle the full SSI of examples without sampled SSI, following `model.training` if not set.
+            Set it explicitly (see `with_training`) when collating in DataLoader workers.
+        pack_sequences (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to pack training examples into rows of `max_length` source and `max_target_length` target tokens
+            with segment ids (T5 only), see :func:`~uie.seq2seq.data_collator.sequence_packing.pack_features`.
+
+    The collator does not modify the input features and is picklable without the model, so it can run in DataLoader
+    workers; random numbers are drawn from the generator of `negative_sampler`, re-seeded in every worker.
     """
 
     tokenizer: PreTrainedTokenizerBase
@@ -182,39 +348,190 @@ class DataCollatorForMetaSeq2Seq:
     label_pad_token_id: int = -100
     spot_asoc_nosier: SpotAsocNoiser = None
     decoding_format: str = 'spotasoc'
+    prompt_cache_size: int = 1024
+    training: Optional[bool] = None
+    pack_sequences: bool = False
+    _prompt_cache: OrderedDict = field(default_factory=OrderedDict, init=False, repr=False)
 
-    def __call__(self, features):
-        """ Make Meta Schema Batch
+    # Columns read by `get_feature_lengths`, list columns as lengths
+    feature_length_columns: ClassVar[Tuple[str, ...]] = ('input_ids', 'labels', 'spots', 'asocs', 'spot_asoc')
+    feature_value_columns: ClassVar[Tuple[str, ...]] = ('skill', 'skill_input', 'sample_prompt')
+
+    def __post_init__(self):
+        # `decoder_input_ids` are shifted from labels by the model config, the model is not needed in the workers
+        if self.model is not None and hasattr(self.model, "prepare_decoder_input_ids_from_labels"):
+            self.decoder_start_token_id = self.model.config.decoder_start_token_id
+            self.decoder_pad_token_id = self.model.config.pad_token_id
+        else:
+            self.decoder_start_token_id = None
+            self.decoder_pad_token_id = None
+
+        # Regenerate labels from pre-tokenized `spot_asoc_ids` if the decoding format supports splicing
+        if self.decoding_format in convert_to_record_function:
+            self.record_ids_converter = SpotAsocIdsConverter(
+                tokenizer=self.tokenizer,
+                structure_maker=BaseStructureMarker(),
+                decoding_format=self.decoding_format,
+            )
+            if not self.record_ids_converter.exact:
+                logger.warning(f"Spliced labels differ from the labels of {type(self.tokenizer).__name__}, "
+                               f"labels are re-tokenized from the record string.")
+                self.record_ids_converter = None
+        else:
+            self.record_ids_converter = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['model'] = None
+        return state
+
+    def with_training(self, training: bool):
+        """ Copy of the collator with an explicit train/eval mode, sharing the tokenizer, model, sampler,
+        ids converter and prompt cache (`dataclasses.replace` would re-run `__post_init__` and empty the cache)
+        """
+        collator = copy.copy(self)
+        collator.training = training
+        return collator
+
+    def encode_prompt(self, prompt):
+        """ Token ids of the skill prompt, memoized in a LRU cache of `prompt_cache_size` prompts
+        """
+        prompt_ids = self._prompt_cache.get(prompt)
+        if prompt_ids is None:
+            prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
+            self._prompt_cache[prompt] = prompt_ids
+            if len(self._prompt_cache) > self.prompt_cache_size:
+                self._prompt_cache.popitem(last=False)
+        else:
+            self._prompt_cache.move_to_end(prompt)
+        return prompt_ids
+
+    def get_prefix(self, skill, skill_input, converted_spot_prefix, converted_asoc_prefix):
+        """ Skill prompt + SSI, truncated to `max_prefix_length`
+        """
+        if skill == "first":
+            prefix = self.encode_prompt(HT) + converted_spot_prefix
+        elif skill == "second":
+            prompt = f"{HT} {HA} {self.negative_sampler.raw_spot_prompt} {skill_input[0]} {span_start} {skill_input[1]}"
+            prefix = self.encode_prompt(prompt) + converted_asoc_prefix
+        else:  # main task
+            prompt = f"{HT} {HA}"
+            prefix = self.encode_prompt(prompt) + converted_spot_prefix + converted_asoc_prefix
+
+        # truncate `prefix` to max length
+        if self.max_prefix_length is not None and self.max_prefix_length >= 0:
+            prefix = prefix[:self.max_prefix_length]
+        return prefix
+
+    def get_feature_lengths(self, columns: Dict[str, Union[np.ndarray, list]]) -> Tuple[np.ndarray, np.ndarray]:
+        """ Expected `input_ids` and `labels` lengths of collated features, for batching by length
+
+        Features with `sample_prompt` get the expected length of sampled SSI (positive names kept by `positive_rate`,
+        negative names except positive ones, names of the average length), the others get the full SSI.
+        Targets regenerated for the main skill drop the spots not kept in the SSI and get the expected rejection noise
+        of `spot_asoc_nosier`, rounded up.
+
+        Args:
+            columns: lengths of the list columns `feature_length_columns` (`np.ndarray`) and values of the columns
+                `feature_value_columns` of the features, missing columns are not used
+        """
+        feature_num = len(columns['input_ids'])
+        zeros = np.zeros(feature_num, dtype=np.int64)
+        sample_prompt = np.array(columns.get('sample_prompt', [False] * feature_num), dtype=bool)
+        spot_length = np.where(sample_prompt, self.negative_sampler.expected_spot_length(columns.get('spots', zeros)),
+                               len(self.negative_sampler.full_spot()))
+        asoc_length = np.where(sample_prompt, self.negative_sampler.expected_asoc_length(columns.get('asocs', zeros)),
+                               len(self.negative_sampler.full_asoc()))
+
+        # Only the SSI length matters for the prefix length
+        prefix_length = np.array([len(self.get_prefix(
+            skill=skill,
+            skill_input=skill_input,
+            converted_spot_prefix=[self.negative_sampler.spot_prompt] * spot,
+            converted_asoc_prefix=[self.negative_sampler.asoc_prompt] * asoc,
+        )) for skill, skill_input, spot, asoc in zip(columns['skill'], columns['skill_input'],
+                                                     spot_length.tolist(), asoc_length.tolist())], dtype=np.int64)
+        source_length = prefix_length + 1 + columns['input_ids']
+
+        target_length = columns.get('labels', zeros)
+        if 'spot_asoc' in columns:
+            regenerated = sample_prompt & (np.array(columns['skill'], dtype=object) == 'main')
+            # Spots whose label is not kept in the SSI are deleted, except `type_start` `type_end` `eos` of the record
+            positive_num = columns.get('spots', zeros)
+            kept_rate = np.floor(positive_num * self.negative_sampler.positive_rate) / np.maximum(positive_num, 1)
+            kept_rate = np.where(positive_num > 0, kept_rate, 1)
+            regenerated_length = 3 + (target_length - 3) * kept_rate
+            if self.spot_asoc_nosier is not None:
+                # An inserted spot or asoc is `type_start` + name + `span_start` + `null_span` + `type_end`
+                spot_offsets, asoc_offsets = self.negative_sampler.spot_offsets, self.negative_sampler.asoc_offsets
+                spot_num = columns['spot_asoc'] * kept_rate
+                regenerated_length += spot_num * self.spot_asoc_nosier.spot_noise_ratio \
+                    * (spot_offsets[-1] / max(len(spot_offsets) - 1, 1) + 3)
+                regenerated_length += spot_num * self.spot_asoc_nosier.asoc_noise_ratio \
+                    * (asoc_offsets[-1] / max(len(asoc_offsets) - 1, 1) + 3)
+            target_length = np.where(regenerated, np.ceil(regenerated_length), target_length).astype(np.int64)
+
+        if self.max_length:
+            source_length = np.minimum(source_length, self.max_length)
+        if self.max_target_length:
+            target_length = np.minimum(target_length, self.max_target_length)
+        return source_length, target_length
+
+    def is_training(self):
+        return self.training if self.training is not None else self.model is not None and self.model.training
+
+    def process_features(self, features):
+        """ Prepend the SSI to features and regenerate labels, before padding
 
         Args:
             features (Dict): [description]
                 - sample_prompt: indicates sample_prompt example, need pop after call
                 - spots (List[str]): List of spots in this sentence, need pop after call
                 - asocs (List[str]): List of asocs in this sentence, need pop after call
+                - spot_asoc_ids (List[List[int]]): optional span ids of `tokenize_spot_asoc`, need pop after call
                 - input_ids
                 - attention_mask
                 - labels
 
         Returns:
+            List[Dict[str, List[int]]]: new features with `input_ids`, `attention_mask` and `labels`
         """
+        training = self.is_training()
+        generator = self.negative_sampler.get_generator()
+        features = [dict(feature) for feature in features]
+
+        # Sample SSI of the whole batch at once
+        sampled_ssi = iter(self.negative_sampler.sample_batch(
+            batch_positive_spot=[feature.get('spots', []) for feature in features if feature['sample_prompt']],
+            batch_positive_asoc=[feature.get('asocs', []) for feature in features if feature['sample_prompt']],
+        ))
+
         for feature in features:
 
             sample_prompt = feature['sample_prompt']
 
             if not sample_prompt:
                 # Evaluation using Ordered SSI
-                converted_spot_prefix = self.negative_sampler.full_spot(shuffle=self.model.training)
-                converted_asoc_prefix = self.negative_sampler.full_asoc(shuffle=self.model.training)
+                converted_spot_prefix = self.negative_sampler.full_spot(shuffle=training)
+                converted_asoc_prefix = self.negative_sampler.full_asoc(shuffle=training)
             else:
                 # Sample SSI
-                converted_spot_prefix, positive_spot, negative_spot = self.negative_sampler.sample_spot(positive=feature.get('spots', []))
-                converted_asoc_prefix, negative_asoc = self.negative_sampler.sample_asoc(positive=feature.get('asocs', []))
+                converted_spot_prefix, positive_spot, negative_spot, converted_asoc_prefix, negative_asoc = next(sampled_ssi)
 
                 # Dynamic generating spot-asoc during training
                 if 'spot_asoc' in feature and feature["skill"] == "main":  # only consider rejection noise in the hard and main stages
 
+                    # Carry pre-tokenized span ids through filtering and noising
+                    if self.record_ids_converter is not None and 'spot_asoc_ids' in feature:
+                        feature['spot_asoc'] = self.record_ids_converter.attach(feature['spot_asoc'], feature['spot_asoc_ids'])
+                        splice_labels = True
+                    else:
+                        splice_labels = False
+
                     # Deleted positive example Spot in Target that was not sampled by Prefix
-                    feature['spot_asoc'] = [spot_asoc for spot_asoc in feature['spot_asoc'] if spot_asoc["label"] in positive_spot]
+                    # Spots and their asoc lists are copied, the noise is inserted into the copies
+                    feature['spot_asoc'] = [dict(spot_asoc, asoc=list(spot_asoc.get('asoc', list())))
+                                            for spot_asoc in feature['spot_asoc'] if spot_asoc["label"] in positive_spot]
 
                     # Inject rejection noise
                     if self.spot_asoc_nosier is not None:
@@ -223,39 +540,39 @@ class DataCollatorForMetaSeq2Seq:
                                 feature['spot_asoc'],
                                 spot_label_list=negative_spot,
                                 asoc_label_list=negative_asoc,
+                                generator=generator,
                             )
                         else:
                             raise NotImplementedError(f'{self.spot_asoc_nosier} is not implemented.')
 
                     # Generate new record
-                    record = convert_to_record_function[self.decoding_format](
-                        feature['spot_asoc'],
-                        structure_maker=BaseStructureMarker()
-                    )
-                    feature["labels"] = self.tokenizer.encode(record)
+                    if splice_labels:
+                        feature["labels"] = self.record_ids_converter.convert(feature['spot_asoc'])
+                    else:
+                        record = convert_to_record_function[self.decoding_format](
+                            feature['spot_asoc'],
+                            structure_maker=BaseStructureMarker()
+                        )
+                        feature["labels"] = self.tokenizer.encode(record)
 
             feature.pop('sample_prompt') if 'sample_prompt' in feature else None
             feature.pop('spot_asoc') if 'spot_asoc' in feature else None
+            feature.pop('spot_asoc_ids') if 'spot_asoc_ids' in feature else None
             feature.pop('spots') if 'spots' in feature else None
             feature.pop('asocs') if 'asocs' in feature else None
 
             assert 'skill' in feature
             assert 'skill_input' in feature
 
-            if feature["skill"] == "first":
-                prefix = self.tokenizer.encode(HT, add_special_tokens=False) + converted_spot_prefix
-            elif feature["skill"] == "second":
-                prompt = f"{HT} {HA} {self.negative_sampler.raw_spot_prompt} {feature['skill_input'][0]} {span_start} {feature['skill_input'][1]}"
-                prefix = self.tokenizer.encode(prompt, add_special_tokens=False) + converted_asoc_prefix
-            else:  # main task
-                prompt = f"{HT} {HA}"
-                prefix = self.tokenizer.encode(prompt, add_special_tokens=False) + converted_spot_prefix + converted_asoc_prefix
+            prefix = self.get_prefix(
+                skill=feature['skill'],
+                skill_input=feature['skill_input'],
+                converted_spot_prefix=converted_spot_prefix,
+                converted_asoc_prefix=converted_asoc_prefix,
+            )
 
             feature.pop('skill')
             feature.pop('skill_input')
-            # truncate `prefix` to max length
-            if self.max_prefix_length is not None and self.max_prefix_length >= 0:
-                prefix = prefix[:self.max_prefix_length]
             feature['input_ids'] = prefix + [self.negative_sampler.text_start] + feature['input_ids']
             # print("decoded_input: ", self.tokenizer.decode(feature['input_ids']))
             # print("decoded_labels: ", self.tokenizer.decode(feature['labels']))
@@ -269,29 +586,65 @@ class DataCollatorForMetaSeq2Seq:
 
             feature['attention_mask'] = [1] * len(feature['input_ids'])
 
+        return features
+
+    def __call__(self, features):
+        """ Make Meta Schema Batch, see `process_features` for the features
+        """
+        features = self.process_features(features)
+
+        if self.pack_sequences and self.is_training() and "labels" in features[0].keys():
+            return pack_features(
+                features,
+                max_length=self.max_length,
+                max_target_length=self.max_target_length,
+                decoder_start_token_id=self.decoder_start_token_id if self.decoder_start_token_id is not None
+                else self.tokenizer.pad_token_id,
+                pad_token_id=self.tokenizer.pad_token_id,
+                label_pad_token_id=self.label_pad_token_id,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+            )
+
         labels = [feature["labels"] for feature in features] if "labels" in features[0].keys() else None
-        # We have to pad the labels before calling `tokenizer.pad` as this method won't pad them and needs them of the
-        # same length to return tensors.
-        if labels is not None:
-            max_label_length = max(len(_label) for _label in labels)
-            padding_side = self.tokenizer.padding_side
-            for feature in features:
-                remainder = [self.label_pad_token_id] * (max_label_length - len(feature["labels"]))
-                feature["labels"] = (
-                    feature["labels"] + remainder if padding_side == "right" else remainder + feature["labels"]
-                )
-
-        features = self.tokenizer.pad(
-            features,
-            padding=self.padding,
-            max_length=self.max_length,
-            pad_to_multiple_of=self.pad_to_multiple_of,
-            return_tensors="pt"
-        )
 
-        # prepare decoder_input_ids
-        if self.model is not None and hasattr(self.model, "prepare_decoder_input_ids_from_labels"):
-            decoder_input_ids = self.model.prepare_decoder_input_ids_from_labels(labels=features["labels"])
+        if self.padding in [True, 'longest', PaddingStrategy.LONGEST] and self.tokenizer.padding_side == 'right' \
+                and set(features[0].keys()) <= {'input_ids', 'attention_mask', 'labels'}:
+            # Pad every feature once into a buffer of the final shape, the same result as `tokenizer.pad` below
+            batch = {
+                'input_ids': pad_sequences([feature['input_ids'] for feature in features],
+                                           self.tokenizer.pad_token_id, self.pad_to_multiple_of),
+                'attention_mask': pad_sequences([feature['attention_mask'] for feature in features],
+                                                0, self.pad_to_multiple_of),
+            }
+            if labels is not None:
+                batch['labels'] = pad_sequences(labels, self.label_pad_token_id)
+            features = BatchEncoding(batch)
+
+        else:
+            # We have to pad the labels before calling `tokenizer.pad` as this method won't pad them and needs them of
+            # the same length to return tensors.
+            if labels is not None:
+                max_label_length = max(len(_label) for _label in labels)
+                padding_side = self.tokenizer.padding_side
+                for feature in features:
+                    remainder = [self.label_pad_token_id] * (max_label_length - len(feature["labels"]))
+                    feature["labels"] = (
+                        feature["labels"] + remainder if padding_side == "right" else remainder + feature["labels"]
+                    )
+
+            features = self.tokenizer.pad(
+                features,
+                padding=self.padding,
+                max_length=self.max_length,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+                return_tensors="pt"
+            )
+
+        # prepare decoder_input_ids, the same as `model.prepare_decoder_input_ids_from_labels`
+        if self.decoder_start_token_id is not None:
+            decoder_input_ids = shift_labels_right(
+                features["labels"], self.decoder_pad_token_id, self.decoder_start_token_id
+            )
             features["decoder_input_ids"] = decoder_input_ids
 
         return features
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Sequence packing of short instances for T5.
+
+Several instances share one row and are separated by segment ids (1, 2, ..., 0 for padding):
+encoder self-attention is block-diagonal, decoder self-attention is causal inside every segment,
+the decoder input restarts from `decoder_start_token_id` at every segment,
+and every decoder segment only attends to the encoder tokens of the same instance.
+T5 uses relative position bias, so every segment sees the same positions as without packing.
+
+`pad_sequences` pads id lists of a batch into one preallocated tensor, it is shared with unpacked collation.
+"""
+from typing import Dict, List, Optional
+
+import torch
+
+
+def pack_features(features: List[Dict],
+                  max_length: Optional[int] = None,
+                  max_target_length: Optional[int] = None,
+                  decoder_start_token_id: int = 0,
+                  pad_token_id: int = 0,
+                  label_pad_token_id: int = -100,
+                  pad_to_multiple_of: Optional[int] = None) -> Dict[str, torch.Tensor]:
+    """ Pack collated features with `input_ids` and `labels` into rows by first-fit decreasing
+
+    Args:
+        features (List[Dict]): features with `input_ids` and `labels` lists
+        max_length (int, optional): source tokens of a row, the longest source if not set
+        max_target_length (int, optional): target tokens of a row, the longest target if not set
+        decoder_start_token_id (int):
+        pad_token_id (int):
+        label_pad_token_id (int):
+        pad_to_multiple_of (int, optional):
+
+    Returns:
+        Dict[str, torch.Tensor]: input_ids, segment_ids, labels, decoder_input_ids, decoder_segment_ids
+    """
+    source_capacity = max([max_length or 0] + [len(feature['input_ids']) for feature in features])
+    target_capacity = max([max_target_length or 0] + [len(feature['labels']) for feature in features])
+
+    # [source length, target length, feature indexes]
+    rows = list()
+    order = sorted(range(len(features)),
+                   key=lambda index: (len(features[index]['input_ids']), len(features[index]['labels'])),
+                   reverse=True)
+    for index in order:
+        source_length, target_length = len(features[index]['input_ids']), len(features[index]['labels'])
+        for row in rows:
+            if row[0] + source_length <= source_capacity and row[1] + target_length <= target_capacity:
+                row[0] += source_length
+                row[1] += target_length
+                row[2] += [index]
+                break
+        else:
+            rows += [[source_length, target_length, [index]]]
+
+    packed = {key: list() for key in ['input_ids', 'segment_ids', 'labels', 'decoder_input_ids', 'decoder_segment_ids']}
+    for _, _, index_list in rows:
+        input_ids, segment_ids, labels, decoder_input_ids, decoder_segment_ids = list(), list(), list(), list(), list()
+        for segment_id, index in enumerate(index_list, 1):
+            feature_labels = features[index]['labels']
+            input_ids += features[index]['input_ids']
+            segment_ids += [segment_id] * len(features[index]['input_ids'])
+            labels += feature_labels
+            # Shift labels right inside the segment, the same as `model.prepare_decoder_input_ids_from_labels`
+            decoder_input_ids += [decoder_start_token_id] + [pad_token_id if label == label_pad_token_id else label
+                                                             for label in feature_labels[:-1]]
+            decoder_segment_ids += [segment_id] * len(feature_labels)
+        packed['input_ids'] += [input_ids]
+        packed['segment_ids'] += [segment_ids]
+        packed['labels'] += [labels]
+        packed['decoder_input_ids'] += [decoder_input_ids]
+        packed['decoder_segment_ids'] += [decoder_segment_ids]
+
+    return {
+        'input_ids': pad_sequences(packed['input_ids'], pad_token_id, pad_to_multiple_of),
+        'segment_ids': pad_sequences(packed['segment_ids'], 0, pad_to_multiple_of),
+        'labels': pad_sequences(packed['labels'], label_pad_token_id, pad_to_multiple_of),
+        'decoder_input_ids': pad_sequences(packed['decoder_input_ids'], pad_token_id, pad_to_multiple_of),
+        'decoder_segment_ids': pad_sequences(packed['decoder_segment_ids'], 0, pad_to_multiple_of),
+    }
+
+
+def scatter_sequences(buffer: torch.Tensor, sequences: List[List[int]], start: int = 0) -> torch.Tensor:
+    """ Write `sequences` into the rows of `buffer` from row `start`, left-aligned, all ids at once
+    """
+    lengths = torch.tensor([len(sequence) for sequence in sequences], dtype=torch.long)
+    row_index = torch.repeat_interleave(torch.arange(start, start + len(sequences)), lengths)
+    column_index = torch.arange(row_index.size(0)) - torch.repeat_interleave(torch.cumsum(lengths, dim=0) - lengths,
+                                                                             lengths)
+    buffer[row_index, column_index] = torch.tensor([x for sequence in sequences for x in sequence], dtype=buffer.dtype)
+    return buffer
+
+
+def padded_length(sequences: List[List[int]], pad_to_multiple_of: Optional[int] = None) -> int:
+    """ Length of the longest sequence, rounded up to a multiple of `pad_to_multiple_of`
+    """
+    length = max(len(sequence) for sequence in sequences)
+    if pad_to_multiple_of is not None and length % pad_to_multiple_of != 0:
+        length = (length // pad_to_multiple_of + 1) * pad_to_multiple_of
+    return length
+
+
+def pad_sequences(sequences: List[List[int]], pad_id: int, pad_to_multiple_of: Optional[int] = None) -> torch.Tensor:
+    """ Right-pad `sequences` to the longest one, all ids are scattered into a buffer of the final shape at once
+    """
+    buffer = torch.full((len(sequences), padded_length(sequences, pad_to_multiple_of)), fill_value=pad_id,
+                        dtype=torch.long)
+    return scatter_sequences(buffer, sequences)
+
+
+def get_packed_attention_masks(segment_ids: torch.Tensor, decoder_segment_ids: torch.Tensor):
+    """ Attention masks of packed rows, (batch, query, key), 1 to attend
+
+    Padding tokens (segment 0) attend to each other only, their outputs are ignored by the loss.
+
+    Returns:
+        encoder self-attention mask, decoder self-attention mask, decoder-encoder cross-attention mask
+    """
+    decoder_length = decoder_segment_ids.size(1)
+    causal_mask = torch.ones(decoder_length, decoder_length, dtype=torch.bool, device=decoder_segment_ids.device).tril()
+    encoder_mask = segment_ids[:, :, None] == segment_ids[:, None, :]
+    decoder_mask = (decoder_segment_ids[:, :, None] == decoder_segment_ids[:, None, :]) & causal_mask[None, :, :]
+    cross_mask = decoder_segment_ids[:, :, None] == segment_ids[:, None, :]
+    return encoder_mask.long(), decoder_mask.long(), cross_mask.long()
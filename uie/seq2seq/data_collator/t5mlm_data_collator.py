@@ -69,13 +69,11 @@ class DataCollatorForT5MLM:
         )
         input_ids = input_ids['input_ids']
 
-        mask_indices = np.zeros_like(input_ids, dtype=bool)
-        for index, x in enumerate(raw_input_ids):
-            if len(x) - 1 < 2:
-                # Ignore src with single token
-                continue
-            mask = self.random_spans_noise_mask(len(x) - 1)
-            mask_indices[index, :len(mask)] = mask
+        # Ignore src with single token, the last token (eos) is never masked
+        mask_indices = self.random_spans_noise_mask_batch(
+            lengths=[len(x) - 1 for x in raw_input_ids],
+            width=input_ids.shape[1],
+        )
 
         labels_mask = ~mask_indices
 
@@ -114,17 +112,74 @@ class DataCollatorForT5MLM:
         Puts sentinel mask on `input_ids` and fuse consecutive mask tokens into a single mask token by deleting.
         This will reduce the sequence length from `expanded_inputs_length` to `input_length`.
         """
-        new_input_ids = list()
-        for x, y in zip(input_ids, sentinel_ids):
-            input_ids_full = np.where(y != 0, y, x)
-            x = input_ids_full[input_ids_full > 0].tolist()[:-1]
-            x = x + [self.tokenizer.eos_token_id]
-            new_input_ids += [x]
-        from itertools import zip_longest
-
-        new_input_ids = np.array(list(zip_longest(*new_input_ids, fillvalue=0))).T
+        input_ids_full = np.where(sentinel_ids != 0, sentinel_ids, input_ids)
+        keep = input_ids_full > 0
+        keep_num = keep.sum(axis=1)
+        # Kept tokens except the last one, followed by eos, are moved to the left of every row
+        position = np.cumsum(keep, axis=1) - 1
+        keep &= position < (keep_num - 1)[:, None]
+        new_length = np.maximum(keep_num, 1)
+
+        new_input_ids = np.zeros((input_ids.shape[0], new_length.max()), dtype=input_ids.dtype)
+        rows, columns = np.nonzero(keep)
+        new_input_ids[rows, position[rows, columns]] = input_ids_full[rows, columns]
+        new_input_ids[np.arange(input_ids.shape[0]), new_length - 1] = self.tokenizer.eos_token_id
         return new_input_ids
 
+    def random_spans_noise_mask_batch(self, lengths, width):
+        """ Noise masks of a batch by array operations, every row follows the distribution of
+        `random_spans_noise_mask` of its length; lengths less than 2 get empty masks.
+
+        Args:
+            lengths: lengths of the incoming token sequences
+            width: width of the returned masks, no less than the max length
+
+        Returns:
+            a boolean array with shape [batch size, width]
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        batch_size = lengths.shape[0]
+        valid = lengths >= 2
+        safe_lengths = np.where(valid, lengths, 2)
+
+        num_noise_tokens = np.round(safe_lengths * self.noise_density).astype(np.int64)
+        # avoid degeneracy by ensuring positive numbers of noise and nonnoise tokens.
+        num_noise_tokens = np.minimum(np.maximum(num_noise_tokens, 1), safe_lengths - 1)
+        num_noise_spans = np.round(num_noise_tokens / self.mean_noise_span_length).astype(np.int64)
+        # avoid degeneracy by ensuring positive number of noise spans
+        num_noise_spans = np.maximum(num_noise_spans, 1)
+        num_nonnoise_tokens = safe_lengths - num_noise_tokens
+
+        def _random_segment_id(num_items, num_segments):
+            """Segment id of every item, partitioning items of every row randomly into non-empty segments.
+            The first `num_segments - 1` of a random permutation of the `num_items - 1` boundaries are chosen,
+            the same as shuffling `num_segments - 1` boundaries among them.
+            """
+            boundary_width = num_items.max() - 1
+            keys = np.random.random_sample((batch_size, boundary_width))
+            keys[np.arange(boundary_width)[None, :] >= (num_items - 1)[:, None]] = np.inf
+            rank = np.argsort(np.argsort(keys, axis=1), axis=1)
+            first_in_segment = np.pad(rank < (num_segments - 1)[:, None], [[0, 0], [1, 0]])
+            return np.cumsum(first_in_segment, axis=1)
+
+        noise_segment_id = _random_segment_id(num_noise_tokens, num_noise_spans)
+        nonnoise_segment_id = _random_segment_id(num_nonnoise_tokens, num_noise_spans)
+
+        # Spans alternate between non-noise and noise, the k-th non-noise span follows the first k noise spans
+        noise_valid = np.arange(noise_segment_id.shape[1])[None, :] < num_noise_tokens[:, None]
+        noise_rows = np.nonzero(noise_valid)[0]
+        noise_span_lengths = np.zeros((batch_size, num_noise_spans.max()), dtype=np.int64)
+        np.add.at(noise_span_lengths, (noise_rows, noise_segment_id[noise_valid]), 1)
+        preceding_noise = np.cumsum(noise_span_lengths, axis=1) - noise_span_lengths
+
+        nonnoise_valid = np.arange(nonnoise_segment_id.shape[1])[None, :] < num_nonnoise_tokens[:, None]
+        nonnoise_rows, nonnoise_index = np.nonzero(nonnoise_valid)
+        nonnoise_position = nonnoise_index + preceding_noise[nonnoise_rows, nonnoise_segment_id[nonnoise_valid]]
+
+        is_noise = np.arange(width)[None, :] < np.where(valid, lengths, 0)[:, None]
+        is_noise[nonnoise_rows[valid[nonnoise_rows]], nonnoise_position[valid[nonnoise_rows]]] = False
+        return is_noise
+
     def random_spans_noise_mask(self, length):
 
         """This function is copy of `random_spans_helper <https://github.com/google-research/text-to-text-transfer-transformer/blob/84f8bcc14b5f2c03de51bd3587609ba8f6bbd1cd/t5/data/preprocessors.py#L2682>`__ .
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from typing import List
+
+import torch
+
+from torch.utils.data.sampler import Sampler
+
+
+class LengthSortedSampler(Sampler):
+    """
+    Iterate dataset indices by descending input length, so that every evaluation batch is padded to similar lengths.
+    `indices[i]` is the dataset index of the i-th collated example, used to restore the dataset order of predictions.
+    """
+
+    def __init__(self, lengths: List[int]):
+        self.lengths = lengths
+        self.indices = sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def restore_order(self, array):
+        """ Permute `array` collected in sampler order back to dataset order
+        """
+        if array is None:
+            return None
+        if isinstance(array, (list, tuple)):
+            return type(array)(self.restore_order(x) for x in array)
+        restored = array.copy()
+        restored[self.indices] = array
+        return restored
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch training examples by a token budget instead of a fixed batch size: every batch keeps
+    `batch size * (max source length + max target length)`, the padded source and target tokens, within `max_tokens`.
+    Examples are sorted by length with random tie-breaking and packed greedily once, so the number of batches is fixed;
+    the order of batches is shuffled by the epoch set by `set_epoch`, which `ConstraintSeq2SeqTrainer` calls at the
+    beginning of every epoch.
+    In distributed training, every replica takes every `num_replicas`-th batch of the same order.
+    """
+
+    def __init__(self, source_lengths: List[int], target_lengths: List[int], max_tokens: int, seed: int = 0,
+                 shuffle: bool = True, num_replicas: int = 1, rank: int = 0):
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+        order = torch.randperm(len(source_lengths), generator=generator).tolist()
+        order.sort(key=lambda index: (source_lengths[index], target_lengths[index]))
+
+        self.batches = list()
+        batch, max_source_length, max_target_length = list(), 0, 0
+        for index in order:
+            source_length = max(max_source_length, source_lengths[index])
+            target_length = max(max_target_length, target_lengths[index])
+            if len(batch) > 0 and (len(batch) + 1) * (source_length + target_length) > self.max_tokens:
+                self.batches += [batch]
+                batch, source_length, target_length = list(), source_lengths[index], target_lengths[index]
+            batch += [index]
+            max_source_length, max_target_length = source_length, target_length
+        if len(batch) > 0:
+            self.batches += [batch]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            batch_order = torch.randperm(len(self.batches), generator=generator).tolist()
+        else:
+            batch_order = list(range(len(self.batches)))
+        # Drop the tail so that all replicas run the same number of steps
+        batch_order = batch_order[:len(self) * self.num_replicas]
+        for batch_index in batch_order[self.rank::self.num_replicas]:
+            yield self.batches[batch_index]
+
+    def __len__(self):
+        return len(self.batches) // self.num_replicas
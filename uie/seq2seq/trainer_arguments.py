@@ -80,6 +80,13 @@ class DataTrainingArguments:
             "help": "How many examples for each training example of the main task"
         },
     )
+    stream_hard: bool = field(
+        default=False,  # for the hard stage
+        metadata={
+            "help": "Merge hard instances on the fly with new random partners every epoch instead of building them "
+                    "once, `max_train_samples` selects the base instances."
+        },
+    )
     empty_ratio: float = field(
         default=1,  # for the easy stage
         metadata={
@@ -126,12 +133,14 @@ class DataTrainingArguments:
     )
     preprocess: bool = field(
         default=True,
-        metadata={"help": ""},
+        metadata={"help": "Save the stage datasets into `preprocessed_folder` if they are not cached, "
+                          "otherwise only load cached ones."},
     )
     preprocessed_folder: Optional[str] = field(
         default=None,
         metadata={
-            "help": "Folder to preprocessed data"
+            "help": "Folder to preprocessed data, the stage datasets are cached by input files, stage, skills, "
+                    "empty_ratio, sent_num, M and seed. Use `overwrite_cache` to rebuild."
         },
     )
     max_source_length: Optional[int] = field(
@@ -224,10 +233,12 @@ class DataTrainingArguments:
         else:
             if self.train_file is not None:
                 extension = self.train_file.split(".")[-1]
-                assert extension in ["csv", "json"], "`train_file` should be a csv or a json file."
+                assert extension in ["csv", "json", "parquet", "arrow"], \
+                    "`train_file` should be a csv, json, parquet or arrow file."
             if self.validation_file is not None:
                 extension = self.validation_file.split(".")[-1]
-                assert extension in ["csv", "json"], "`validation_file` should be a csv or a json file."
+                assert extension in ["csv", "json", "parquet", "arrow"], \
+                    "`validation_file` should be a csv, json, parquet or arrow file."
         if self.val_max_target_length is None:
             self.val_max_target_length = self.max_target_length
 
@@ -1,9 +1,12 @@
 # coding=utf-8
 
+import functools
 import json
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from io import BytesIO
-from typing import Optional
+from typing import List, Optional
 
 import pyarrow as pa
 import pyarrow.json as paj
@@ -11,6 +14,13 @@ import pyarrow.json as paj
 import datasets
 
 
+@functools.lru_cache(maxsize=None)
+def read_table_schema(schema_file):
+    """ Explicit pa.Schema of UIE JSON lines, loaded once per process """
+    with open(schema_file, 'rb') as f:
+        return pickle.load(f)
+
+
 @dataclass
 class JsonConfig(datasets.BuilderConfig):
     """BuilderConfig for JSON."""
@@ -20,6 +30,11 @@ class JsonConfig(datasets.BuilderConfig):
     use_threads: bool = True
     block_size: Optional[int] = None
     newlines_in_values: Optional[bool] = None
+    schema_file: str = 'etc/record.dataload.schema'
+    # Columns to read, fields out of `columns` are skipped by the JSON parser instead of being materialized
+    columns: Optional[List[str]] = None
+    # Threads reading files of one split in parallel
+    num_threads: Optional[int] = None
 
     @property
     def pa_read_options(self):
@@ -27,10 +42,14 @@ class JsonConfig(datasets.BuilderConfig):
 
     @property
     def pa_parse_options(self):
-        import pickle
-        table_schema = pickle.load(open('etc/record.dataload.schema', 'rb'))
-        print(table_schema)
-        return paj.ParseOptions(explicit_schema=table_schema, newlines_in_values=self.newlines_in_values)
+        table_schema = read_table_schema(self.schema_file)
+        if self.columns is None:
+            return paj.ParseOptions(explicit_schema=table_schema, newlines_in_values=self.newlines_in_values)
+        return paj.ParseOptions(
+            explicit_schema=pa.schema([table_schema.field(name) for name in self.columns]),
+            newlines_in_values=self.newlines_in_values,
+            unexpected_field_behavior='ignore',
+        )
 
     @property
     def schema(self):
@@ -60,50 +79,57 @@ class Json(datasets.ArrowBasedBuilder):
             splits.append(datasets.SplitGenerator(name=split_name, gen_kwargs={"files": files}))
         return splits
 
-    def _generate_tables(self, files):
-        for i, file in enumerate(files):
-            if self.config.field is not None:
-                with open(file, encoding="utf-8") as f:
-                    dataset = json.load(f)
+    def _read_table(self, file, read_options, parse_options):
+        if self.config.field is not None:
+            with open(file, encoding="utf-8") as f:
+                dataset = json.load(f)
 
-                # We keep only the field we are interested in
-                dataset = dataset[self.config.field]
+            # We keep only the field we are interested in
+            dataset = dataset[self.config.field]
 
-                # We accept two format: a list of dicts or a dict of lists
-                if isinstance(dataset, (list, tuple)):
-                    pa_table = paj.read_json(
-                        BytesIO("\n".join(json.dumps(row) for row in dataset).encode("utf-8")),
-                        read_options=self.config.pa_read_options,
-                        parse_options=self.config.pa_parse_options,
-                    )
-                else:
-                    pa_table = pa.Table.from_pydict(mapping=dataset)
+            # We accept two format: a list of dicts or a dict of lists
+            if isinstance(dataset, (list, tuple)):
+                pa_table = paj.read_json(
+                    BytesIO("\n".join(json.dumps(row) for row in dataset).encode("utf-8")),
+                    read_options=read_options,
+                    parse_options=parse_options,
+                )
             else:
-                try:
-                    pa_table = paj.read_json(
-                        file,
-                        read_options=self.config.pa_read_options,
-                        parse_options=self.config.pa_parse_options,
-                    )
-                except pa.ArrowInvalid:
-                    with open(file, encoding="utf-8") as f:
-                        dataset = json.load(f)
-                    raise ValueError(
-                        f"Not able to read records in the JSON file at {file}. "
-                        f"You should probably indicate the field of the JSON file containing your records. "
-                        f"This JSON file contain the following fields: {str(list(dataset.keys()))}. "
-                        f"Select the correct one and provide it as `field='XXX'` to the dataset loading method. "
-                    )
-            if self.config.features:
-                # Encode column if ClassLabel
-                for i, col in enumerate(self.config.features.keys()):
-                    if isinstance(self.config.features[col], datasets.ClassLabel):
-                        pa_table = pa_table.set_column(
-                            i, self.config.schema.field(col), [self.config.features[col].str2int(pa_table[col])]
-                        )
-                # Cast allows str <-> int/float, while parse_option explicit_schema does NOT
-                # Before casting, rearrange JSON field names to match passed features schema field names order
-                pa_table = pa.Table.from_arrays(
-                    [pa_table[name] for name in self.config.features], schema=self.config.schema
+                pa_table = pa.Table.from_pydict(mapping=dataset)
+        else:
+            try:
+                pa_table = paj.read_json(
+                    file,
+                    read_options=read_options,
+                    parse_options=parse_options,
+                )
+            except pa.ArrowInvalid:
+                with open(file, encoding="utf-8") as f:
+                    dataset = json.load(f)
+                raise ValueError(
+                    f"Not able to read records in the JSON file at {file}. "
+                    f"You should probably indicate the field of the JSON file containing your records. "
+                    f"This JSON file contain the following fields: {str(list(dataset.keys()))}. "
+                    f"Select the correct one and provide it as `field='XXX'` to the dataset loading method. "
                 )
-            yield i, pa_table
+        if self.config.features:
+            # Encode column if ClassLabel
+            for i, col in enumerate(self.config.features.keys()):
+                if isinstance(self.config.features[col], datasets.ClassLabel):
+                    pa_table = pa_table.set_column(
+                        i, self.config.schema.field(col), [self.config.features[col].str2int(pa_table[col])]
+                    )
+            # Cast allows str <-> int/float, while parse_option explicit_schema does NOT
+            # Before casting, rearrange JSON field names to match passed features schema field names order
+            pa_table = pa.Table.from_arrays(
+                [pa_table[name] for name in self.config.features], schema=self.config.schema
+            )
+        return pa_table
+
+    def _generate_tables(self, files):
+        read_options, parse_options = self.config.pa_read_options, self.config.pa_parse_options
+        # `paj.read_json` releases the GIL, files are parsed in parallel and yielded in order
+        with ThreadPoolExecutor(max_workers=self.config.num_threads or len(files)) as executor:
+            tables = executor.map(lambda file: self._read_table(file, read_options, parse_options), files)
+            for i, pa_table in enumerate(tables):
+                yield i, pa_table
@@ -14,14 +14,148 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # You can also adapt this script on your own sequence to sequence task. Pointers for this are left as comments.
-import copy
+import hashlib
+import json
+import logging
+import os
+import pickle
 import random
+import shutil
 import string
+
+import numpy as np
+import pyarrow as pa
+import torch
 from datasets import load_dataset, concatenate_datasets
-from datasets import Dataset, load_from_disk
+from datasets import Dataset, DatasetDict, NamedSplit, load_from_disk
+from datasets.fingerprint import update_fingerprint
 
 from uie.extraction.constants import BaseStructureMarker
 
+logger = logging.getLogger(__name__)
+
+
+class StageCache:
+    """
+    Objects kept between the easy, hard and main stages run in one process by `e2h.py`:
+    raw datasets by data files, tokenized datasets by their source dataset and preprocessing,
+    the tokenizer and the model trained by the last stage.
+    """
+
+    def __init__(self):
+        self.raw_datasets = dict()
+        self.tokenized_datasets = dict()
+        self.tokenizer = None
+        self.model = None
+
+
+def read_data_files(data_files, columns=None, cache_dir=None):
+    """ Read `columns` of data files by their extension:
+    JSON lines by `uie_json.py`, Parquet by the `parquet` builder, and Arrow IPC stream files memory-mapped without parsing
+    """
+    extension = os.path.splitext(next(iter(data_files.values())))[1]
+    if extension == ".arrow":
+        datasets = DatasetDict()
+        for split, filename in data_files.items():
+            dataset = Dataset.from_file(filename, split=NamedSplit(split))
+            if columns is not None:
+                dataset = dataset.remove_columns([name for name in dataset.column_names if name not in columns])
+            datasets[split] = dataset
+        return datasets
+    if extension == ".parquet":
+        return load_dataset("parquet", data_files=data_files, columns=columns, cache_dir=cache_dir)
+    return load_dataset("uie_json.py", data_files=data_files, columns=columns, cache_dir=cache_dir)
+
+
+def load_raw_datasets(data_files, columns=None, cache_dir=None, cache=None):
+    """ Load `columns` of data files by `read_data_files`, only once in the process with `cache` """
+    if cache is None:
+        return read_data_files(data_files, columns=columns, cache_dir=cache_dir)
+    key = (tuple(sorted(data_files.items())), tuple(columns or ()))
+    if key not in cache.raw_datasets:
+        cache.raw_datasets[key] = read_data_files(data_files, columns=columns, cache_dir=cache_dir)
+    # A new dict, `process_datasets` replaces the splits
+    return DatasetDict(cache.raw_datasets[key])
+
+
+def map_dataset(dataset, function, cache=None, cache_key=(), **kwargs):
+    """ `dataset.map(function, **kwargs)`, reused with `cache` for the same source dataset, `function` and `cache_key`
+    (the arguments of `function`, e.g., max lengths)
+    """
+    if cache is None:
+        return dataset.map(function, **kwargs)
+    key = (dataset._fingerprint, function.__name__) + tuple(cache_key)
+    if key not in cache.tokenized_datasets:
+        cache.tokenized_datasets[key] = dataset.map(function, **kwargs)
+    return cache.tokenized_datasets[key]
+
+
+def file_hash(filename):
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def stage_datasets_key(data_files, data_args, seed, process_args):
+    """ Hash of everything `process_datasets` depends on: input files, stage arguments, seed and the schema types """
+    key = {
+        "data_files": {split: file_hash(filename) for split, filename in sorted(data_files.items())},
+        "stage": data_args.stage,
+        "skills": data_args.skills,
+        "empty_ratio": data_args.empty_ratio,
+        "sent_num": data_args.sent_num,
+        "M": data_args.M,
+        "stream_hard": data_args.stream_hard,
+        "seed": seed,
+        "process_args": repr(process_args),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def process_stage_datasets(process_datasets, datasets, data_files, data_args, seed, *process_args):
+    """ `process_datasets(datasets, data_args, *process_args)` with an on-disk cache in `data_args.preprocessed_folder`
+
+    Stage datasets are saved as Arrow files by their key (`stage_datasets_key`) and memory-mapped on a cache hit
+    instead of being rebuilt. Tokenized datasets are cached next to them by `datasets.map` fingerprints,
+    which cover the tokenizer and the preprocessing arguments.
+    With `preprocess=False`, missing stage datasets are built in memory without saving (read-only cache).
+    The state of `random` after `process_datasets` is saved with the datasets and restored on a cache hit,
+    so the random draws after this call (e.g., the samples of the meta collators) are the same as without the cache.
+    """
+    if data_args.preprocessed_folder is None:
+        process_datasets(datasets, data_args, *process_args)
+        return
+
+    key = stage_datasets_key(data_files, data_args, seed, process_args)
+    folder = os.path.join(data_args.preprocessed_folder, f"{data_args.stage}_{key[:16]}")
+    random_state_file = os.path.join(folder, "random_state.pkl")
+    # Folders saved without the random state are rebuilt
+    if os.path.isfile(random_state_file) and not data_args.overwrite_cache:
+        logger.info(f"Load {data_args.stage} datasets from {folder}")
+        with open(random_state_file, "rb") as reader:
+            random.setstate(pickle.load(reader))
+    else:
+        process_datasets(datasets, data_args, *process_args)
+        if not data_args.preprocess:
+            return
+        # Save into a temporary folder and rename, concurrent processes never load a partial cache
+        temp_folder = f"{folder}.{os.getpid()}.tmp"
+        DatasetDict(datasets).save_to_disk(temp_folder)
+        with open(os.path.join(temp_folder, os.path.basename(random_state_file)), "wb") as writer:
+            pickle.dump(random.getstate(), writer)
+        if os.path.isdir(folder):  # overwrite_cache, or saved without the random state
+            shutil.rmtree(folder, ignore_errors=True)
+        try:
+            os.rename(temp_folder, folder)
+        except OSError:  # saved by another process
+            shutil.rmtree(temp_folder, ignore_errors=True)
+        logger.info(f"Save {data_args.stage} datasets to {folder}")
+
+    for split, dataset in load_from_disk(folder).items():
+        datasets[split] = dataset
+
 
 def count_dataset(dataset, tokenizer):
     len_list = []
@@ -48,48 +182,154 @@ def count_datasets(datasets, tokenizer):
     count_dataset(datasets["test"], tokenizer)
 
 
-def merge(example, another_example, structure_marker):
-    example["tokens"] = example["tokens"] + another_example["tokens"]
-    example["text"] = example["text"] + " " + another_example["text"]
-    example["entity"] = example["entity"] + another_example["entity"]
-    example["relation"] = example["relation"] + another_example["relation"]
-    example["event"] = example["event"] + another_example["event"]
-    example["spot"] = example["spot"] + another_example["spot"]
-    example["asoc"] = example["asoc"] + another_example["asoc"]
-    example["spot_asoc"] = example["spot_asoc"] + another_example["spot_asoc"]
-    example["record"] = ' '.join([
-        structure_marker.sent_start,
-        " ".join(example["record"].split()[1:-1]),
-        " ".join(another_example["record"].split()[1:-1]),
-        structure_marker.sent_end,
-    ])
+# Columns concatenated by merging instances, the others are kept from the first instance
+merged_list_columns = ["tokens", "entity", "relation", "event", "spot", "asoc", "spot_asoc"]
+
+
+def is_empty_record(record, structure_marker):
+    record_tokens = record.split()
+    return len(record_tokens) == 2 and record_tokens[1] == structure_marker.sent_end
+
+
+def merge_record(records, structure_marker):
+    record = records[0]
+    for another_record in records[1:]:
+        record = ' '.join([
+            structure_marker.sent_start,
+            " ".join(record.split()[1:-1]),
+            " ".join(another_record.split()[1:-1]),
+            structure_marker.sent_end,
+        ])
+    return record
+
+
+def merge_list_array(array, index):
+    """ Concatenate the lists in rows `index[i]` of a list array for every i, by one take of the flattened values """
+    offsets = np.asarray(array.offsets)
+    starts, lengths = offsets[:-1][index], (offsets[1:] - offsets[:-1])[index]
+    merged_offsets = np.concatenate([[0], np.cumsum(lengths.sum(axis=1))])
+    starts, lengths = starts.ravel(), lengths.ravel()
+    values_index = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    return type(array).from_arrays(pa.array(merged_offsets, type=array.offsets.type),
+                                   array.values.take(pa.array(values_index)))
+
+
+def merge_columns(table, index, structure_marker):
+    """ Table of the instances merged from rows `index[i]` of `table` in order, the same as merging them one by one
+
+    Args:
+        table (pa.Table): source instances
+        index (np.ndarray): (num instances, num merged rows)
+        structure_marker:
+
+    Returns:
+        pa.Table: merged instances with the schema of `table`
+    """
+    columns = list()
+    for name in table.column_names:
+        column = pa.concat_arrays(table.column(name).chunks)
+        if name in merged_list_columns:
+            columns += [merge_list_array(column, index)]
+        elif name == "text":
+            text = column.to_pylist()
+            columns += [pa.array([" ".join(text[i] for i in row) for row in index.tolist()], type=column.type)]
+        elif name == "record":
+            record = column.to_pylist()
+            columns += [pa.array([merge_record([record[i] for i in row], structure_marker) for row in index.tolist()],
+                                 type=column.type)]
+        else:
+            columns += [column.take(pa.array(index[:, 0]))]
+    return pa.Table.from_arrays(columns, schema=table.schema)
+
+
+def draw_hard_index(num_instances, non_empty_index, sent_num, generator=None):
+    """ Rows of hard instances, every instance is followed by `sent_num - 1` random non-empty instances
+
+    Without `generator`, partners are drawn by `random.randrange` in the order of `random.choice` on every instance,
+    so the hard instances are the same as merging them one by one under a fixed seed.
+    """
+    if generator is None:
+        draws = np.array([random.randrange(len(non_empty_index)) for _ in range(num_instances * (sent_num - 1))],
+                         dtype=np.int64)
+    else:
+        draws = generator.integers(len(non_empty_index), size=num_instances * (sent_num - 1))
+    partner_index = non_empty_index[draws.reshape(num_instances, sent_num - 1)]
+    return np.concatenate([np.arange(num_instances)[:, None], partner_index], axis=1)
+
+
+def get_non_empty_index(records, structure_marker):
+    return np.array([index for index, record in enumerate(records) if not is_empty_record(record, structure_marker)],
+                    dtype=np.int64)
 
 
 def build_hard(train_dataset, sent_num=2, M=1):
     # for each training example of the main task, we randomly sample M training examples to construct M hard instances
     structure_marker = BaseStructureMarker()
-    hard_train_dataset = None
-    for _ in range(M):
-        dataset = copy.deepcopy(train_dataset)
-        data = []
-        for instance in dataset:
-            if len(instance["record"].split()) == 2 and instance["record"].split()[1] == structure_marker.sent_end:
-                continue
-            else:
-                data.append(instance)
-        data = {k: [r.get(k) for r in data] for k in data[0]}
-        new_dataset = Dataset.from_dict(data, features=dataset.features)  # convert dict to dataset
-        examples = []
-        for i, example in enumerate(dataset):
-            for n in range(1, sent_num):
-                another_example = random.choice(new_dataset)
-                merge(example, another_example, structure_marker)
-            examples.append(example)
-        examples = {k: [r.get(k) for r in examples] for k in examples[0]}
-        dataset = Dataset.from_dict(examples, features=dataset.features)  # convert dict to dataset
-        hard_train_dataset = concatenate_datasets([hard_train_dataset, dataset]) if hard_train_dataset else dataset
-        
-    return hard_train_dataset
+    if train_dataset._indices is not None:
+        train_dataset = train_dataset.flatten_indices()
+    non_empty_index = get_non_empty_index(train_dataset["record"], structure_marker)
+    index = np.concatenate([draw_hard_index(len(train_dataset), non_empty_index, sent_num) for _ in range(M)])
+    fingerprint = update_fingerprint(train_dataset._fingerprint, build_hard, {"index": index})
+    return Dataset(merge_columns(train_dataset.data.table, index, structure_marker),
+                   info=train_dataset.info.copy(), split=train_dataset.split, fingerprint=fingerprint)
+
+
+class HardInstanceIterableDataset(torch.utils.data.IterableDataset):
+    """
+    Hard instances merged from the base train set on the fly, instead of materializing them by `build_hard`.
+    Every epoch, every base instance is merged with `sent_num - 1` non-empty instances drawn with `seed + epoch`,
+    `M` times for every `sent_num` in `sent_num_list`, so only the base set is kept and every epoch sees new pairings.
+    Hard instances are shuffled, merged and processed by the batched `function` (e.g., tokenization) chunk by chunk;
+    DataLoader workers take every `num_workers`-th chunk and batch it on their own, so `chunk_size` is rounded up
+    to a multiple of `batch_size` (the batch size of all processes together, e.g., `train_batch_size * world_size`):
+    only the worker of the last chunk yields a partial batch, and an epoch has as many batches as `len(dataloader)`.
+    The epoch is set by `set_epoch`, which `ConstraintSeq2SeqTrainer` calls at the beginning of every epoch.
+    """
+
+    def __init__(self, train_dataset, sent_num_list, M, function, seed=0, chunk_size=1000, batch_size=1):
+        if len(sent_num_list) == 0:
+            raise ValueError("sent_num_list of hard instances is empty.")
+        if train_dataset._indices is not None:
+            train_dataset = train_dataset.flatten_indices()
+        self.structure_marker = BaseStructureMarker()
+        self.table = train_dataset.data.table
+        self.non_empty_index = get_non_empty_index(train_dataset["record"], self.structure_marker)
+        self.num_instances = len(train_dataset)
+        # One group of hard instances for every sent_num and every m in M
+        self.group_sent_num = [sent_num for sent_num in sent_num_list for _ in range(M)]
+        self.function = function
+        self.seed = seed
+        self.chunk_size = -(-chunk_size // batch_size) * batch_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_instances * len(self.group_sent_num)
+
+    def __iter__(self):
+        generator = np.random.default_rng(self.seed + self.epoch)
+        group_index = [draw_hard_index(self.num_instances, self.non_empty_index, sent_num, generator)
+                       for sent_num in self.group_sent_num]
+        order = generator.permutation(len(self))
+
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for start in range(worker_id * self.chunk_size, len(order), num_workers * self.chunk_size):
+            chunk = order[start:start + self.chunk_size]
+            groups = chunk // self.num_instances
+            tables, positions = list(), list()
+            for group in np.unique(groups):
+                position = np.nonzero(groups == group)[0]
+                index = group_index[group][chunk[position] % self.num_instances]
+                tables += [merge_columns(self.table, index, self.structure_marker)]
+                positions += [position]
+            # Restore the shuffled order inside the chunk
+            merged = pa.concat_tables(tables).take(pa.array(np.argsort(np.concatenate(positions))))
+            features = self.function(merged.to_pydict())
+            for i in range(len(merged)):
+                yield {key: value[i] for key, value in features.items()}
 
 
 def convert_spot_asoc(spot_asoc_instance, structure_marker):
@@ -156,18 +396,73 @@ def convert_asoc(asoc_instance, structure_marker):
     return target_text
 
 
-def balance_data(data, data_args):
-    empty_data = [x for x in data if x["empty"]]
-    non_empty_data = [x for x in data if not x["empty"]]
-    # print("len(empty_data): ", len(empty_data))
-    # print("len(non_empty_data): ", len(non_empty_data))
-    if len(empty_data) / len(data) > data_args.empty_ratio:
-        random.shuffle(empty_data)
-        num = int(len(non_empty_data) * data_args.empty_ratio / (1 - data_args.empty_ratio))
-        empty_data = empty_data[:num]
-        # print("len(empty_data) after downsampling: ", len(empty_data))
-        data = non_empty_data + empty_data
-        # random.shuffle(data)
-    return data
+def skill_instance(skill, skill_input, record, structure_marker):
+    """ Changed columns of a skill instance, `empty` if the record has no spot """
+    return {
+        "record": record,
+        "skill": skill,
+        "skill_input": skill_input,
+        "empty": is_empty_record(record, structure_marker),
+    }
+
+
+def balance_indices(empty, data_args):
+    """ Positions of the kept instances by their `empty` flags,
+    empty instances are downsampled to at most `empty_ratio` of the kept ones
+    """
+    empty_index = [index for index, is_empty in enumerate(empty) if is_empty]
+    non_empty_index = [index for index, is_empty in enumerate(empty) if not is_empty]
+    if len(empty) > 0 and len(empty_index) / len(empty) > data_args.empty_ratio:
+        random.shuffle(empty_index)
+        num = int(len(non_empty_index) * data_args.empty_ratio / (1 - data_args.empty_ratio))
+        return non_empty_index + empty_index[:num]
+    return list(range(len(empty)))
+
+
+def take_rows(dataset, indices):
+    """ Rows of `dataset` by `indices` as a new in-memory Arrow table
+
+    Unlike `select`, the result has no indices mapping, which the concatenation of columns ignores;
+    unlike `flatten_indices`, rows are gathered by `pyarrow.Table.take` without decoding them to python objects.
+    """
+    if dataset._indices is not None:
+        dataset = dataset.flatten_indices()
+    fingerprint = update_fingerprint(dataset._fingerprint, take_rows, {"indices": indices})
+    return Dataset(dataset.data.table.take(indices), info=dataset.info.copy(), split=dataset.split,
+                   fingerprint=fingerprint)
+
+
+def decompose_dataset(dataset, decompose_function, input_columns, skill_order, data_args, fn_kwargs=None):
+    """ Decompose every instance into skill instances for the easy stage
+
+    `decompose_function(*input_columns, indices, **fn_kwargs)` runs as a batched map and only emits the changed
+    columns (`record`, `skill`, `skill_input`, `empty`) and `source_index` of every skill instance, instead of copying
+    the whole instance. Skill instances are balanced per skill and ordered by `skill_order`, then the unchanged columns
+    are taken from the source rows by `source_index`.
+    """
+    skill_dataset = dataset.map(
+        decompose_function,
+        batched=True,
+        with_indices=True,
+        input_columns=input_columns,
+        remove_columns=dataset.column_names,
+        num_proc=data_args.preprocessing_num_workers,
+        load_from_cache_file=not data_args.overwrite_cache,
+        fn_kwargs=fn_kwargs,
+    )
+
+    skill_column, empty_column = skill_dataset["skill"], skill_dataset["empty"]
+    order = []
+    for skill in skill_order:
+        # Balance every skill even if it is not used, to keep the random state the same as training with all skills
+        skill_index = [index for index, name in enumerate(skill_column) if name == skill]
+        kept_index = balance_indices([empty_column[index] for index in skill_index], data_args)
+        if skill in data_args.skills:
+            order += [skill_index[index] for index in kept_index]
+
+    skill_dataset = take_rows(skill_dataset, order)
+    source_dataset = dataset.remove_columns([name for name in skill_dataset.column_names if name in dataset.column_names])
+    source_dataset = take_rows(source_dataset, skill_dataset["source_index"])
+    return concatenate_datasets([source_dataset, skill_dataset.remove_columns("source_index")], axis=1)
 
 